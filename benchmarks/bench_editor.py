@@ -0,0 +1,333 @@
+"""Benchmarks for the editor's hot paths.
+
+    python benchmarks/bench_editor.py                          # 10k and 100k rows
+    python benchmarks/bench_editor.py --rows 1000000 --repeat 1
+    python benchmarks/bench_editor.py --json before.json       # save the results...
+    python benchmarks/bench_editor.py --compare before.json    # ...and compare a later run
+    xvfb-run python benchmarks/bench_editor.py --gui           # through JsonlEditorAppTk
+
+Every case runs on a synthetic dataset (see synthetic.py) and reports the
+best wall time of --repeat runs and the peak memory allocated by Python
+during one more run under tracemalloc. By default the cases call the data
+core the editor is built on (jsonl_dataset), so no display is needed;
+--gui drives the editor's own methods instead.
+"""
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jsonl_dataset import Dataset, ReferenceIndex, ScanCache, diff_files # noqa: E402
+from synthetic import write_dataset # noqa: E402
+
+CASES = ("load", "reopen", "populate_listbox", "find_duplicates", "undo", "save", "search", "near_duplicates", "diff",
+         "contamination", "statistics")
+UNDO_STEPS = 200
+VISIBLE_ROWS = 40
+SEARCH_QUERIES = ("summarize", "answer question", "model data text", "translate sentence french", "zzz")
+SLOWER = 1.2 # --compare flags cases slower than the baseline by this factor
+
+
+class _InlineTask:
+    """Stands in for BackgroundTask: the worker runs inline and its messages apply at once."""
+
+    def __init__(self, on_message=None):
+        self.on_message = on_message
+
+    def cancelled(self):
+        return False
+
+    def post(self, *message):
+        if self.on_message is not None:
+            self.on_message(*message)
+
+
+def _load(path, use_cache=False):
+    # Without the index cache unless asked, so "load" always measures a full scan.
+    dataset = Dataset.map(path)
+    task = _InlineTask(lambda kind, *message: kind == "rows" and
+                       dataset.extend_scanned(*message[:4], shard=message[6]))
+    dataset.finish_scan(dataset.scan(task, use_cache=use_cache))
+    return dataset
+
+
+@contextlib.contextmanager
+def _cache_any_size():
+    # Lets small benchmark files have an index cache; later cases see the usual threshold.
+    min_bytes = ScanCache.MIN_BYTES
+    ScanCache.MIN_BYTES = 0
+    try:
+        yield
+    finally:
+        ScanCache.MIN_BYTES = min_bytes
+
+
+def _indexed(path):
+    # Loads once so that the file has an up-to-date index cache, whatever its size.
+    with _cache_any_size():
+        _load(path, use_cache=True).close()
+    return path
+
+
+def _reopen(path):
+    with _cache_any_size():
+        return _load(path, use_cache=True)
+
+
+def _edited(record, n):
+    record = dict(record)
+    record[Dataset.KEY_OUTPUT] = f"{record.get(Dataset.KEY_OUTPUT, '')} (edit {n})"
+    return record
+
+
+# --- Core cases: setup(path) returns the state run(state) works on; only run() is timed ---
+
+def _core_cases():
+    def populate(dataset):
+        # What the virtual list does for one screen: read, preview and color the visible rows.
+        for i in range(min(VISIBLE_ROWS, len(dataset))):
+            record = dataset[i]
+            str(record.get(Dataset.KEY_INSTRUCTION, ''))[:50].replace('\n', ' ')
+            dataset.is_duplicate(i)
+
+    def undo(dataset):
+        store = dataset.store
+        step = max(1, len(store) // UNDO_STEPS)
+        for n in range(UNDO_STEPS):
+            dataset.history.begin(f"Edit {n}", n)
+            index = (n * step) % len(store)
+            store[index] = _edited(store[index], n)
+        while dataset.history.can_undo():
+            dataset.history.undo(0)
+        while dataset.history.can_redo():
+            dataset.history.redo()
+
+    def edit_for_save(path):
+        dataset = _load(path)
+        for n in range(0, len(dataset), max(1, len(dataset) // UNDO_STEPS)):
+            dataset.store[n] = _edited(dataset[n], n)
+        return dataset
+
+    def edited_copy(path):
+        # Another version of the file: UNDO_STEPS records edited, as many removed, a few moved.
+        dataset = _load(path)
+        step = max(1, len(dataset) // UNDO_STEPS)
+        n = 0
+        while n + 1 < len(dataset):
+            dataset.store[n] = _edited(dataset[n], n)
+            del dataset.store[n + 1]
+            n += step
+        for n in range(0, len(dataset), 10 * step):
+            dataset.move([n], len(dataset))
+        other = path + ".edited.jsonl"
+        dataset.store.save(other)
+        dataset.close()
+        return path, other
+
+    def with_reference(path):
+        # The file is its own eval set, so every record is looked up in full; its index is
+        # built here and only opened by the timed run.
+        ReferenceIndex.open(path).close()
+        return _load(path)
+
+    def contamination(dataset):
+        index = dataset.build_contamination([dataset.path])
+        index.close()
+        return index
+
+    def search(dataset):
+        for query in SEARCH_QUERIES:
+            dataset.find(query, "token")
+            dataset.find(query, "phrase")
+
+    return {
+        "load": (lambda path: path, _load),
+        "reopen": (_indexed, _reopen),
+        "populate_listbox": (_load, populate),
+        "find_duplicates": (_load, lambda dataset: dataset.duplicates.attach(dataset.store)),
+        "undo": (_load, undo),
+        "save": (edit_for_save, lambda dataset: dataset.save()),
+        "search": (_load, search),
+        "near_duplicates": (_load, lambda dataset: dataset.build_near_duplicates(0.8)),
+        "diff": (edited_copy, lambda paths: sum(1 for entry in diff_files(*paths))),
+        "contamination": (with_reference, contamination),
+        "statistics": (_load, lambda dataset: dataset.build_stats()),
+    }
+
+
+# --- GUI cases: the same paths through JsonlEditorAppTk ---
+
+def _gui_cases():
+    import tkinter as tk
+    import jsonl_editor
+
+    # Dialogs would block an unattended run
+    jsonl_editor.messagebox.askyesno = lambda *args, **kwargs: True
+    jsonl_editor.messagebox.askyesnocancel = lambda *args, **kwargs: False
+    jsonl_editor.messagebox.showerror = lambda title, message, **kwargs: print(f"{title}: {message}", file=sys.stderr)
+    jsonl_editor.messagebox.showwarning = jsonl_editor.messagebox.showerror
+
+    root = tk.Tk()
+
+    def wait_idle(app):
+        while app.busy_task is not None:
+            root.update()
+            time.sleep(0.001)
+        root.update()
+
+    def new_app(path):
+        for child in root.winfo_children():
+            child.destroy()
+        app = jsonl_editor.JsonlEditorAppTk(root)
+        app.pending_path = path
+        return app
+
+    def load(app):
+        jsonl_editor.filedialog.askopenfilename = lambda **kwargs: app.pending_path
+        app.load_file()
+        wait_idle(app)
+        return app
+
+    def populate(app):
+        app.populate_listbox()
+        root.update_idletasks()
+
+    def undo(app):
+        step = max(1, len(app.data) // UNDO_STEPS)
+        for n in range(UNDO_STEPS):
+            app._push_state_to_undo(f"Edit {n}")
+            index = (n * step) % len(app.data)
+            app.data[index] = _edited(app.data[index], n)
+        while app.dataset.history.can_undo():
+            app.undo_action()
+
+    def edit_for_save(path):
+        app = load(new_app(path))
+        for n in range(0, len(app.data), max(1, len(app.data) // UNDO_STEPS)):
+            app.data[n] = _edited(app.data[n], n)
+        app.is_dirty_file = True
+        return app
+
+    return {
+        "load": (new_app, load),
+        "populate_listbox": (lambda path: load(new_app(path)), populate),
+        "find_duplicates": (lambda path: load(new_app(path)), lambda app: app._find_duplicate_inputs()),
+        "undo": (lambda path: load(new_app(path)), undo),
+        "save": (edit_for_save, lambda app: app.save_data_to_file(autosave=False)),
+    }
+
+
+def _measure(setup, run, path, repeat, memory):
+    best = None
+    for _ in range(repeat):
+        state = setup(path)
+        start = time.perf_counter()
+        result = run(state)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        _close(state, result)
+    peak = None
+    if memory:
+        state = setup(path)
+        tracemalloc.start()
+        result = run(state)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        _close(state, result)
+    return best, peak
+
+
+def _close(*states):
+    for state in states:
+        dataset = getattr(state, "dataset", state)
+        if isinstance(dataset, Dataset):
+            dataset.close()
+
+
+def run_benchmarks(rows_list, cases, repeat=3, duplicate_rate=0.1, seed=0, memory=True, gui=False, workdir=None):
+    available = _gui_cases() if gui else _core_cases()
+    results = []
+    workdir = workdir or tempfile.mkdtemp(prefix="jsonl-bench-")
+    try:
+        for rows in rows_list:
+            source = write_dataset(os.path.join(workdir, f"synthetic-{rows}.jsonl"), rows, duplicate_rate, seed)
+            for case in cases:
+                if case not in available:
+                    continue
+                path = os.path.join(workdir, f"work-{rows}.jsonl")
+                shutil.copyfile(source, path) # "save" rewrites its file
+                setup, run = available[case]
+                seconds, peak = _measure(setup, run, path, repeat, memory)
+                result = {"case": case, "rows": rows, "mode": "gui" if gui else "core",
+                          "seconds": round(seconds, 6), "peak_bytes": peak}
+                results.append(result)
+                _print_result(result)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def _print_result(result, baseline=None):
+    peak = f"{result['peak_bytes'] / 1e6:10.1f} MB" if result["peak_bytes"] is not None else "         - MB"
+    line = f"{result['case']:<18}{result['rows']:>10}  {result['seconds'] * 1000:12.1f} ms  {peak}"
+    if baseline is not None:
+        ratio = result["seconds"] / baseline["seconds"] if baseline["seconds"] else float('inf')
+        line += f"  {ratio:6.2f}x{'  SLOWER' if ratio > SLOWER else ''}"
+    print(line, flush=True)
+
+
+def compare(results, baseline_results):
+    # Prints each result next to the baseline result for the same case, size and mode.
+    # Returns the number of cases that got slower by more than SLOWER.
+    baseline = {(r["case"], r["rows"], r["mode"]): r for r in baseline_results}
+    slower = 0
+    print(f"\n{'case':<18}{'rows':>10}  {'time':>15}  {'peak':>13}  vs baseline")
+    for result in results:
+        previous = baseline.get((result["case"], result["rows"], result["mode"]))
+        _print_result(result, previous)
+        if previous and previous["seconds"] and result["seconds"] / previous["seconds"] > SLOWER:
+            slower += 1
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the editor's hot paths on synthetic datasets.")
+    parser.add_argument("--rows", default="10000,100000", help="comma-separated dataset sizes (default: %(default)s)")
+    parser.add_argument("--cases", default=",".join(CASES), help="comma-separated cases (default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case; the best time is reported")
+    parser.add_argument("--duplicate-rate", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc run")
+    parser.add_argument("--gui", action="store_true", help="drive JsonlEditorAppTk (needs a display, e.g. xvfb-run)")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="compare with results written by --json; exits 1 if a case got slower")
+    args = parser.parse_args(argv)
+
+    rows_list = [int(rows) for rows in args.rows.split(",")]
+    cases = [case for case in args.cases.split(",") if case]
+    unknown = set(cases) - set(CASES)
+    if unknown:
+        parser.error(f"unknown cases: {', '.join(sorted(unknown))}")
+
+    print(f"{'case':<18}{'rows':>10}  {'time':>15}  {'peak':>13}")
+    results = run_benchmarks(rows_list, cases, args.repeat, args.duplicate_rate, args.seed,
+                             memory=not args.no_memory, gui=args.gui)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({"python": sys.version.split()[0], "results": results}, f, indent=2)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            slower = compare(results, json.load(f)["results"])
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,77 @@
+"""Synthetic instruction/input/output datasets for the benchmarks.
+
+    python benchmarks/synthetic.py data.jsonl --rows 100000 --duplicate-rate 0.1
+
+The same arguments and seed always produce the same file, so timings taken
+on different commits are comparable.
+"""
+import argparse
+import json
+import random
+
+_WORDS = (
+    "the model should answer question about data text summary list number city country river "
+    "history science language translate explain describe compare write short long story poem "
+    "code function return value error test file line record field input output example result "
+    "reason step first second third final because however therefore while during after before"
+).split()
+
+_INSTRUCTIONS = (
+    "Summarize the following text.",
+    "Translate the following sentence to French.",
+    "Answer the question using the context.",
+    "Classify the sentiment of the review.",
+    "Rewrite the paragraph in plain language.",
+    "Extract the named entities from the text.",
+)
+
+
+def _sentence(rng, low, high):
+    return " ".join(rng.choice(_WORDS) for _ in range(rng.randint(low, high))).capitalize() + "."
+
+
+def generate_records(rows, duplicate_rate=0.1, seed=0, input_words=(10, 60), output_words=(5, 40)):
+    # Yields `rows` records. About `duplicate_rate` of them repeat the input of an earlier
+    # record exactly, and as many again repeat it with a small change (near-duplicates).
+    rng = random.Random(seed)
+    inputs = []
+    for i in range(rows):
+        draw = rng.random()
+        if inputs and draw < duplicate_rate:
+            text = rng.choice(inputs)
+        elif inputs and draw < 2 * duplicate_rate:
+            words = rng.choice(inputs).split()
+            words[rng.randrange(len(words))] = rng.choice(_WORDS)
+            text = " ".join(words)
+        else:
+            text = " ".join(_sentence(rng, *input_words) for _ in range(rng.randint(1, 3)))
+            if rng.random() < 0.1:
+                text = "" # Some tasks have no input
+        if text and len(inputs) < 100000:
+            inputs.append(text)
+        yield {
+            "instruction": rng.choice(_INSTRUCTIONS),
+            "input": text,
+            "output": _sentence(rng, *output_words),
+        }
+
+
+def write_dataset(path, rows, duplicate_rate=0.1, seed=0):
+    with open(path, 'w', encoding='utf-8', buffering=1024 * 1024) as f:
+        for record in generate_records(rows, duplicate_rate, seed):
+            f.write(json.dumps(record) + "\n")
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a synthetic JSONL dataset.")
+    parser.add_argument("output")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--duplicate-rate", type=float, default=0.1, help="share of exact duplicate inputs (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    write_dataset(args.output, args.rows, args.duplicate_rate, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,428 @@
+"""Command-line tools for JSONL datasets, without opening a window.
+
+    python jsonl_editor.py dedupe data.jsonl -o clean.jsonl --near 0.8
+    python jsonl_editor.py validate data.jsonl --require-keys instruction,output
+    python jsonl_editor.py stats data.jsonl --histogram
+    python jsonl_editor.py split data.jsonl --ratios 0.9,0.1 -o splits/ --by-content
+    python jsonl_editor.py shuffle data.jsonl -o shuffled.jsonl.gz --shard-size 500M
+    python jsonl_editor.py sample data.jsonl -n 1000 -o sample.jsonl
+    python jsonl_editor.py diff old.jsonl new.jsonl
+    python jsonl_editor.py merge base.jsonl ours.jsonl theirs.jsonl -o merged.jsonl
+    python jsonl_editor.py contamination train.jsonl --reference eval.jsonl
+
+Every command streams its input one line at a time through the same helpers
+the editor uses (``jsonl_dataset``), so files of any size can be processed;
+``validate`` checks chunks of the file in parallel processes, and ``dedupe``
+and ``stats`` hash the inputs into buckets on disk in parallel processes, so
+files with more distinct inputs than fit in memory can be deduplicated and
+counted. Files ending in .gz, .bz2 or .xz are decompressed and compressed on
+the fly, and ``validate`` also accepts a directory of shards. ``diff`` and ``merge`` keep 8-byte hashes
+of every record in memory and the changed records only. ``contamination``
+indexes each reference file once into a ``.refindex`` file next to it.
+Lines that are written out are copied byte for byte, except records merged
+from both sides of a ``merge``.
+"""
+import argparse
+import json
+import os
+import sys
+
+from jsonl_dataset import (COMPRESSIONS, DEDUPE_MEMORY_BUDGET, IO_BUFFER_SIZE, SHUFFLE_MEMORY_BUDGET, ContaminationIndex,
+                           Dataset, RecordStats, ReferenceIndex, ShardedWriter, compression_of, count_values, dedupe_file,
+                           dedupe_records, diff_files, iter_records, merge_files, open_data_file, sample_records, shuffle_lines,
+                           split_records, validate_file)
+
+COMMANDS = ("dedupe", "validate", "stats", "split", "shuffle", "sample", "diff", "merge", "contamination")
+DIFF_MARKS = {"added": "+", "removed": "-", "modified": "~", "moved": ">"}
+HISTOGRAM_WIDTH = 40 # Characters of the longest bar printed by stats --histogram
+
+
+def _open_output(path, args=None):
+    # `args` with --shard-lines or --shard-size set writes shards named after `path` instead.
+    shard_lines, shard_bytes = getattr(args, "shard_lines", None), getattr(args, "shard_size", None)
+    if path == '-':
+        if shard_lines or shard_bytes:
+            raise ValueError("sharded output needs an output file name (-o)")
+        return open(sys.stdout.fileno(), 'wb', buffering=IO_BUFFER_SIZE, closefd=False)
+    if shard_lines or shard_bytes:
+        return ShardedWriter(path, shard_lines, shard_bytes)
+    return open_data_file(path, 'wb') # Compressed when the name ends in .gz, .bz2 or .xz
+
+
+def _report_errors(errors, limit=20):
+    for e in errors[:limit]:
+        print(e, file=sys.stderr)
+    if len(errors) > limit:
+        print(f"... and {len(errors) - limit} more invalid lines", file=sys.stderr)
+
+
+def cmd_dedupe(args):
+    errors = []
+    if args.near: # Near-duplicates are found in one pass, comparing each record with the kept ones
+        removed = []
+        kept = 0
+        records = iter_records(args.input, errors if args.skip_invalid else None)
+        with _open_output(args.output, args) as out:
+            for line_number, line, record in dedupe_records(records, args.key, removed, args.near):
+                out.write(line)
+                out.write(b"\n")
+                kept += 1
+        if args.report:
+            with open(args.report, 'w', encoding='utf-8') as f:
+                for line_number in removed:
+                    f.write(f"{line_number}\n")
+        removed = len(removed)
+    else: # Hashed into buckets on disk, so any number of distinct inputs fits in --memory
+        with _open_output(args.output, args) as out, \
+                open(args.report if args.report else os.devnull, 'w', encoding='utf-8') as report:
+            kept, removed = dedupe_file(args.input, out, args.key, report, errors if args.skip_invalid else None,
+                                        args.memory, args.jobs)
+    _report_errors(errors)
+    kind = f"duplicates and near-duplicates (similarity >= {args.near})" if args.near else "duplicates"
+    print(f"Kept {kept} records, removed {removed} {kind} of '{args.key}'"
+          + (f", skipped {len(errors)} invalid lines" if errors else ""), file=sys.stderr)
+    return 0
+
+
+def cmd_validate(args):
+    required = [key for key in args.require_keys.split(',') if key] if args.require_keys else []
+    problems = 0
+    records = 0
+    # Chunks of the file are checked by a pool of processes; problems still come in line order.
+    for chunk_records, messages in validate_file(args.input, required, args.jobs):
+        records += chunk_records
+        for line_number, message in messages:
+            problems += 1
+            if not args.max_errors or problems <= args.max_errors:
+                print(message)
+    if args.max_errors and problems > args.max_errors:
+        print(f"... and {problems - args.max_errors} more problems")
+    print(f"{records} valid JSON lines, {problems} problems", file=sys.stderr)
+    return 1 if problems else 0
+
+
+def cmd_stats(args):
+    # Duplicate inputs and repeated instructions are counted in hash buckets on disk first,
+    # so memory does not grow with the number of distinct values; the pass over the records
+    # then picks up the text of the most repeated instructions.
+    groups, _ = count_values(args.input, Dataset.KEY_INPUT, errors=[], memory_budget=args.memory, workers=args.jobs)
+    _, top = count_values(args.input, Dataset.KEY_INSTRUCTION, RecordStats.TOP_INSTRUCTIONS, [], args.memory, args.jobs)
+    wanted = {line_number: records for records, line_number in top}
+    texts = {}
+    stats = RecordStats(count_inputs=False, count_instructions=False)
+    errors = []
+    for line_number, line, record in iter_records(args.input, errors):
+        stats.add(record)
+        if line_number in wanted:
+            texts[line_number] = str(record[Dataset.KEY_INSTRUCTION]).strip()[:RecordStats.PREVIEW_CHARS]
+    summary = stats.summary()
+    summary["invalid_lines"] = len(errors)
+    summary["duplicate_inputs"] = sum((size - 1) * count for size, count in groups.items())
+    summary["duplicate_groups"] = groups
+    summary["top_instructions"] = [{"instruction": texts[line_number], "records": records} for records, line_number in top]
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return 0
+    print(f"Records:           {summary['records']}")
+    print(f"Invalid lines:     {summary['invalid_lines']}")
+    print(f"Duplicate inputs:  {summary['duplicate_inputs']}")
+    if summary["duplicate_groups"]:
+        print("Duplicate groups:  " + ", ".join(f"{groups} of {size}" for size, groups in summary["duplicate_groups"].items()))
+    print(f"Tokens (estimate): {summary['tokens']}")
+    for key, field in summary["fields"].items():
+        print(f"{key}: missing {field['missing']}, empty {field['empty']}, "
+              f"mean {field['mean_chars']} chars, max {field['max_chars']} chars, ~{field['tokens']} tokens")
+    if summary["top_instructions"]:
+        print("Most repeated instructions:")
+        for entry in summary["top_instructions"]:
+            print(f"  {entry['records']:>9}  {_preview(entry['instruction'])}")
+    if args.histogram:
+        for key, field in summary["fields"].items():
+            print(f"{key} length in characters:")
+            peak = max((values for low, high, values in field["histogram"]), default=0)
+            for low, high, values in field["histogram"]:
+                label = str(low) if low == high else f"{low}-{high}"
+                print(f"  {label:>15} {values:>10}  {'#' * round(HISTOGRAM_WIDTH * values / peak)}")
+    return 0
+
+
+def cmd_split(args):
+    ratios = [float(r) for r in args.ratios.split(',')]
+    names = args.names.split(',') if args.names else None
+    if names is None:
+        names = ["train", "validation", "test"][:len(ratios)] if len(ratios) <= 3 else [f"part{i}" for i in range(len(ratios))]
+    if len(names) != len(ratios) or any(r < 0 for r in ratios) or not sum(ratios):
+        print("split: --names must match --ratios, and ratios must be non-negative and not all zero", file=sys.stderr)
+        return 2
+    os.makedirs(args.output, exist_ok=True)
+    base, compressed = os.path.splitext(os.path.basename(args.input))
+    if compressed.lower() not in COMPRESSIONS: # Parts are compressed like the input
+        base, compressed = os.path.basename(args.input), ""
+    stem = os.path.splitext(base)[0]
+    paths = [os.path.join(args.output, f"{stem}.{name}.jsonl{compressed}") for name in names]
+    counts = [0] * len(paths)
+    errors = []
+    outputs = [_open_output(path, args) for path in paths]
+    try:
+        records = iter_records(args.input, errors)
+        for part, line_number, line, record in split_records(records, ratios, args.seed, args.by_content or bool(args.hash_key),
+                                                             args.hash_key):
+            outputs[part].write(line)
+            outputs[part].write(b"\n")
+            counts[part] += 1
+    finally:
+        for out in outputs:
+            out.close()
+    _report_errors(errors)
+    for out, path, count in zip(outputs, paths, counts):
+        shards = f" ({len(out.paths)} shards)" if isinstance(out, ShardedWriter) and out.sharded else ""
+        print(f"{count:>10}  {path}{shards}", file=sys.stderr)
+    return 0
+
+
+def cmd_shuffle(args):
+    errors = []
+    # Decompressed files are larger than they are on disk; the hint only sets the number of runs
+    size_hint = os.path.getsize(args.input) * (4 if compression_of(args.input) else 1)
+    lines = (line for line_number, line, record in iter_records(args.input, errors if args.skip_invalid else None))
+    count = 0
+    with _open_output(args.output, args) as out:
+        for line in shuffle_lines(lines, args.seed, args.memory, size_hint):
+            out.write(line)
+            out.write(b"\n")
+            count += 1
+    _report_errors(errors)
+    print(f"Shuffled {count} records" + (f", skipped {len(errors)} invalid lines" if errors else ""), file=sys.stderr)
+    return 0
+
+
+def cmd_sample(args):
+    errors = []
+    picked = sample_records(iter_records(args.input, errors if args.skip_invalid else None), args.count, args.seed)
+    with _open_output(args.output, args) as out:
+        for line_number, line in picked:
+            out.write(line)
+            out.write(b"\n")
+    _report_errors(errors)
+    print(f"Sampled {len(picked)} records" + (f", skipped {len(errors)} invalid lines" if errors else ""), file=sys.stderr)
+    return 0
+
+
+def _preview(record, width=60):
+    value = record.get(Dataset.KEY_INSTRUCTION, "") if isinstance(record, dict) else record
+    text = (value if isinstance(value, str) else json.dumps(value)).replace("\n", " ")
+    return text[:width] + ("..." if len(text) > width else "")
+
+
+def cmd_diff(args):
+    errors = []
+    counts = dict.fromkeys(DIFF_MARKS, 0)
+    for entry in diff_files(args.old, args.new, args.key, errors if args.skip_invalid else None):
+        counts[entry.kind] += 1
+        if args.json:
+            print(json.dumps(entry.to_json()))
+        elif not args.summary:
+            where = (f"line {entry.old_line} -> {entry.new_line}" if entry.old_line and entry.new_line
+                     else f"line {entry.old_line or entry.new_line}")
+            fields = f" [{', '.join(str(key) for key in entry.fields)}]" if entry.fields else ""
+            print(f"{DIFF_MARKS[entry.kind]} {where}{fields}: {_preview(entry.new_record or entry.old_record)}")
+    _report_errors(errors)
+    print(", ".join(f"{count} {kind}" for kind, count in counts.items()), file=sys.stderr)
+    return 1 if any(counts.values()) else 0
+
+
+def cmd_merge(args):
+    if args.output != '-' and any(os.path.abspath(args.output) == os.path.abspath(path)
+                                  for path in (args.base, args.ours, args.theirs)):
+        print("merge: the output must be a new file, not one of the versions being merged", file=sys.stderr)
+        return 2
+    errors = []
+    conflicts = []
+    with _open_output(args.output) as out:
+        counts = merge_files(args.base, args.ours, args.theirs, out, args.key, args.prefer, conflicts,
+                             errors if args.skip_invalid else None)
+    if args.conflicts:
+        with open(args.conflicts, 'w', encoding='utf-8') as f:
+            for conflict in conflicts:
+                f.write(json.dumps(conflict) + "\n")
+    _report_errors(errors)
+    for conflict in conflicts[:20]:
+        fields = ", ".join(str(key) for key in conflict["fields"]) if conflict["fields"] != [None] else "deleted on one side"
+        print(f"Conflict in base line {conflict['base_line']} ({fields}); kept {args.prefer}", file=sys.stderr)
+    print(f"Wrote {counts['records']} records: {counts['from_theirs']} changed in theirs only, {counts['combined']} "
+          f"changed on both sides, {counts['added']} added, {counts['deleted']} deleted, {counts['conflicts']} conflicts",
+          file=sys.stderr)
+    return 1 if conflicts else 0
+
+
+def cmd_contamination(args):
+    references = [ReferenceIndex.open(path, workers=args.jobs) for path in args.reference]
+    index = ContaminationIndex(references)
+    errors = []
+    flagged = kept = 0
+    out = _open_output(args.output) if args.output else None # The records not found, to train on
+    try:
+        for line_number, line, record in iter_records(args.input, errors if args.skip_invalid else None):
+            found = index.matches(record)
+            if not found:
+                if out is not None:
+                    out.write(line)
+                    out.write(b"\n")
+                    kept += 1
+                continue
+            flagged += 1
+            if args.output != '-':
+                where = ", ".join(f"{'exact' if flag == index.EXACT else 'overlap'} in {os.path.basename(reference.path)}"
+                                  for reference, flag in found)
+                print(f"line {line_number} ({where}): {_preview(record)}")
+    finally:
+        index.close()
+        if out is not None:
+            out.close()
+    _report_errors(errors)
+    print(f"{flagged} records found in {len(references)} reference files"
+          + (f", wrote {kept} others" if out is not None else ""), file=sys.stderr)
+    return 1 if flagged else 0
+
+
+def _similarity(text):
+    value = float(text)
+    if not 0 < value <= 1:
+        raise argparse.ArgumentTypeError("must be between 0 and 1")
+    return value
+
+
+def _byte_size(text):
+    # "512M", "2G" or a number of bytes.
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    text = text.strip().upper().rstrip("B")
+    try:
+        value = float(text[:-1]) * units[text[-1]] if text and text[-1] in units else float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a size such as 512M or 2G") from None
+    if value <= 0:
+        raise argparse.ArgumentTypeError("must be more than 0")
+    return int(value)
+
+
+def _memory_size(text):
+    value = _byte_size(text)
+    if value < 64 * 1024 ** 2:
+        raise argparse.ArgumentTypeError("must be at least 64M")
+    return value
+
+
+def _add_shard_options(p):
+    p.add_argument("--shard-lines", type=int, metavar="N", help="write shards of N records, named like train-00000-of-00012.jsonl")
+    p.add_argument("--shard-size", type=_byte_size, metavar="SIZE", help="write shards of about SIZE uncompressed bytes, e.g. 500M")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="jsonl_editor.py", description="Process JSONL datasets without the editor window.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("dedupe", help="keep the first record of each input")
+    p.add_argument("input")
+    p.add_argument("-o", "--output", default='-', help="output file (default: stdout)")
+    p.add_argument("--key", default=Dataset.KEY_INPUT, help="field compared for duplicates (default: %(default)s)")
+    p.add_argument("--near", type=_similarity, metavar="THRESHOLD", help="also remove near-duplicates, e.g. 0.8 (MinHash estimate of shingle overlap)")
+    p.add_argument("--report", help="write the line numbers of removed records to this file")
+    p.add_argument("--skip-invalid", action="store_true", help="drop invalid lines instead of stopping")
+    p.add_argument("--memory", type=_memory_size, default=DEDUPE_MEMORY_BUDGET, metavar="SIZE",
+                   help="memory to use without --near, e.g. 512M or 4G (default: 1G); the rest goes to the temp directory")
+    p.add_argument("--jobs", type=int, help="processes deduplicating in parallel without --near (default: one per core)")
+    _add_shard_options(p)
+    p.set_defaults(run=cmd_dedupe)
+
+    p = commands.add_parser("validate", help="report every invalid line")
+    p.add_argument("input")
+    p.add_argument("--require-keys", help="comma-separated keys every record must have")
+    p.add_argument("--max-errors", type=int, default=0, help="print at most this many problems (default: all)")
+    p.add_argument("--jobs", type=int, help="processes checking the file in parallel (default: one per core)")
+    p.set_defaults(run=cmd_validate)
+
+    p = commands.add_parser("stats", help="record and field statistics")
+    p.add_argument("input")
+    p.add_argument("--json", action="store_true", help="print the statistics as JSON")
+    p.add_argument("--histogram", action="store_true", help="also print a histogram of each field's lengths")
+    p.add_argument("--memory", type=_memory_size, default=DEDUPE_MEMORY_BUDGET, metavar="SIZE",
+                   help="memory for counting duplicate inputs and instructions, e.g. 512M or 4G (default: 1G); "
+                        "the rest goes to the temp directory")
+    p.add_argument("--jobs", type=int, help="processes counting duplicates in parallel (default: one per core)")
+    p.set_defaults(run=cmd_stats)
+
+    p = commands.add_parser("split", help="split into train/validation/test files")
+    p.add_argument("input")
+    p.add_argument("-o", "--output", default='.', help="output directory (default: current directory)")
+    p.add_argument("--ratios", default="0.8,0.1,0.1", help="comma-separated part sizes (default: %(default)s)")
+    p.add_argument("--names", help="comma-separated part names (default: train,validation,test)")
+    p.add_argument("--seed", type=int, default=0, help="random seed; the same seed gives the same split")
+    p.add_argument("--by-content", action="store_true",
+                   help="place each record by a hash of its content, so it stays in its part in later versions of the file")
+    p.add_argument("--hash-key", metavar="KEY", help="with --by-content, hash only this field (e.g. input)")
+    _add_shard_options(p)
+    p.set_defaults(run=cmd_split)
+
+    p = commands.add_parser("shuffle", help="shuffle the records of a file of any size")
+    p.add_argument("input")
+    p.add_argument("-o", "--output", default='-', help="output file (default: stdout)")
+    p.add_argument("--seed", type=int, default=0, help="random seed; the same seed gives the same order")
+    p.add_argument("--memory", type=_memory_size, default=SHUFFLE_MEMORY_BUDGET, metavar="SIZE",
+                   help="records shuffled in memory at a time, e.g. 512M or 4G (default: 1G); the rest goes to the temp directory")
+    p.add_argument("--skip-invalid", action="store_true", help="drop invalid lines instead of stopping")
+    _add_shard_options(p)
+    p.set_defaults(run=cmd_shuffle)
+
+    p = commands.add_parser("sample", help="pick records uniformly at random, in one pass")
+    p.add_argument("input")
+    p.add_argument("-n", "--count", type=int, required=True, help="number of records to pick")
+    p.add_argument("-o", "--output", default='-', help="output file (default: stdout)")
+    p.add_argument("--seed", type=int, default=0, help="random seed; the same seed gives the same sample")
+    p.add_argument("--skip-invalid", action="store_true", help="drop invalid lines instead of stopping")
+    _add_shard_options(p)
+    p.set_defaults(run=cmd_sample)
+
+    p = commands.add_parser("diff", help="list the records added, removed, modified and moved between two versions")
+    p.add_argument("old")
+    p.add_argument("new")
+    p.add_argument("--key", default=Dataset.KEY_INPUT, help="field that identifies an edited record (default: %(default)s)")
+    p.add_argument("--json", action="store_true", help="print each difference as a JSON line with both versions")
+    p.add_argument("--summary", action="store_true", help="print the counts only")
+    p.add_argument("--skip-invalid", action="store_true", help="skip invalid lines instead of stopping")
+    p.set_defaults(run=cmd_diff)
+
+    p = commands.add_parser("merge", help="three-way merge of two versions edited from the same base")
+    p.add_argument("base")
+    p.add_argument("ours")
+    p.add_argument("theirs")
+    p.add_argument("-o", "--output", default='-', help="output file (default: stdout)")
+    p.add_argument("--key", default=Dataset.KEY_INPUT, help="field that identifies an edited record (default: %(default)s)")
+    p.add_argument("--prefer", choices=("ours", "theirs"), default="ours", help="side kept in a conflict (default: %(default)s)")
+    p.add_argument("--conflicts", help="write each conflict, with all three versions, to this JSONL file")
+    p.add_argument("--skip-invalid", action="store_true", help="skip invalid lines instead of stopping")
+    p.set_defaults(run=cmd_merge)
+
+    p = commands.add_parser("contamination", help="find records whose input or output is in an eval set")
+    p.add_argument("input")
+    p.add_argument("--reference", action="append", required=True, help="reference file (eval set); repeat for several")
+    p.add_argument("-o", "--output", help="also write the records not found in any reference to this file")
+    p.add_argument("--jobs", type=int, help="processes indexing a reference file in parallel (default: one per core)")
+    p.add_argument("--skip-invalid", action="store_true", help="skip invalid lines instead of stopping")
+    p.set_defaults(run=cmd_contamination)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        return args.run(args)
+    except OSError as e:
+        print(f"{args.command}: {e}", file=sys.stderr)
+        return 1
+    except ValueError as e: # RecordDecodeError when invalid lines are not skipped
+        print(f"{args.command}: {e}", file=sys.stderr)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
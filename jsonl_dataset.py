@@ -0,0 +1,4389 @@
+"""Data core of the JSONL editor, without any GUI dependency.
+
+Holds the lazily decoded record store and the indexes kept current on every
+edit (duplicates, undo history, autosave journal), the ``Dataset`` that ties
+them together for the editor, and helpers that process files of any size line
+by line, or in parallel chunks, for the command-line tools in ``jsonl_cli``.
+"""
+import bz2
+import glob
+import gzip
+import io
+import itertools
+import json
+import lzma
+import math
+import os
+import hashlib
+import heapq
+import mmap
+import multiprocessing
+import operator
+import random
+import re
+import shutil
+import sys
+import tempfile
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict, deque # Statistics, decode cache, undo history
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+_JSON_WHITESPACE = b" \t\r\n\x0b\x0c"
+
+
+class FileChangedError(OSError):
+    """A dataset file changed on disk since it was read, so writing it would lose data."""
+
+
+class RecordDecodeError(ValueError):
+    """A line of the backing file is not valid JSON.
+
+    ``path`` names the shard the line is in when a dataset has several files.
+    """
+
+    def __init__(self, line_number, line_text, error, path=None):
+        where = f"line {line_number} of {os.path.basename(path)}" if path else f"line {line_number}"
+        super().__init__(f"Error parsing JSON on {where}: {error}")
+        self.line_number = line_number
+        self.line_text = line_text
+        self.error = error
+        self.path = path
+
+    def __reduce__(self): # Sent back from map_chunks() worker processes
+        return type(self), (self.line_number, self.line_text, self.error, self.path)
+
+
+def decode_line(line, line_number, path=None):
+    try:
+        return json.loads(line)
+    except ValueError as e: # JSONDecodeError and invalid UTF-8
+        text = line.decode('utf-8', errors='replace').strip()
+        raise RecordDecodeError(line_number, text, e, path) from None
+
+
+# --- Dataset files: plain or compressed, one file or a set of shards ---
+COMPRESSIONS = {".gz": gzip, ".bz2": bz2, ".xz": lzma} # File suffix -> module reading and writing it
+SHARD_SUFFIXES = (".jsonl", ".ndjson") # Files of a dataset directory, before any compression suffix
+SIDECAR_SUFFIXES = (".journal", ".journal.stale", ".index", ".index.tmp", ".refindex", ".refindex.tmp") # EditJournal, ScanCache and ReferenceIndex files
+IO_BUFFER_SIZE = 1024 * 1024
+
+
+def compression_of(path):
+    return COMPRESSIONS.get(os.path.splitext(path)[1].lower())
+
+
+def open_data_file(path, mode='rb', name=None):
+    # Opens a plain or compressed (.gz, .bz2, .xz) file in binary mode; compressed data is
+    # decompressed or compressed as it streams. `path` may also be an open binary file;
+    # `name` then picks the compression if the file's own name does not.
+    codec = compression_of(name or (path if isinstance(path, str) else getattr(path, 'name', '')))
+    if codec is None:
+        return open(path, mode, buffering=IO_BUFFER_SIZE) if isinstance(path, str) else path
+    if codec is gzip:
+        compressed = gzip.GzipFile(filename='', mode=mode, fileobj=path, compresslevel=6) if not isinstance(path, str) \
+            else gzip.open(path, mode, compresslevel=6)
+    else:
+        compressed = codec.open(path, mode)
+    if 'w' in mode: # Every write would otherwise go through the compressor on its own
+        return io.BufferedWriter(compressed, IO_BUFFER_SIZE)
+    return io.BufferedReader(compressed, IO_BUFFER_SIZE) # Lines are read from large decompressed blocks
+
+
+def dataset_files(location):
+    # The files of a dataset: the file itself, or the shards in a directory or matching a
+    # glob pattern, in name order (train-00000-of-00128.jsonl.gz first).
+    if os.path.isdir(location):
+        paths = [os.path.join(location, name) for name in sorted(os.listdir(location))
+                 if not name.startswith('.') and _strip_compression(name).lower().endswith(SHARD_SUFFIXES)]
+    elif glob.has_magic(location):
+        paths = sorted(path for path in glob.glob(location) if os.path.isfile(path) and not path.endswith(SIDECAR_SUFFIXES))
+    else:
+        return [location]
+    if not paths:
+        raise FileNotFoundError(f"No JSONL files found in {location}")
+    return paths
+
+
+def _strip_compression(name):
+    stem, suffix = os.path.splitext(name)
+    return stem if suffix.lower() in COMPRESSIONS else name
+
+
+def is_sharded(location):
+    return os.path.isdir(location) or glob.has_magic(location)
+
+
+def _dataset_stat(location):
+    # (size, mtime_ns) of a dataset; for shards the total size and the latest change.
+    stats = [os.stat(path) for path in dataset_files(location)]
+    return sum(st.st_size for st in stats), max(st.st_mtime_ns for st in stats)
+
+
+def _spool(path, on_progress=None, cancelled=None):
+    # Decompresses a file into a new temporary file, streaming, and returns its path.
+    # on_progress(fraction) follows the compressed bytes read.
+    size = os.path.getsize(path) or 1
+    fd, spool_path = tempfile.mkstemp(prefix="jsonl-", suffix=".spool")
+    try:
+        with open(path, 'rb') as raw, open_data_file(raw) as data, os.fdopen(fd, 'wb') as out:
+            while True:
+                block = data.read(IO_BUFFER_SIZE)
+                if not block:
+                    break
+                out.write(block)
+                if cancelled is not None and cancelled():
+                    raise _Cancelled()
+                if on_progress is not None:
+                    on_progress(raw.tell() / size)
+    except BaseException:
+        os.remove(spool_path)
+        raise
+    return spool_path
+
+
+class _Shard:
+    """One file of a dataset and the mapping its records are read from.
+
+    Compressed files cannot be mapped; they are decompressed once into a
+    temporary spool file, which is mapped instead and removed on close.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.compressed = compression_of(path) is not None
+        st = os.stat(path)
+        self.disk_size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        self.spool_path = None
+        self.file = None
+        self.mm = None
+
+    @property
+    def data_path(self):
+        return self.spool_path or self.path
+
+    @property
+    def mapped(self):
+        return self.file is not None
+
+    @property
+    def size(self):
+        return len(self.mm) if self.mm is not None else 0
+
+    def map(self, on_progress=None, cancelled=None):
+        if self.compressed and self.spool_path is None:
+            self.spool_path = _spool(self.path, on_progress, cancelled)
+        self.file = open(self.data_path, 'rb')
+        if os.fstat(self.file.fileno()).st_size > 0: # mmap rejects empty files
+            self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def remap(self):
+        # Maps a plain file again at its current size, after it grew.
+        self.unmap()
+        st = os.stat(self.path)
+        self.disk_size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        self.map()
+
+    def changed_on_disk(self):
+        st = os.stat(self.path)
+        return (st.st_size, st.st_mtime_ns) != (self.disk_size, self.mtime_ns)
+
+    def unmap(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def replace(self, tmp_path, spool_path=None):
+        # Moves a rewritten file over this shard and maps it; spool_path holds its data
+        # when it is compressed.
+        old_spool = self.spool_path
+        self.unmap()
+        try:
+            os.replace(tmp_path, self.path)
+        except OSError:
+            self.map()
+            raise
+        self.spool_path = spool_path
+        st = os.stat(self.path)
+        self.disk_size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        if old_spool:
+            _remove_quietly(old_spool)
+        self.map()
+
+    def close(self):
+        self.unmap()
+        if self.spool_path:
+            _remove_quietly(self.spool_path)
+            self.spool_path = None
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _scan_lines(mm, pos, end, batch_lines=50000):
+    # Yields (starts, ends, line_numbers, position, lines) batches for the non-blank lines
+    # in bytes [pos, end) of a mapping. Line numbers count from 1 at `pos`; `lines` is the
+    # number of lines scanned so far, blank ones included. The last batch, possibly
+    # empty, ends at `end`.
+    find = mm.find
+    line_no = 0
+    starts, ends, line_numbers = array('q'), array('q'), array('q')
+    while pos < end:
+        line_no += 1
+        stop = find(b"\n", pos, end)
+        if stop == -1:
+            stop = end
+        if stop > pos and (mm[pos] not in _JSON_WHITESPACE or mm[pos:stop].strip()):
+            starts.append(pos)
+            ends.append(stop)
+            line_numbers.append(line_no)
+            if len(starts) >= batch_lines:
+                yield starts, ends, line_numbers, stop, line_no
+                starts, ends, line_numbers = array('q'), array('q'), array('q')
+        pos = stop + 1
+    yield starts, ends, line_numbers, end, line_no
+
+
+def _map_file(path):
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class _LineSource:
+    """Byte ranges of records in the memory-mapped files of a dataset, by record id.
+
+    A dataset is one file or a list of shards (see dataset_files). Every record
+    id remembers its shard, records added later included, and a shard is marked
+    dirty when one of its records changes, so a save rewrites only those.
+    """
+
+    def __init__(self):
+        self.path = None # Dataset location: a file, a directory or a glob pattern of shards
+        self.shards = []
+        self.starts = array('q') # Per record id; -1 when the id is not file-backed
+        self.ends = array('q')
+        self.line_numbers = array('q')
+        self.shard_of = array('i') # Per record id, file-backed or not
+        self.next_id = 0
+        self.dirty = set() # Shards with changes that are not written yet
+
+    def open(self, path):
+        self._map(path)
+        for shard, starts, ends, line_numbers, _ in self.iter_scan():
+            self.extend(starts, ends, line_numbers, shard)
+
+    def _map(self, path):
+        # Plain files are mapped at once; compressed ones when iter_scan() reaches them.
+        self.path = path
+        self.shards = [_Shard(shard_path) for shard_path in dataset_files(path)]
+        for shard in self.shards:
+            if not shard.compressed:
+                shard.map()
+
+    @property
+    def size(self):
+        # Bytes of the dataset files on disk, compressed ones at their compressed size.
+        return sum(shard.disk_size for shard in self.shards)
+
+    def progress(self, shard_index, fraction):
+        # (done, total) on the scale of size, `fraction` of the way through a shard.
+        done = sum(shard.disk_size for shard in self.shards[:shard_index])
+        return done + int(self.shards[shard_index].disk_size * fraction), self.size
+
+    def map_shard(self, shard_index, task=None):
+        # Maps a shard, first decompressing it if needed; from a worker thread, reports
+        # progress as ("progress", done, total) messages and stops when the task is cancelled.
+        shard = self.shards[shard_index]
+        if shard.mapped:
+            return shard
+        if task is None:
+            shard.map()
+        else:
+            shard.map(lambda fraction: task.post("progress", *self.progress(shard_index, fraction / 2)), task.cancelled)
+        return shard
+
+    def iter_scan(self, batch_lines=50000, task=None, resume=None):
+        # One pass over the mappings recording where each non-blank line starts and ends.
+        # Only reads the mappings, so it can run on a worker thread; yields batches with
+        # their shard index and the byte position reached in the shard. `resume` is a
+        # (shard, position, lines before it) to start from, as returned by ScanCache.replay().
+        first, start, lines_before = resume or (0, 0, 0)
+        for index in range(first, len(self.shards)):
+            mm = self.map_shard(index, task).mm
+            if mm is None:
+                continue
+            pos = start if index == first and start else (3 if mm[:3] == b"\xef\xbb\xbf" else 0)
+            offset = lines_before if index == first else 0
+            for starts, ends, line_numbers, position, _ in _scan_lines(mm, pos, len(mm), batch_lines):
+                if starts:
+                    if offset:
+                        line_numbers = array('q', map(offset.__add__, line_numbers))
+                    yield index, starts, ends, line_numbers, position
+
+    def scan_fraction(self, shard_index, position):
+        # How far a scan at `position` of a shard is through it; decompression was the first half.
+        shard = self.shards[shard_index]
+        fraction = position / shard.size if shard.size else 1.0
+        return 0.5 + fraction / 2 if shard.compressed else fraction
+
+    def extend(self, starts, ends, line_numbers, shard=0):
+        # Appends scanned lines as new record ids; returns the first of them.
+        first_id = self.next_id
+        missing = first_id - len(self.starts) # Ids of records added since the scan
+        if missing > 0:
+            for values in (self.starts, self.ends, self.line_numbers):
+                values.extend(array('q', (-1,)) * missing)
+        self.starts.extend(starts)
+        self.ends.extend(ends)
+        self.line_numbers.extend(line_numbers)
+        self.shard_of.extend(array('i', (shard,)) * len(starts))
+        self.next_id += len(starts)
+        return first_id
+
+    def new_id(self, shard):
+        record_id = self.next_id
+        self.next_id += 1
+        self.shard_of.append(shard)
+        return record_id
+
+    def is_file_backed(self, record_id):
+        return record_id < len(self.starts) and self.starts[record_id] >= 0
+
+    def raw(self, record_id):
+        return self.shards[self.shard_of[record_id]].mm[self.starts[record_id]:self.ends[record_id]]
+
+    def decode(self, record_id):
+        path = self.shards[self.shard_of[record_id]].path if len(self.shards) > 1 else None
+        return decode_line(self.raw(record_id), self.line_numbers[record_id], path)
+
+    def rebase(self, path, written, starts, ends, line_numbers):
+        # Record ids survive the save; only their byte ranges move to the rewritten files.
+        # `written` holds (shard index, temporary file, spool or None, record ids) per file.
+        if path == self.path and self.shards:
+            whole = len(written) == len(self.shards) == 1
+            for index, tmp_path, spool_path, record_ids in written:
+                self.shards[index].replace(tmp_path, spool_path)
+                if not whole: # Only this shard's ids; a later shard may still fail to move
+                    self._copy_ranges(record_ids, starts, ends, line_numbers)
+                self.dirty.discard(index)
+            if whole:
+                self.starts, self.ends, self.line_numbers = starts, ends, line_numbers
+            return
+        # Saved as a new single file, which becomes the dataset
+        (_, tmp_path, spool_path, _), = written
+        for shard in self.shards:
+            shard.unmap()
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            for shard in self.shards:
+                shard.map()
+            raise
+        for shard in self.shards:
+            shard.close()
+        shard = _Shard(path)
+        shard.spool_path = spool_path
+        shard.map()
+        self.path = path
+        self.shards = [shard]
+        self.shard_of = array('i', bytes(4 * self.next_id))
+        self.dirty.clear()
+        self.starts, self.ends, self.line_numbers = starts, ends, line_numbers
+
+    def _copy_ranges(self, record_ids, starts, ends, line_numbers):
+        missing = self.next_id - len(self.starts)
+        if missing > 0:
+            for values in (self.starts, self.ends, self.line_numbers):
+                values.extend(array('q', (-1,)) * missing)
+        for record_id in record_ids:
+            self.starts[record_id] = starts[record_id]
+            self.ends[record_id] = ends[record_id]
+            self.line_numbers[record_id] = line_numbers[record_id]
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+
+class ColumnarRecords:
+    """Records stored column by column instead of as one dict each.
+
+    Used for the records a store holds in memory (edited and added ones). The
+    instruction, input and output strings go into one UTF-8 buffer per column,
+    located by offset and length arrays, and repeated instructions (a dataset
+    usually reuses a handful of task prompts) share their bytes, which become
+    garbage with the last record using them. Other keys, values that are not
+    strings and unusual key orders are kept in side dicts, so every record
+    reads back equal to what was stored, in the same key order. Replaced
+    values leave garbage in the buffers until there is more of it than live
+    data, and then the buffers are compacted.
+
+    Maps keys (record ids) to records like a dict. A read builds a new dict.
+    """
+    COLUMNS = ("instruction", "input", "output")
+    INTERNED = ("instruction",)
+    INTERN_LIMIT = 4096 # Distinct values shared per interned column
+    COMPACT_MIN_BYTES = 1024 * 1024
+
+    def __init__(self, columns=COLUMNS, interned=INTERNED):
+        self.columns = tuple(columns)
+        self._interned_columns = frozenset(interned)
+        self._column_index = {column: i for i, column in enumerate(self.columns)}
+        self.clear()
+
+    def clear(self):
+        self._slots = {} # key -> slot
+        self._free = []
+        self._buffers = [bytearray() for _ in self.columns]
+        self._offsets = [array('q') for _ in self.columns] # Per slot
+        self._lengths = [array('q') for _ in self.columns] # Per slot; -1 when the record has no string there
+        self._interned = [{} if column in self._interned_columns else None for column in self.columns] # value -> (offset, length)
+        self._refs = [{} if column in self._interned_columns else None for column in self.columns] # interned (offset, length) -> slots
+        self._extras = {} # slot -> {key: value} for keys outside the columns and non-string values
+        self._orders = {} # slot -> key order, when it is not the columns first and the extras after
+        self._values = {} # slot -> the whole value, when it is not a dict
+        self._garbage = 0 # Buffer bytes no longer referenced
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, key):
+        return key in self._slots
+
+    def keys(self):
+        return self._slots.keys()
+
+    def get(self, key, default=None):
+        slot = self._slots.get(key)
+        return default if slot is None else self._record(slot)
+
+    def __getitem__(self, key):
+        return self._record(self._slots[key])
+
+    def __setitem__(self, key, record):
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = self._free.pop() if self._free else self._new_slot()
+        else:
+            self._release(slot)
+        self._store(slot, record)
+        self._compact_if_wasteful()
+
+    def discard(self, key):
+        slot = self._slots.pop(key, None)
+        if slot is not None:
+            self._release(slot)
+            self._free.append(slot)
+            self._compact_if_wasteful()
+
+    @property
+    def nbytes(self):
+        # Approximate memory of the columns, not counting the side dicts.
+        return (sum(len(buffer) for buffer in self._buffers)
+                + sum(len(values) * values.itemsize for values in self._offsets + self._lengths))
+
+    def _new_slot(self):
+        slot = len(self._offsets[0])
+        for offsets, lengths in zip(self._offsets, self._lengths):
+            offsets.append(0)
+            lengths.append(-1)
+        return slot
+
+    def _store(self, slot, record):
+        if not isinstance(record, dict): # A JSON line may hold any value
+            self._values[slot] = record
+            return
+        extras = None
+        column_index = self._column_index
+        for key, value in record.items():
+            i = column_index.get(key)
+            if i is not None and isinstance(value, str):
+                self._offsets[i][slot], self._lengths[i][slot] = self._append(i, value)
+            else:
+                if extras is None:
+                    extras = {}
+                extras[key] = value
+        if extras:
+            self._extras[slot] = extras
+        if not self._in_column_order(record):
+            self._orders[slot] = tuple(record)
+
+    def _in_column_order(self, record):
+        # Whether columns first, in column order, then the extras rebuilds the key order.
+        next_column = 0
+        in_extras = False
+        for key, value in record.items():
+            i = self._column_index.get(key)
+            if i is not None and isinstance(value, str):
+                if in_extras or i < next_column:
+                    return False
+                next_column = i + 1
+            else:
+                in_extras = True
+        return True
+
+    def _append(self, i, value):
+        interned = self._interned[i]
+        if interned is not None:
+            location = interned.get(value)
+            if location is not None:
+                self._refs[i][location] += 1
+                return location
+        data = value.encode('utf-8', 'surrogatepass') # json.loads accepts lone surrogates
+        buffer = self._buffers[i]
+        location = (len(buffer), len(data))
+        buffer += data
+        if interned is not None and len(interned) < self.INTERN_LIMIT:
+            interned[value] = location
+            self._refs[i][location] = 1
+        return location
+
+    def _release(self, slot):
+        for i, lengths in enumerate(self._lengths):
+            length = lengths[slot]
+            if length < 0:
+                continue
+            refs = self._refs[i]
+            location = (self._offsets[i][slot], length)
+            if refs is not None and location in refs: # Interned bytes are shared; freed with their last slot
+                refs[location] -= 1
+                if refs[location]:
+                    length = 0
+                else:
+                    del refs[location]
+                    offset = location[0]
+                    del self._interned[i][self._buffers[i][offset:offset + length].decode('utf-8', 'surrogatepass')]
+            self._garbage += length
+            lengths[slot] = -1
+        self._extras.pop(slot, None)
+        self._orders.pop(slot, None)
+        self._values.pop(slot, None)
+
+    def _record(self, slot):
+        if slot in self._values:
+            return self._values[slot]
+        record = {}
+        for column, buffer, offsets, lengths in zip(self.columns, self._buffers, self._offsets, self._lengths):
+            length = lengths[slot]
+            if length >= 0:
+                offset = offsets[slot]
+                record[column] = buffer[offset:offset + length].decode('utf-8', 'surrogatepass')
+        extras = self._extras.get(slot)
+        if extras:
+            record.update(extras)
+        order = self._orders.get(slot)
+        if order is not None:
+            record = {key: record[key] for key in order}
+        return record
+
+    def _compact_if_wasteful(self):
+        if self._garbage > self.COMPACT_MIN_BYTES and self._garbage * 2 > sum(len(buffer) for buffer in self._buffers):
+            self.compact()
+
+    def compact(self):
+        # Copies the live values into new buffers; values that shared bytes still do.
+        for i, old in enumerate(self._buffers):
+            new = bytearray()
+            offsets, lengths = self._offsets[i], self._lengths[i]
+            moved = {} # (old offset, length) -> new offset
+            for slot in self._slots.values():
+                length = lengths[slot]
+                if length < 0:
+                    continue
+                location = (offsets[slot], length)
+                offset = moved.get(location)
+                if offset is None:
+                    offset = moved[location] = len(new)
+                    new += old[location[0]:location[0] + length]
+                offsets[slot] = offset
+            self._buffers[i] = new
+            if self._interned[i] is not None:
+                self._interned[i] = {value: (moved[location], location[1])
+                                     for value, location in self._interned[i].items() if location in moved}
+                self._refs[i] = {(moved[location], location[1]): count
+                                 for location, count in self._refs[i].items() if location in moved}
+        self._garbage = 0
+
+
+class LineIndexedStore:
+    """List-like JSONL dataset decoded lazily from a line-offset index.
+
+    Opening a file only records where each line starts; a record is parsed when
+    it is read. Edited and added records live in an overlay keyed by record id
+    (ColumnarRecords), so the backing file is only touched by save(). Returned
+    records are shared
+    with the store's cache: copy them before modifying and assign the copy back.
+    The backing file may be compressed or a set of shards (see dataset_files);
+    an added record joins the shard of the record before it.
+
+    Listeners are called as ``listener(kind, index, record_id, old, new)`` after
+    every change, with kind one of "insert", "delete" or "replace".
+    """
+    CACHE_SIZE = 256
+
+    def __init__(self, source=None):
+        self._source = source if source is not None else _LineSource()
+        self._order = array('q') # Record ids in dataset order
+        self._overlay = ColumnarRecords() # record id -> record, for edited and added records
+        self._cache = OrderedDict() # record id -> decoded record, most recent last
+        self._listeners = []
+        self.version = 0 # Bumped on every change; tells callers when cached positions are stale
+
+    @classmethod
+    def open(cls, path):
+        source = _LineSource()
+        source.open(path)
+        store = cls(source)
+        store._order = array('q', range(source.next_id))
+        return store
+
+    @classmethod
+    def map(cls, path):
+        # Maps the file without indexing it; lines are added with extend_scanned(), which
+        # lets a worker thread scan scan_batches() while the first rows are already shown.
+        source = _LineSource()
+        source._map(path)
+        return cls(source)
+
+    def scan_batches(self, batch_lines=50000, task=None, resume=None):
+        # Yields (shard, starts, ends, line_numbers, position) batches for extend_scanned().
+        return self._source.iter_scan(batch_lines, task, resume)
+
+    def extend_scanned(self, starts, ends, line_numbers, shard=0):
+        first_id = self._source.extend(starts, ends, line_numbers, shard)
+        self._order.extend(range(first_id, self._source.next_id))
+        return first_id
+
+    @property
+    def file_size(self):
+        return self._source.size
+
+    @property
+    def shard_paths(self):
+        return [shard.path for shard in self._source.shards]
+
+    def mark_changed(self, shard_paths):
+        # Makes the next save rewrite these shards even without edits; None stands for the
+        # only file of an unsharded dataset.
+        shard_paths = set(shard_paths)
+        for index, shard in enumerate(self._source.shards):
+            if shard.path in shard_paths or None in shard_paths:
+                self._source.dirty.add(index)
+
+    @property
+    def path(self):
+        return self._source.path
+
+    def __len__(self):
+        return len(self._order)
+
+    def __iter__(self):
+        for record_id in self._order:
+            yield self._read(record_id)
+
+    def items(self):
+        for record_id in self._order:
+            yield record_id, self._read(record_id)
+
+    def __getitem__(self, index):
+        return self._read(self._order[index])
+
+    def __setitem__(self, index, record):
+        record_id = self._order[index]
+        old = self._read(record_id) if self._listeners else None
+        self._overlay[record_id] = record
+        self._remember(record_id, record)
+        self._source.dirty.add(self._source.shard_of[record_id])
+        self._notify("replace", index, record_id, old, record)
+
+    def __delitem__(self, index):
+        index = range(len(self._order))[index] # Normalise negative indexes for listeners
+        record_id = self._order[index]
+        old = self._read(record_id) if self._listeners else None
+        del self._order[index]
+        self._overlay.discard(record_id)
+        self._cache.pop(record_id, None)
+        self._source.dirty.add(self._source.shard_of[record_id])
+        self._notify("delete", index, record_id, old, None)
+
+    def insert(self, index, record):
+        index = max(0, min(index, len(self._order))) if index >= 0 else max(0, len(self._order) + index)
+        source = self._source
+        neighbor = index - 1 if index > 0 else 0
+        shard = source.shard_of[self._order[neighbor]] if neighbor < len(self._order) else 0
+        record_id = source.new_id(shard)
+        source.dirty.add(shard)
+        self._overlay[record_id] = record
+        self._remember(record_id, record)
+        self._order.insert(index, record_id)
+        self._notify("insert", index, record_id, None, record)
+
+    def append(self, record):
+        self.insert(len(self._order), record)
+
+    def delete_many(self, indexes):
+        # Deletes the records at the given positions with one pass over the order. Listeners
+        # get a "delete" per record, last position first, so each index is valid at its event.
+        order = self._order
+        indexes = sorted({range(len(order))[index] for index in indexes})
+        if not indexes:
+            return
+        records = [(index, order[index]) for index in reversed(indexes)]
+        olds = [self._read(record_id) if self._listeners else None for index, record_id in records]
+        kept = array('q')
+        start = 0
+        for index in indexes:
+            kept.extend(order[start:index])
+            start = index + 1
+        kept.extend(order[start:])
+        self._order = kept
+        for (index, record_id), old in zip(records, olds):
+            self._overlay.discard(record_id)
+            self._cache.pop(record_id, None)
+            self._source.dirty.add(self._source.shard_of[record_id])
+            self._notify("delete", index, record_id, old, None)
+
+    def insert_many(self, items):
+        # Inserts (index, record) pairs with one pass over the order, each index being the
+        # position its record ends up at. Listeners get an "insert" per record, first
+        # position first, so each index is valid at its event.
+        order, source = self._order, self._source
+        result = array('q')
+        inserted = []
+        start = 0
+        for index, record in sorted(items, key=lambda item: item[0]):
+            take = max(0, min(index - len(result), len(order) - start))
+            result.extend(order[start:start + take])
+            start += take
+            neighbor = result[-1] if result else (order[start] if start < len(order) else None)
+            shard = source.shard_of[neighbor] if neighbor is not None else 0 # As insert() picks it
+            record_id = source.new_id(shard)
+            source.dirty.add(shard)
+            self._overlay[record_id] = record
+            self._remember(record_id, record)
+            inserted.append((len(result), record_id, record))
+            result.append(record_id)
+        result.extend(order[start:])
+        self._order = result
+        for index, record_id, record in inserted:
+            self._notify("insert", index, record_id, None, record)
+
+    def record_id(self, index):
+        return self._order[index]
+
+    def record_ids(self):
+        return iter(self._order)
+
+    def index_of(self, record_id):
+        return self._order.index(record_id) # Linear, but a C-level scan
+
+    def positions(self, record_ids):
+        # Sorted dataset positions of the given record ids.
+        if len(record_ids) <= 16:
+            return sorted(self._order.index(record_id) for record_id in record_ids)
+        wanted = set(record_ids)
+        return [i for i, record_id in enumerate(self._order) if record_id in wanted]
+
+    def peek(self, record_id):
+        # Reads a record without the cache, so a worker thread can read while the Tk thread
+        # draws rows. Safe as long as the store is not modified meanwhile.
+        if record_id in self._overlay:
+            return self._overlay[record_id]
+        return self._source.decode(record_id)
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def _notify(self, kind, index, record_id, old, new):
+        self.version += 1
+        for listener in self._listeners:
+            listener(kind, index, record_id, old, new)
+
+    def _read(self, record_id):
+        record = self._cache.get(record_id)
+        if record is not None:
+            self._cache.move_to_end(record_id)
+            return record
+        if record_id in self._overlay:
+            record = self._overlay[record_id]
+        else:
+            record = self._source.decode(record_id)
+        self._remember(record_id, record)
+        return record
+
+    def _remember(self, record_id, record):
+        self._cache[record_id] = record
+        self._cache.move_to_end(record_id)
+        if len(self._cache) > self.CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    def save(self, path):
+        self.commit_save(self.write_snapshot(path))
+
+    def write_snapshot(self, path, task=None):
+        # First half of a save: writes synced temporary files next to the targets. Saving to
+        # the store's own location rewrites only the shards with changes; any other path
+        # gets one file with every record, compressed if its name ends in .gz, .bz2 or .xz.
+        # Safe on a worker thread as long as the store is not modified meanwhile. Returns
+        # None when the task is cancelled.
+        source = self._source
+        missing = array('q', (-1,)) * (source.next_id - len(source.starts))
+        starts = source.starts + missing # New byte ranges, by record id
+        ends = source.ends + missing
+        line_numbers = source.line_numbers + missing
+        if path == source.path and source.shards:
+            self._check_unchanged(source.dirty)
+            targets = {index: [] for index in source.dirty} # shard -> its record ids, in order
+            if len(source.shards) == 1:
+                targets = {0: self._order} if targets else {}
+            elif targets:
+                shard_of = source.shard_of
+                for record_id in self._order:
+                    record_ids = targets.get(shard_of[record_id])
+                    if record_ids is not None:
+                        record_ids.append(record_id)
+            target_paths = [shard.path for shard in source.shards]
+        else:
+            targets = {0: self._order}
+            target_paths = [path]
+        written = []
+        total = sum(len(record_ids) for record_ids in targets.values())
+        try:
+            done = 0
+            for index, record_ids in sorted(targets.items()):
+                tmp_path, spool_path = self._write_file(target_paths[index], record_ids, starts, ends, line_numbers,
+                                                        task, done, total)
+                written.append((index, tmp_path, spool_path, record_ids))
+                done += len(record_ids)
+        except BaseException as e:
+            for _, tmp_path, spool_path, _ in written:
+                _remove_quietly(tmp_path)
+                if spool_path:
+                    _remove_quietly(spool_path)
+            if isinstance(e, _Cancelled):
+                return None
+            raise
+        return path, written, starts, ends, line_numbers
+
+    def _write_file(self, path, record_ids, starts, ends, line_numbers, task, done, total):
+        # Writes the records to path + ".tmp" and records their new byte ranges. A compressed
+        # file is written uncompressed to a new spool first, which then becomes its mapping.
+        source = self._source
+        tmp_path = path + ".tmp"
+        compressed = compression_of(path) is not None
+        if compressed:
+            fd, data_path = tempfile.mkstemp(prefix="jsonl-", suffix=".spool")
+            os.close(fd)
+        else:
+            data_path = tmp_path
+        try:
+            with open(data_path, 'wb', buffering=IO_BUFFER_SIZE) as f:
+                offset = 0
+                for line_index, record_id in enumerate(record_ids):
+                    if record_id in self._overlay:
+                        line = json.dumps(self._overlay[record_id]).encode('utf-8')
+                    else:
+                        line = source.raw(record_id).strip() # Unchanged lines are copied verbatim
+                    f.write(line)
+                    f.write(b"\n")
+                    starts[record_id] = offset
+                    offset += len(line)
+                    ends[record_id] = offset
+                    offset += 1
+                    line_numbers[record_id] = line_index + 1
+                    if task is not None and line_index % 10000 == 0:
+                        if task.cancelled():
+                            raise _Cancelled()
+                        task.post("progress", done + line_index, total)
+                if not compressed:
+                    f.flush()
+                    os.fsync(f.fileno())
+            if compressed:
+                with open(data_path, 'rb') as data, open(tmp_path, 'wb') as raw:
+                    with open_data_file(raw, 'wb', name=path) as out:
+                        while True:
+                            block = data.read(IO_BUFFER_SIZE)
+                            if not block:
+                                break
+                            out.write(block)
+                            if task is not None and task.cancelled():
+                                raise _Cancelled()
+                    raw.flush()
+                    os.fsync(raw.fileno())
+        except BaseException:
+            _remove_quietly(tmp_path)
+            if compressed:
+                _remove_quietly(data_path)
+            raise
+        return tmp_path, data_path if compressed else None
+
+    def _check_unchanged(self, shard_indexes):
+        # Lines appended by another program since the files were read would be lost.
+        for index in shard_indexes:
+            shard = self._source.shards[index]
+            if shard.changed_on_disk():
+                raise FileChangedError(f"{os.path.basename(shard.path)} changed on disk after it was opened")
+
+    def commit_save(self, snapshot):
+        # Second half: renames the temporary files over the targets, so a crash leaves
+        # either the old or the new version of each file. Truncating a mapped file in place
+        # would also pull the data out from under the mapping.
+        path, written = snapshot[:2]
+        if path == self._source.path:
+            try:
+                self._check_unchanged(index for index, _, _, _ in written)
+            except FileChangedError:
+                for _, tmp_path, spool_path, _ in written:
+                    _remove_quietly(tmp_path)
+                    if spool_path:
+                        _remove_quietly(spool_path)
+                raise
+        self._source.rebase(*snapshot)
+        ScanCache.discard(path) # Its offsets and hashes describe the old files
+        synced = set()
+        for _, tmp_path, _, _ in written:
+            directory = os.path.dirname(os.path.abspath(tmp_path))
+            if directory not in synced:
+                synced.add(directory)
+                _fsync_directory(tmp_path)
+        self._overlay.clear()
+        self._cache.clear()
+
+    def close(self):
+        self._source.close()
+
+
+class _Cancelled(Exception):
+    pass
+
+
+def _sidecar_path(data_path, suffix):
+    # Next to the file, or next to the directory of a sharded dataset. Wildcards of a glob
+    # pattern are not allowed in Windows file names.
+    return re.sub(r"[*?\[\]]", "_", data_path.rstrip("/\\")) + suffix
+
+
+def _fsync_directory(path):
+    # Makes a rename durable on POSIX; directories cannot be opened this way on Windows.
+    if os.name != 'posix':
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class EditJournal:
+    """Append-only sidecar log of the edits made since the file was last written.
+
+    Autosave appends the pending operations (one JSON object per line) to
+    ``<file>.journal`` and fsyncs it, which costs O(edit) instead of a rewrite.
+    The header records the size and mtime of the file the operations apply
+    to, so after a crash they can be replayed onto exactly that file. Writing
+    the file itself ("compaction") empties the journal. A sharded dataset has
+    one journal, next to its directory, covering the total size and latest
+    mtime of the shards.
+    """
+    SUFFIX = ".journal"
+
+    def __init__(self):
+        self.store = None
+        self.path = None
+        self.data_path = None
+        self._pending = []
+        self._replaying = False
+
+    def attach(self, store, data_path):
+        if self.store is not None:
+            self.store.remove_listener(self._on_change)
+        self.store = store
+        self.data_path = data_path
+        self.path = self.journal_path(data_path) if data_path else None
+        self._pending = []
+        store.add_listener(self._on_change)
+
+    @classmethod
+    def journal_path(cls, data_path):
+        return _sidecar_path(data_path, cls.SUFFIX)
+
+    def exists(self):
+        return bool(self.path) and os.path.exists(self.path)
+
+    def has_pending(self):
+        return bool(self._pending)
+
+    def _on_change(self, kind, index, record_id, old, new):
+        if self._replaying or not self.path:
+            return
+        op = {"op": kind, "index": index}
+        if new is not None:
+            op["record"] = new
+        self._pending.append(op)
+
+    def flush(self):
+        if not self._pending or not self.path:
+            return
+        is_new = not os.path.exists(self.path)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            if is_new:
+                size, mtime_ns = _dataset_stat(self.data_path)
+                f.write(json.dumps({"journal": 1, "size": size, "mtime_ns": mtime_ns}) + '\n')
+            for op in self._pending:
+                f.write(json.dumps(op) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._pending = []
+
+    def reset(self, data_path):
+        # Called once the file has been written: the journal is no longer needed.
+        self._pending = []
+        if self.exists():
+            os.remove(self.path)
+        self.data_path = data_path
+        self.path = self.journal_path(data_path) if data_path else None
+
+    def discard_pending(self):
+        self._pending = []
+
+    def restamp(self):
+        # The file was appended to by another program (see TailFollower). The journaled
+        # operations still apply to it, the new lines coming after the records they index,
+        # so the header is brought up to date rather than the journal being set aside.
+        if not self.exists():
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            f.readline()
+            ops = f.read()
+        size, mtime_ns = _dataset_stat(self.data_path)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({"journal": 1, "size": size, "mtime_ns": mtime_ns}) + '\n')
+            f.write(ops)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    @classmethod
+    def read_ops(cls, data_path):
+        # Returns the journaled operations for data_path, or None when there is no journal
+        # or it was written against a different version of the file.
+        path = cls.journal_path(data_path)
+        if not os.path.exists(path):
+            return None
+        ops = []
+        with open(path, 'r', encoding='utf-8') as f:
+            try:
+                header = json.loads(f.readline())
+            except ValueError:
+                return None
+            size, mtime_ns = _dataset_stat(data_path)
+            if header.get("size") != size or header.get("mtime_ns") != mtime_ns:
+                return None
+            for line in f:
+                try:
+                    ops.append(json.loads(line))
+                except ValueError: # Torn final write from a crash
+                    break
+        return ops
+
+    @classmethod
+    def set_aside(cls, data_path):
+        # Keeps a journal that no longer matches its file without replaying it.
+        path = cls.journal_path(data_path)
+        if os.path.exists(path):
+            os.replace(path, path + ".stale")
+
+    def replay(self, ops):
+        # Applies recovered operations to the attached store without journaling them again.
+        applied = 0
+        self._replaying = True
+        try:
+            for op in ops:
+                kind, index = op.get("op"), op.get("index")
+                if not isinstance(index, int) or not 0 <= index <= len(self.store):
+                    break
+                if kind == "insert":
+                    self.store.insert(index, op["record"])
+                elif kind == "delete" and index < len(self.store):
+                    del self.store[index]
+                elif kind == "replace" and index < len(self.store):
+                    self.store[index] = op["record"]
+                else:
+                    break
+                applied += 1
+        finally:
+            self._replaying = False
+        return applied
+
+    @classmethod
+    def compact_file(cls, data_path):
+        # Writes a journal into its file without the editor's in-memory state.
+        ops = cls.read_ops(data_path)
+        if ops is None:
+            return
+        store = LineIndexedStore.open(data_path)
+        journal = cls()
+        journal.attach(store, data_path)
+        try:
+            journal.replay(ops)
+            store.save(data_path)
+            journal.reset(data_path)
+        finally:
+            store.close()
+
+
+class ScanCache:
+    """Sidecar index of a scanned dataset, so reopening it does not parse it again.
+
+    ``<file>.index`` keeps what a scan produces: the line offsets, the hash
+    of each record's duplicate key, the search postings and the invalid lines.
+    Every shard is checked against the size and mtime it had when it was
+    scanned and a checksum of its first and last bytes. A shard that is
+    unchanged is replayed from the cache; one that was appended to is replayed
+    up to its last complete line and only the rest is scanned. The scan
+    starts over at the first shard that changed in any other way.
+
+    The file is a JSON header line followed by the arrays in native byte
+    order. Saving a dataset removes its index.
+    """
+    SUFFIX = ".index"
+    VERSION = 1
+    MIN_BYTES = 16 * 1024 * 1024 # Smaller datasets scan fast enough without one
+    CHECK_BYTES = 64 * 1024 # Checksummed at the start and before the end of each shard's indexed part
+
+    def __init__(self, header, arrays, postings):
+        self.header = header
+        self.shard_of, self.starts, self.ends, self.line_numbers, self.hashes = arrays
+        self.postings = postings # word -> array('i') of record ids, sorted
+
+    @classmethod
+    def cache_path(cls, data_path):
+        return _sidecar_path(data_path, cls.SUFFIX)
+
+    @classmethod
+    def discard(cls, data_path):
+        _remove_quietly(cls.cache_path(data_path))
+
+    @classmethod
+    def load(cls, data_path, key, search_keys):
+        # The cache of data_path, or None when there is none or it cannot be used.
+        try:
+            with open(cls.cache_path(data_path), 'rb') as f:
+                header = json.loads(f.readline())
+                if (header.get("index") != cls.VERSION or header.get("byteorder") != sys.byteorder
+                        or header.get("key") != key or header.get("search_keys") != list(search_keys)):
+                    return None
+                count = header["records"]
+                arrays = [array('i')] + [array('q') for _ in range(4)]
+                for values in arrays:
+                    values.fromfile(f, count)
+                words = f.read(header["words_bytes"]).decode('utf-8').split("\n") if header["words_bytes"] else []
+                lengths = array('q')
+                lengths.fromfile(f, len(words))
+                record_ids = array('i')
+                record_ids.fromfile(f, sum(lengths))
+        except (OSError, ValueError, KeyError, TypeError, EOFError):
+            return None
+        postings = {}
+        position = 0
+        for word, length in zip(words, lengths):
+            postings[word] = record_ids[position:position + length]
+            position += length
+        return cls(header, arrays, postings)
+
+    @staticmethod
+    def _checksum(mm, end):
+        # Of the first and last CHECK_BYTES before `end`.
+        if mm is None or end == 0:
+            return ""
+        head = mm[:min(end, ScanCache.CHECK_BYTES)]
+        tail = mm[max(0, end - ScanCache.CHECK_BYTES):end]
+        return hashlib.blake2b(head + tail, digest_size=16).hexdigest()
+
+    def _reusable(self, entry, shard):
+        # Records of the shard that are still valid: "all", "complete" (up to the last
+        # complete line; the shard was appended to) or None.
+        if shard.size < entry["resume"] or self._checksum(shard.mm, entry["resume"]) != entry["checksum"]:
+            return None
+        if (shard.disk_size, shard.mtime_ns, shard.size) == (entry["disk_size"], entry["mtime_ns"], entry["size"]):
+            return "all"
+        return "complete"
+
+    def replay(self, source, task, search, errors, batch_lines=50000):
+        # Worker side: posts the cached rows that are still valid as "rows" messages, like a
+        # scan would, merges their search postings and collects their invalid lines. Returns
+        # (shard, position, lines before it, next record id) for the scan to resume from.
+        shards = self.header["shards"]
+        reused = 0 # Records posted
+        offset = 0 # Position in the cached arrays
+        resume = None
+        for index, entry in enumerate(shards):
+            if index >= len(source.shards) or entry["name"] != os.path.basename(source.shards[index].path):
+                resume = (index, 0, 0, reused)
+                break
+            shard = source.map_shard(index, task)
+            reusable = self._reusable(entry, shard)
+            if reusable is None:
+                resume = (index, 0, 0, reused)
+                break
+            count = entry["records"] if reusable == "all" else entry["resume_records"]
+            for batch in range(offset, offset + count, batch_lines):
+                stop = min(batch + batch_lines, offset + count)
+                position = self.ends[stop - 1]
+                task.post("rows", self.starts[batch:stop], self.ends[batch:stop], self.line_numbers[batch:stop],
+                          self.hashes[batch:stop], *source.progress(index, source.scan_fraction(index, position)), index)
+            last_line = entry["resume_lines"] if reusable == "complete" else float('inf')
+            path = _shard_name(source, index)
+            errors.extend(RecordDecodeError(line_number, line_text, error, path)
+                          for shard_index, line_number, line_text, error in self.header["errors"]
+                          if shard_index == index and line_number <= last_line)
+            reused += count
+            offset += entry["records"]
+            if reusable == "complete":
+                resume = (index, entry["resume"], entry["resume_lines"], reused)
+                break
+        if resume is None:
+            resume = (len(shards), 0, 0, reused)
+        postings = self.postings
+        if reused < len(self.starts): # Only the postings of the records posted
+            postings = {}
+            for word, record_ids in self.postings.items():
+                record_ids = record_ids[:bisect_left(record_ids, reused)]
+                if record_ids:
+                    postings[word] = record_ids
+        search.merge(postings, 0, reused)
+        return resume
+
+    @classmethod
+    def write(cls, data_path, source, key, search_keys, rows, errors, search):
+        # Writes the cache of a finished scan: `rows` are the "rows" messages it posted, in
+        # order, and `search` its index over the same record ids.
+        shard_of, starts, ends, line_numbers, hashes = array('i'), array('q'), array('q'), array('q'), array('q')
+        for row_starts, row_ends, row_line_numbers, row_hashes, _, _, shard in rows:
+            shard_of.extend(array('i', (shard,)) * len(row_starts))
+            for values, new in zip((starts, ends, line_numbers, hashes), (row_starts, row_ends, row_line_numbers, row_hashes)):
+                values.extend(new)
+        entries = []
+        first = 0
+        for index, shard in enumerate(source.shards):
+            count = bisect_left(shard_of, index + 1, first) - first
+            # The last line ending in a newline: an append may continue a line after it
+            complete = first + count
+            while complete > first and ends[complete - 1] >= shard.size:
+                complete -= 1
+            resume = ends[complete - 1] + 1 if complete > first else 0
+            entries.append({"name": os.path.basename(shard.path), "disk_size": shard.disk_size, "mtime_ns": shard.mtime_ns,
+                            "size": shard.size, "records": count, "resume": resume, "resume_records": complete - first,
+                            "resume_lines": line_numbers[complete - 1] if complete > first else 0,
+                            "checksum": cls._checksum(shard.mm, resume)})
+            first += count
+        shard_index = {shard.path: index for index, shard in enumerate(source.shards)}
+        words = []
+        lengths = array('q')
+        record_ids = array('i')
+        for word, posting in search._postings.items():
+            words.append(word)
+            lengths.append(len(posting))
+            record_ids.extend(posting)
+        words_blob = "\n".join(words).encode('utf-8')
+        header = {"index": cls.VERSION, "byteorder": sys.byteorder, "key": key, "search_keys": list(search_keys),
+                  "records": len(starts), "shards": entries, "words_bytes": len(words_blob),
+                  "errors": [[shard_index.get(e.path, 0), e.line_number, e.line_text, str(e.error)] for e in errors]}
+        path = cls.cache_path(data_path)
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(json.dumps(header).encode('utf-8') + b"\n")
+                for values in (shard_of, starts, ends, line_numbers, hashes):
+                    values.tofile(f)
+                f.write(words_blob)
+                lengths.tofile(f)
+                record_ids.tofile(f)
+            os.replace(tmp_path, path)
+        except OSError: # A read-only directory, a full disk: the next open scans again
+            _remove_quietly(tmp_path)
+
+
+class _RecordingTask:
+    """Passes a task's messages on and keeps the "rows" ones for ScanCache.write()."""
+
+    def __init__(self, task):
+        self.task = task
+        self.rows = []
+
+    def cancelled(self):
+        return self.task.cancelled()
+
+    def post(self, *message):
+        if message[0] == "rows":
+            self.rows.append(message[1:])
+        self.task.post(*message)
+
+
+class DuplicateInputIndex:
+    """Duplicate detection over one field, kept current from store change events.
+
+    Only an 8-byte hash of each normalised value is kept per record id, plus a
+    map from hash to the id (or set of ids) sharing it, so an edit, add or
+    delete costs O(1). Record ids are stable, so inserts never shift anything.
+    Ids whose duplicate status flipped accumulate until take_changed(), and the
+    number of groups of each size is counted as they grow and shrink.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.store = None
+        self._hashes = array('q') # record id -> hash of normalised value, 0 when empty
+        self._groups = {} # hash -> record id, or set of record ids once shared
+        self._sizes = Counter() # records in a group -> groups of that size, for groups of 2 or more
+        self._changed = set()
+
+    def attach(self, store):
+        # Full rebuild, for when the whole dataset is replaced.
+        if self.store is not None:
+            self.store.remove_listener(self._on_change)
+        self.store = store
+        self._hashes = array('q')
+        self._groups = {}
+        self._sizes = Counter()
+        for record_id, record in store.items():
+            self._add(record_id, record)
+        self._changed.clear()
+        store.add_listener(self._on_change)
+
+    def is_duplicate(self, record_id):
+        value_hash = self.hash_of(record_id)
+        return bool(value_hash) and isinstance(self._groups[value_hash], set)
+
+    def hash_of(self, record_id):
+        # Hash of the record's normalised value; records with equal values share it.
+        return self._hashes[record_id] if record_id < len(self._hashes) else 0
+
+    def duplicate_count(self):
+        return sum(len(group) for group in self._groups.values() if isinstance(group, set))
+
+    def group_sizes(self):
+        # {records sharing a value: number of such groups}, smallest groups first.
+        return dict(sorted(self._sizes.items()))
+
+    def take_changed(self):
+        changed, self._changed = self._changed, set()
+        return changed
+
+    def _on_change(self, kind, index, record_id, old, new):
+        if kind == "insert":
+            self._add(record_id, new)
+        elif kind == "delete":
+            self._remove(record_id)
+        else:
+            was_duplicate = self.is_duplicate(record_id)
+            self._remove(record_id)
+            self._add(record_id, new)
+            if self.is_duplicate(record_id) == was_duplicate:
+                self._changed.discard(record_id)
+
+    @staticmethod
+    def value_hash(record, key):
+        value = record.get(key, "") if isinstance(record, dict) else ""
+        value = (value if isinstance(value, str) else str(value)).strip() # Normalize by stripping
+        if not value: # Only consider non-empty values for duplication
+            return 0
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'little', signed=True) or 1
+
+    def add_hashes(self, first_id, hashes):
+        # Records appended by a background load, hashed on the worker thread.
+        for offset, value_hash in enumerate(hashes):
+            self._add_hash(first_id + offset, value_hash)
+
+    def _add(self, record_id, record):
+        self._add_hash(record_id, self.value_hash(record, self.key))
+
+    def _add_hash(self, record_id, value_hash):
+        if record_id >= len(self._hashes):
+            self._hashes.frombytes(bytes(8 * (record_id + 1 - len(self._hashes))))
+        self._hashes[record_id] = value_hash
+        if not value_hash:
+            return
+        group = self._groups.get(value_hash)
+        if group is None:
+            self._groups[value_hash] = record_id
+        elif isinstance(group, set):
+            self._resize(len(group), len(group) + 1)
+            group.add(record_id)
+            self._changed.add(record_id)
+        else:
+            self._groups[value_hash] = {group, record_id}
+            self._resize(1, 2)
+            self._changed.update((group, record_id))
+
+    def _remove(self, record_id):
+        value_hash = self._hashes[record_id] if record_id < len(self._hashes) else 0
+        if not value_hash:
+            return
+        self._hashes[record_id] = 0
+        group = self._groups[value_hash]
+        if not isinstance(group, set):
+            del self._groups[value_hash]
+            return
+        self._resize(len(group), len(group) - 1)
+        group.discard(record_id)
+        self._changed.add(record_id)
+        if len(group) == 1:
+            remaining = next(iter(group))
+            self._groups[value_hash] = remaining
+            self._changed.add(remaining)
+
+    def _resize(self, old, new):
+        if old > 1:
+            self._sizes[old] -= 1
+            if not self._sizes[old]:
+                del self._sizes[old]
+        if new > 1:
+            self._sizes[new] += 1
+
+
+_WORD_RE = re.compile(r"\w+")
+
+
+class NearDuplicateIndex:
+    """Near-duplicate detection over one field with MinHash and LSH, kept current from store change events.
+
+    Values are normalized (lower case, punctuation and runs of whitespace
+    dropped) and cut into overlapping character shingles. One-permutation
+    MinHash reduces the shingles to a NUM_PERM byte signature, cached per
+    record id, so an edit only rehashes the record that changed. Records that
+    share a band of their signature are candidates; a candidate whose
+    estimated Jaccard similarity reaches the threshold becomes a neighbor.
+    Rows with a neighbor are near-duplicates, and connected rows form a
+    cluster.
+
+    Each band is a sorted array searched with bisect (16 bytes per record)
+    plus a dict of records added since it was last sorted, so lookups stay
+    sub-linear and memory stays flat for millions of rows.
+    """
+    NUM_PERM = 64 # Signature bytes per record; a power of two
+    SHINGLE = 5 # Characters per shingle
+    MAX_NEIGHBORS = 8 # Enough to flag and cluster a record; bounds the work in large clusters
+    MAX_CANDIDATES = 256 # Bucket entries examined per band and lookup
+
+    def __init__(self, key, threshold=0.8):
+        self.key = key
+        self.threshold = threshold
+        self.bands, self.rows = self.band_layout(threshold, self.NUM_PERM)
+        self.store = None
+        self._signatures = bytearray() # NUM_PERM bytes per record id
+        self._live = bytearray() # 1 for record ids with a signature
+        self._live_count = 0
+        self._keys = [array('Q') for _ in range(self.bands)] # Sorted band keys...
+        self._ids = [array('q') for _ in range(self.bands)] # ...and their record ids
+        self._recent = [{} for _ in range(self.bands)] # band key -> record ids added since the sort
+        self._recent_count = 0
+        self._neighbors = {} # record id -> set of near-duplicate record ids
+        self._changed = set()
+        self._clusters = None # record id -> cluster number, rebuilt after changes
+        self._cluster_numbers = {} # Smallest record id of a cluster -> its number, kept across rebuilds
+
+    @staticmethod
+    def band_layout(threshold, num_perm):
+        # (bands, rows) whose candidate probability 1 - (1 - s**rows)**bands best separates
+        # pairs above and below the threshold. A false positive only costs one signature
+        # comparison, so it weighs a tenth of a missed pair. Bands of fewer than 3 bytes
+        # would collide by chance in large files.
+        best = None
+        for rows in range(3, 9):
+            for bands in range(1, num_perm // rows + 1):
+                error = 0.0
+                for step in range(50):
+                    s = (step + 0.5) / 50
+                    p = 1 - (1 - s ** rows) ** bands
+                    error += 0.1 * p if s < threshold else 1 - p
+                if best is None or error < best[0]:
+                    best = (error, bands, rows)
+        return best[1], best[2]
+
+    def signature(self, record):
+        # NUM_PERM bytes, or None when the value is empty after normalization.
+        value = record.get(self.key, "") if isinstance(record, dict) else ""
+        text = " ".join(_WORD_RE.findall((value if isinstance(value, str) else str(value)).lower()))
+        if not text:
+            return None
+        data = text.encode('utf-8')
+        k = self.SHINGLE
+        shingles = {zlib.crc32(data[i:i + k]) for i in range(max(1, len(data) - k + 1))}
+        bins = self.NUM_PERM
+        shift = 33 - bins.bit_length() # Top bits pick the bin, the rest is the hash value
+        mask = (1 << shift) - 1
+        empty = mask + 1
+        mins = [empty] * bins
+        for h in shingles:
+            h = (h * 0x9E3779B1) & 0xFFFFFFFF # Spread crc32 over all bits
+            b = h >> shift
+            if h & mask < mins[b]:
+                mins[b] = h & mask
+        if empty in mins:
+            # Densification: an empty bin borrows the next filled bin's minimum, offset by the
+            # distance, so short values still compare bin by bin.
+            filled = mins[:]
+            for b in range(bins):
+                if filled[b] == empty:
+                    distance = 1
+                    while filled[(b + distance) % bins] == empty:
+                        distance += 1
+                    mins[b] = filled[(b + distance) % bins] + distance * 0x9E3779B1
+        return bytes(v & 0xFF for v in mins) # One byte per bin (b-bit MinHash)
+
+    @classmethod
+    def similarity(cls, a, b):
+        # Estimated Jaccard similarity of two signatures, corrected for the 1/256 chance
+        # that two different minimums share their low byte.
+        equal = sum(1 for x, y in zip(a, b) if x == y)
+        return max(0.0, (equal / len(a) - 1 / 256) / (1 - 1 / 256))
+
+    def attach(self, store):
+        # Full rebuild, for when the whole dataset is replaced.
+        self.build(store)
+        self.listen()
+
+    def build(self, store, task=None, signatures_from=None):
+        # Hashes every record and links the near-duplicates. Reads records without touching
+        # the store's cache, so it can run on a worker thread as long as the store is not
+        # modified; listen() then keeps the index current. Signatures of an index over the
+        # same store (built with another threshold) are reused. False if cancelled.
+        if self.store is not None:
+            self.detach()
+        self.store = store
+        total = len(store)
+        reuse = signatures_from is not None and signatures_from.store is store and signatures_from.key == self.key
+        if reuse:
+            self._signatures = bytearray(signatures_from._signatures)
+            self._live = bytearray(signatures_from._live)
+            self._live_count = signatures_from._live_count
+        else:
+            for n, record_id in enumerate(store.record_ids()):
+                if task is not None and n % 2000 == 0:
+                    if task.cancelled():
+                        return False
+                    task.post("progress", n, 2 * total)
+                self._set_signature(record_id, self.signature(store.peek(record_id)))
+        self._sort_bands()
+        for n, record_id in enumerate(store.record_ids()):
+            if task is not None and n % 2000 == 0:
+                if task.cancelled():
+                    return False
+                task.post("progress", total + n, 2 * total)
+            if self._is_live(record_id):
+                self._link(record_id)
+        self._changed.clear()
+        return True
+
+    def listen(self):
+        self.store.add_listener(self._on_change)
+
+    def detach(self):
+        self.store.remove_listener(self._on_change)
+
+    def is_duplicate(self, record_id):
+        return record_id in self._neighbors
+
+    def neighbors(self, record_id):
+        return self._neighbors.get(record_id, ())
+
+    def duplicate_count(self):
+        return len(self._neighbors)
+
+    def cluster(self, record_id):
+        # Number of the record's cluster, or 0 when it has no near-duplicate. Numbers stay
+        # the same as long as a cluster keeps its first record.
+        if self._clusters is None:
+            self._clusters = {}
+            for start in sorted(self._neighbors):
+                if start in self._clusters:
+                    continue
+                members = [start]
+                self._clusters[start] = None
+                for member in members: # Breadth-first; grows while iterating
+                    for other in self._neighbors[member]:
+                        if other not in self._clusters:
+                            self._clusters[other] = None
+                            members.append(other)
+                number = self._cluster_numbers.setdefault(start, len(self._cluster_numbers) + 1)
+                for member in members:
+                    self._clusters[member] = number
+        return self._clusters.get(record_id, 0)
+
+    def cluster_count(self):
+        self.cluster(-1)
+        return len(set(self._clusters.values()))
+
+    def take_changed(self):
+        changed, self._changed = self._changed, set()
+        return changed
+
+    def add(self, record_id, record):
+        # A record that is new to the store, such as a line appended to the file.
+        self._set_signature(record_id, self.signature(record))
+        if self._is_live(record_id):
+            self._add_to_bands(record_id)
+            self._link(record_id)
+
+    def _on_change(self, kind, index, record_id, old, new):
+        if kind != "insert":
+            self._remove(record_id)
+        if kind != "delete":
+            self.add(record_id, new)
+
+    def _is_live(self, record_id):
+        return record_id < len(self._live) and self._live[record_id]
+
+    def _signature_of(self, record_id):
+        start = record_id * self.NUM_PERM
+        return self._signatures[start:start + self.NUM_PERM]
+
+    def _band_key(self, signature, band):
+        return int.from_bytes(signature[band * self.rows:(band + 1) * self.rows], 'little')
+
+    def _set_signature(self, record_id, signature):
+        if record_id >= len(self._live):
+            grow = record_id + 1 - len(self._live)
+            self._live.extend(bytes(grow))
+            self._signatures.extend(bytes(grow * self.NUM_PERM))
+        if signature is None:
+            return
+        start = record_id * self.NUM_PERM
+        self._signatures[start:start + self.NUM_PERM] = signature
+        self._live[record_id] = 1
+        self._live_count += 1
+
+    def _sort_bands(self):
+        live_ids = [record_id for record_id, live in enumerate(self._live) if live]
+        signatures = [self._signature_of(record_id) for record_id in live_ids]
+        for band in range(self.bands):
+            keys = [self._band_key(signature, band) for signature in signatures]
+            order = sorted(range(len(keys)), key=keys.__getitem__)
+            self._keys[band] = array('Q', [keys[i] for i in order])
+            self._ids[band] = array('q', [live_ids[i] for i in order])
+            self._recent[band] = {}
+        self._recent_count = 0
+
+    def _add_to_bands(self, record_id):
+        signature = self._signature_of(record_id)
+        for band in range(self.bands):
+            self._recent[band].setdefault(self._band_key(signature, band), []).append(record_id)
+        self._recent_count += 1
+        if self._recent_count > max(4096, self._live_count // 4):
+            self._sort_bands()
+
+    def _candidates(self, band, key):
+        keys, ids = self._keys[band], self._ids[band]
+        i = bisect_left(keys, key)
+        end = min(len(keys), i + self.MAX_CANDIDATES)
+        while i < end and keys[i] == key:
+            yield ids[i]
+            i += 1
+        yield from self._recent[band].get(key, ())[:self.MAX_CANDIDATES]
+
+    def add_unique(self, record_id, record):
+        # Streaming deduplication without a store: indexes the record unless it is a
+        # near-duplicate of one indexed before. Returns whether it was indexed.
+        signature = self.signature(record)
+        if signature is None:
+            return True
+        if next(self._similar(signature, ()), None) is not None:
+            return False
+        self._set_signature(record_id, signature)
+        self._add_to_bands(record_id)
+        return True
+
+    def _link(self, record_id):
+        # Finds neighbors of one record until MAX_NEIGHBORS are known.
+        known = self._neighbors.get(record_id, ())
+        if len(known) >= self.MAX_NEIGHBORS:
+            return
+        for other in self._similar(self._signature_of(record_id), {record_id, *known}):
+            self._connect(record_id, other)
+            if len(self._neighbors[record_id]) >= self.MAX_NEIGHBORS:
+                return
+
+    def _similar(self, signature, skip):
+        # Yields indexed records whose similarity reaches the threshold. Bands still list
+        # records that were deleted or edited since they were sorted; those are skipped.
+        seen = set(skip)
+        for band in range(self.bands):
+            key = self._band_key(signature, band)
+            for other in self._candidates(band, key):
+                if other in seen:
+                    continue
+                seen.add(other)
+                if not self._is_live(other):
+                    continue
+                other_signature = self._signature_of(other)
+                if self._band_key(other_signature, band) != key:
+                    continue
+                if self.similarity(signature, other_signature) >= self.threshold:
+                    yield other
+
+    def _connect(self, a, b):
+        self._neighbors.setdefault(a, set()).add(b)
+        self._neighbors.setdefault(b, set()).add(a)
+        self._changed.update((a, b))
+        self._clusters = None
+
+    def _remove(self, record_id):
+        if not self._is_live(record_id):
+            return
+        self._live[record_id] = 0
+        self._live_count -= 1
+        neighbors = self._neighbors.pop(record_id, None)
+        if not neighbors:
+            return
+        self._changed.add(record_id)
+        self._clusters = None
+        for other in neighbors:
+            others = self._neighbors[other]
+            others.discard(record_id)
+            self._changed.add(other)
+            if not others:
+                del self._neighbors[other]
+        for other in neighbors:
+            self._link(other) # It may have had more neighbors than it looked for
+
+
+class SearchIndex:
+    """Inverted index from lower-case words to the records containing them.
+
+    Postings are arrays of record ids per word, kept current from store
+    change events: an edit appends the words it introduced and notes the ones
+    it removed, a delete marks the record dead and its words stale. A stale
+    posting is cleaned (and sorted) when it is next queried, so no change
+    scans a posting. Word queries intersect postings, shortest first; phrase
+    queries verify those candidates against the text.
+    """
+    SEARCH_MODES = ("token", "phrase", "regex")
+
+    def __init__(self, keys):
+        self.keys = tuple(keys)
+        self.store = None
+        self._postings = {} # word -> array('i') of record ids
+        self._stale = set() # Words whose posting is out of order or holds dead or removed ids
+        self._removed = {} # word -> ids of live records edited to no longer contain it
+        self._live = bytearray() # 1 per indexed record id
+
+    @staticmethod
+    def words(text):
+        return _WORD_RE.findall(text.lower())
+
+    def record_words(self, record):
+        if not isinstance(record, dict):
+            return set()
+        found = set()
+        for key in self.keys:
+            value = record.get(key)
+            if value:
+                found.update(self.words(value if isinstance(value, str) else str(value)))
+        return found
+
+    def attach(self, store):
+        # Full rebuild, for when the whole dataset is replaced.
+        for record_id, record in store.items():
+            self.add(record_id, record)
+        self.store = store
+        self.listen()
+
+    def listen(self):
+        self.store.add_listener(self._on_change)
+
+    def detach(self):
+        self.store.remove_listener(self._on_change)
+
+    def add(self, record_id, record):
+        if record_id >= len(self._live):
+            self._live.extend(bytes(record_id + 1 - len(self._live)))
+        self._live[record_id] = 1
+        for word in self.record_words(record):
+            self._add_posting(word, record_id)
+
+    def merge(self, postings, first_id, count):
+        # Adds `count` records indexed by another SearchIndex (a map_chunks() worker) under
+        # ids shifted by first_id. They must come after every record indexed so far.
+        assert first_id == len(self._live), "merged records must follow the indexed ones"
+        self._live.extend(b"\x01" * count)
+        shift = first_id.__add__
+        for word, record_ids in postings.items():
+            if first_id:
+                record_ids = array('i', map(shift, record_ids))
+            posting = self._postings.get(word)
+            if posting is None:
+                self._postings[word] = record_ids
+            else:
+                posting.extend(record_ids)
+
+    def _add_posting(self, word, record_id):
+        posting = self._postings.get(word)
+        if posting is None:
+            self._postings[word] = array('i', (record_id,))
+            return
+        removed = self._removed.get(word)
+        if removed is not None and record_id in removed: # Edited back in; its id is still in the posting
+            removed.discard(record_id)
+            return
+        if posting[-1] > record_id:
+            self._stale.add(word)
+        posting.append(record_id)
+
+    def _on_change(self, kind, index, record_id, old, new):
+        if kind == "insert":
+            self.add(record_id, new)
+        elif kind == "delete":
+            self._live[record_id] = 0
+            self._stale.update(self.record_words(old))
+        else:
+            old_words, new_words = self.record_words(old), self.record_words(new)
+            for word in old_words - new_words:
+                self._removed.setdefault(word, set()).add(record_id)
+                self._stale.add(word)
+            for word in new_words - old_words:
+                self._add_posting(word, record_id)
+
+    def _posting(self, word):
+        posting = self._postings.get(word)
+        if posting is not None and word in self._stale:
+            live = self._live
+            removed = self._removed.pop(word, ())
+            posting = array('i', sorted(r for r in posting if live[r] and r not in removed))
+            self._stale.discard(word)
+            if posting:
+                self._postings[word] = posting
+            else:
+                del self._postings[word]
+        return posting
+
+    def search(self, query, mode="token"):
+        # Sorted record ids of the records containing every word of the query ("token"), or
+        # the words in sequence within one field ("phrase"). Regular expressions cannot use
+        # the index; see scan_regex().
+        words = self.words(query)
+        if not words:
+            return []
+        postings = []
+        for word in set(words):
+            posting = self._posting(word)
+            if not posting:
+                return []
+            postings.append(posting)
+        postings.sort(key=len)
+        live = self._live
+        result = [record_id for record_id in postings[0] if live[record_id]]
+        for posting in postings[1:]:
+            if not result:
+                break
+            if len(result) * 16 < len(posting): # Few candidates: binary search the long posting
+                result = [r for r in result if _contains_sorted(posting, r)]
+            else:
+                members = set(posting)
+                result = [r for r in result if r in members]
+        if mode == "phrase" and len(words) > 1:
+            phrase = f" {' '.join(words)} "
+            result = [r for r in result if self._has_phrase(self.store.peek(r), phrase)]
+        return result
+
+    def _has_phrase(self, record, phrase):
+        for key in self.keys:
+            value = record.get(key)
+            if value and phrase in f" {' '.join(self.words(value if isinstance(value, str) else str(value)))} ":
+                return True
+        return False
+
+
+def _contains_sorted(values, value):
+    i = bisect_left(values, value)
+    return i < len(values) and values[i] == value
+
+
+def scan_regex(store, keys, pattern, task=None):
+    # Record ids of the records where `pattern` matches one of the fields, in dataset
+    # order. A linear scan, so it runs on a worker thread in the editor; None if cancelled.
+    found = []
+    for n, record_id in enumerate(store.record_ids()):
+        if task is not None and n % 5000 == 0:
+            if task.cancelled():
+                return None
+            task.post("progress", n, len(store))
+        if _regex_matches(store.peek(record_id), keys, pattern):
+            found.append(record_id)
+    return found
+
+
+def _regex_matches(record, keys, pattern):
+    return isinstance(record, dict) and any(
+        pattern.search(value if isinstance(value, str) else str(value))
+        for value in (record.get(key) for key in keys) if value)
+
+
+def _field_text(record, key):
+    value = record.get(key) if isinstance(record, dict) else None
+    if value is None:
+        return ""
+    return value if isinstance(value, str) else str(value)
+
+
+class RecordView:
+    """A filtered and sorted order of a store's records, kept as record ids only.
+
+    Holds the ids of the records passing ``predicate(record_id)``, in dataset
+    order or ordered by the integer ``key(record_id)``, and follows the store's
+    change events, so an edit, add or delete in the view costs one predicate
+    and key call. Records are never copied: row ``r`` is the record
+    ``record_id(r)``, and ``position(r)`` maps it back to the dataset position
+    that edits, undo and save work on. Positions come from a map rebuilt
+    lazily after inserts and deletes, which is also when members added out of
+    place are put in dataset order.
+
+    Lines appended by a load or follow mode do not send change events; they
+    join with extend(). Membership that depends on other records, such as
+    duplicate status, is re-checked with refresh().
+    """
+    _OUT = 1 # _state values; 0 is a deleted or unknown record id
+    _IN = 2
+
+    def __init__(self, predicate=None, key=None, descending=False):
+        self.predicate = predicate
+        self.key = key
+        self.descending = descending
+        self.store = None
+        self._ids = array('q') # Member record ids in view order
+        self._keys = array('q') # Sorted views: sort key of each row, parallel to _ids
+        self._key_of = array('q') # Sorted views: record id -> sort key of a member
+        self._state = bytearray() # record id -> _OUT or _IN
+        self._pending = [] # Dataset-order views: members added since _ids was last put in order
+        self._removed = set() # Dataset-order views: ids left in _ids after leaving the view
+        self._unsorted_ties = set() # Sorted views: keys whose tied rows may be out of dataset order
+        self._positions = None # record id -> dataset position; dropped when records move
+
+    def build(self, store, task=None, members=None):
+        # Fills the view from every record of the store, or takes `members` (record ids the
+        # caller knows to pass, such as search index results) without calling the predicate.
+        # Returns False if cancelled. Safe on a worker thread while the store is not modified.
+        self.store = store
+        self._positions = None
+        self._pending = []
+        self._removed = set()
+        self._unsorted_ties = set()
+        state = self._state = bytearray(store._source.next_id)
+        wanted = set(members) if members is not None else None
+        ids, keys = [], []
+        total = len(store)
+        for n, record_id in enumerate(store.record_ids()):
+            if task is not None and n % 5000 == 0:
+                if task.cancelled():
+                    return False
+                task.post("progress", n, total)
+            if record_id in wanted if wanted is not None else self._wanted(record_id):
+                state[record_id] = self._IN
+                ids.append(record_id)
+                if self.key is not None:
+                    keys.append(self._sort_key(record_id))
+            else:
+                state[record_id] = self._OUT
+        if self.key is None:
+            self._ids = array('q', ids)
+            return True
+        order = sorted(range(len(ids)), key=keys.__getitem__) # Stable: ties keep dataset order
+        self._ids = array('q', [ids[i] for i in order])
+        self._keys = array('q', [keys[i] for i in order])
+        self._key_of = array('q', bytes(8 * len(state)))
+        for record_id, key in zip(ids, keys):
+            self._key_of[record_id] = key
+        return True
+
+    def listen(self):
+        self.store.add_listener(self._on_change)
+
+    def detach(self):
+        self.store.remove_listener(self._on_change)
+
+    def __len__(self):
+        return len(self._ids) + len(self._pending) - len(self._removed)
+
+    def record_id(self, row):
+        self._settle()
+        return self._ids[row]
+
+    def position(self, row):
+        return self._position_map()[self.record_id(row)]
+
+    def row_of(self, record_id):
+        # Row of a record, or -1 when the view leaves it out.
+        if record_id >= len(self._state) or self._state[record_id] != self._IN:
+            return -1
+        self._settle()
+        if self.key is not None:
+            return self._sorted_row(record_id)
+        positions = self._position_map()
+        return self._row_at(positions[record_id], positions)
+
+    def extend(self, first_id, count):
+        # Records appended after the last one by Dataset.extend_scanned().
+        self._grow(first_id + count)
+        if self._positions is not None:
+            start = len(self.store) - count
+            for offset in range(count):
+                self._positions[first_id + offset] = start + offset
+        for record_id in range(first_id, first_id + count):
+            self._state[record_id] = self._OUT
+            if self._wanted(record_id):
+                self._add(record_id, at_end=True)
+
+    def refresh(self, record_ids):
+        # Re-checks records whose membership may have changed without an edit of their own.
+        # Returns whether the view changed.
+        changed = False
+        for record_id in record_ids:
+            if record_id >= len(self._state) or not self._state[record_id]:
+                continue # Deleted
+            wanted = self._wanted(record_id)
+            if wanted != (self._state[record_id] == self._IN):
+                if wanted:
+                    self._add(record_id)
+                else:
+                    self._remove(record_id)
+                changed = True
+        return changed
+
+    def _on_change(self, kind, index, record_id, old, new):
+        if kind == "insert":
+            self._grow(record_id + 1)
+            self._positions = None
+            self._state[record_id] = self._OUT
+            if self._wanted(record_id):
+                self._add(record_id)
+        elif kind == "delete":
+            if self._state[record_id] == self._IN:
+                self._remove(record_id)
+            self._state[record_id] = 0
+            self._positions = None
+        else:
+            member = self._state[record_id] == self._IN
+            wanted = self._wanted(record_id)
+            if member and wanted and (self.key is None or self._sort_key(record_id) == self._key_of[record_id]):
+                return
+            if member:
+                self._remove(record_id)
+            if wanted:
+                self._add(record_id)
+
+    def _wanted(self, record_id):
+        return self.predicate is None or bool(self.predicate(record_id))
+
+    def _sort_key(self, record_id):
+        key = self.key(record_id)
+        return -key if self.descending else key # Descending ties still keep dataset order
+
+    def _add(self, record_id, at_end=False):
+        self._state[record_id] = self._IN
+        if self.key is not None:
+            key = self._key_of[record_id] = self._sort_key(record_id)
+            row = bisect_right(self._keys, key)
+            if not at_end and row and self._keys[row - 1] == key:
+                self._unsorted_ties.add(key) # Put in dataset order among its ties by the next _settle()
+            self._keys.insert(row, key)
+            self._ids.insert(row, record_id)
+        elif record_id in self._removed: # Still in place; ids never move without a delete
+            self._removed.discard(record_id)
+        elif at_end and not self._pending:
+            self._ids.append(record_id)
+        else:
+            self._pending.append(record_id)
+
+    def _remove(self, record_id):
+        self._state[record_id] = self._OUT
+        if self.key is not None:
+            row = self._sorted_row(record_id)
+            del self._keys[row]
+            del self._ids[row]
+        elif record_id in self._pending:
+            self._pending.remove(record_id)
+        else:
+            self._removed.add(record_id) # Dropped from _ids by the next _settle(), in one pass
+
+    def _grow(self, size):
+        grow = size - len(self._state)
+        if grow <= 0:
+            return
+        self._state.extend(bytes(grow))
+        if self.key is not None:
+            self._key_of.frombytes(bytes(8 * grow))
+        if self._positions is not None:
+            self._positions.frombytes(bytes(8 * grow))
+
+    def _position_map(self):
+        if self._positions is None:
+            positions = array('q', bytes(8 * len(self._state)))
+            for position, record_id in enumerate(self.store.record_ids()):
+                positions[record_id] = position
+            self._positions = positions
+        return self._positions
+
+    def _row_at(self, position, positions):
+        # First row whose record is at `position` or after it; dataset-order views only.
+        ids = self._ids
+        low, high = 0, len(ids)
+        while low < high:
+            middle = (low + high) // 2
+            if positions[ids[middle]] < position:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _sorted_row(self, record_id):
+        # Sorted views only: bisects to the record's key, then scans the rows that tie with it.
+        key = self._key_of[record_id]
+        first = bisect_left(self._keys, key)
+        return first + self._ids[first:bisect_right(self._keys, key)].index(record_id)
+
+    def _settle(self):
+        # Drops the members that left, and puts those added by inserts and edits in dataset order.
+        if self._unsorted_ties:
+            positions = self._position_map()
+            for key in self._unsorted_ties:
+                first, last = bisect_left(self._keys, key), bisect_right(self._keys, key)
+                self._ids[first:last] = array('q', sorted(self._ids[first:last], key=positions.__getitem__))
+            self._unsorted_ties = set()
+        if self._removed:
+            removed = self._removed
+            self._ids = array('q', [record_id for record_id in self._ids if record_id not in removed])
+            self._removed = set()
+        if not self._pending:
+            return
+        positions = self._position_map()
+        if len(self._pending) * 16 > len(self._ids):
+            self._ids = array('q', sorted(itertools.chain(self._ids, self._pending), key=positions.__getitem__))
+        else:
+            for record_id in self._pending:
+                self._ids.insert(self._row_at(positions[record_id], positions), record_id)
+        self._pending = []
+
+
+_MISSING = object() # Marks a key absent on one side of a field change
+
+
+def _approx_size(value):
+    # Rough in-memory footprint, used to keep the undo history within its budget.
+    if isinstance(value, str):
+        return 49 + len(value)
+    if isinstance(value, dict):
+        return 64 + sum(_approx_size(k) + _approx_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return 56 + sum(_approx_size(v) for v in value)
+    return 32
+
+
+class _HistoryEntry:
+    __slots__ = ("description", "selected_before", "selected_after", "ops", "size")
+
+    def __init__(self, description, selected_before):
+        self.description = description
+        self.selected_before = selected_before
+        self.selected_after = selected_before
+        self.ops = [] # ("insert", index, record) / ("delete", index, record) / ("replace", index, {key: (old, new)})
+        self.size = 0
+
+
+class EditHistory:
+    """Undo/redo as lists of reversible store operations.
+
+    Listens to the store and records only what each action changed: the
+    inserted or deleted record, or the changed fields of a replaced one (the
+    whole old and new value when either is not a JSON object). Undo
+    and redo replay those operations, so both cost O(change). Old entries are
+    dropped once the recorded operations exceed ``budget_bytes``.
+    """
+
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.store = None
+        self.undo_stack = deque()
+        self.redo_stack = []
+        self._size = 0
+        self._replaying = False
+
+    def attach(self, store):
+        if self.store is not None:
+            self.store.remove_listener(self._on_change)
+        self.store = store
+        self.clear()
+        store.add_listener(self._on_change)
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self._size = 0
+
+    def begin(self, description, selected_index):
+        # Changes made until the next begin() are undone as one step.
+        self._drop_empty_entry()
+        self.undo_stack.append(_HistoryEntry(description, selected_index))
+
+    def can_undo(self):
+        self._drop_empty_entry()
+        return bool(self.undo_stack)
+
+    def can_redo(self):
+        return bool(self.redo_stack)
+
+    def undo(self, selected_index):
+        self._drop_empty_entry()
+        entry = self.undo_stack.pop()
+        entry.selected_after = selected_index
+        self._replay(reversed(entry.ops), undo=True)
+        self.redo_stack.append(entry)
+        return entry
+
+    def redo(self):
+        entry = self.redo_stack.pop()
+        self._replay(entry.ops, undo=False)
+        self.undo_stack.append(entry)
+        return entry
+
+    def _drop_empty_entry(self):
+        if self.undo_stack and not self.undo_stack[-1].ops:
+            self.undo_stack.pop()
+
+    def _on_change(self, kind, index, record_id, old, new):
+        if self._replaying:
+            return
+        if not self.undo_stack:
+            self.undo_stack.append(_HistoryEntry("Change", index))
+        if kind == "insert":
+            op = ("insert", index, new)
+        elif kind == "delete":
+            op = ("delete", index, old)
+        elif not isinstance(old, dict) or not isinstance(new, dict): # A JSON line may hold any value
+            op = ("replace", index, (old, new))
+        else:
+            changes = {}
+            for key in old.keys() | new.keys():
+                old_value, new_value = old.get(key, _MISSING), new.get(key, _MISSING)
+                if old_value != new_value:
+                    changes[key] = (old_value, new_value)
+            op = ("replace", index, changes)
+        entry = self.undo_stack[-1]
+        size = _approx_size(op[2])
+        entry.ops.append(op)
+        entry.size += size
+        self._size += size
+        if self.redo_stack:
+            self._size -= sum(e.size for e in self.redo_stack)
+            self.redo_stack.clear()
+        while self._size > self.budget_bytes and len(self.undo_stack) > 1:
+            self._size -= self.undo_stack.popleft().size
+
+    def _replay(self, ops, undo):
+        # Runs of inserts at rising positions and of deletes at falling ones, which is how
+        # batch operations record them, are applied with one insert_many() or delete_many().
+        store = self.store
+        self._replaying = True
+        try:
+            run_kind, run = None, []
+            for kind, index, payload in itertools.chain(ops, [("end", 0, None)]):
+                if kind in ("insert", "delete"):
+                    kind = "insert" if (kind == "insert") != undo else "delete"
+                    if kind == run_kind and (index > run[-1][0] if kind == "insert" else index < run[-1][0]):
+                        run.append((index, payload))
+                        continue
+                self._apply_run(run_kind, run)
+                run_kind, run = kind, [(index, payload)]
+                if kind == "replace" and isinstance(payload, tuple): # Whole value
+                    store[index] = payload[0] if undo else payload[1]
+                elif kind == "replace":
+                    record = dict(store[index])
+                    for key, (old_value, new_value) in payload.items():
+                        value = old_value if undo else new_value
+                        if value is _MISSING:
+                            record.pop(key, None)
+                        else:
+                            record[key] = value
+                    store[index] = record
+        finally:
+            self._replaying = False
+
+    def _apply_run(self, kind, run):
+        if kind == "insert":
+            self.store.insert_many(run)
+        elif kind == "delete":
+            self.store.delete_many(index for index, _ in run)
+
+
+PARALLEL_SCAN_BYTES = 64 * 1024 * 1024 # Smaller files are scanned in-process, in one pass
+PARALLEL_CHUNK_BYTES = 32 * 1024 * 1024 # Bytes of the file per map_chunks() work item
+
+
+def _decode_lines(mm, starts, ends, line_numbers, key, search=None, first_id=0, errors=None, path=None):
+    # Decodes scanned lines and hashes their `key` value; returns (starts, ends,
+    # line_numbers, hashes). Records are added to `search` with ids from first_id. Invalid
+    # lines raise RecordDecodeError (naming `path`), or are collected into `errors` and
+    # left out.
+    hashes = array('q')
+    invalid = []
+    record_id = first_id
+    for i, (start, end, line_number) in enumerate(zip(starts, ends, line_numbers)):
+        try:
+            record = decode_line(mm[start:end], line_number, path)
+        except RecordDecodeError as e:
+            if errors is None:
+                raise
+            errors.append(e)
+            invalid.append(i)
+            continue
+        hashes.append(DuplicateInputIndex.value_hash(record, key))
+        if search is not None:
+            search.add(record_id, record)
+        record_id += 1
+    if invalid:
+        keep = sorted(set(range(len(starts))).difference(invalid))
+        starts, ends, line_numbers = (array('q', (values[i] for i in keep)) for values in (starts, ends, line_numbers))
+    return starts, ends, line_numbers, hashes
+
+
+def scan_and_hash_records(store, key, task, batch_lines=20000, search=None, errors=None, resume=None):
+    # Background load worker: indexes the mapped files, validates every line and hashes
+    # its `key` value for duplicate detection, posting one "rows" message per batch.
+    # Records are also added to `search`, which the Tk thread does not see until the
+    # scan is done; their ids are assigned in scan order, starting at 0. With an
+    # `errors` list, invalid lines are collected there instead of stopping the scan.
+    # `resume` (see ScanCache.replay) continues after rows that were already posted.
+    source = store._source
+    record_id = resume[3] if resume else 0
+    try:
+        for shard, starts, ends, line_numbers, position in store.scan_batches(batch_lines, task, resume and resume[:3]):
+            if task.cancelled():
+                return False
+            starts, ends, line_numbers, hashes = _decode_lines(source.shards[shard].mm, starts, ends, line_numbers, key,
+                                                               search, record_id, errors, _shard_name(source, shard))
+            record_id += len(starts)
+            task.post("rows", starts, ends, line_numbers, hashes,
+                      *source.progress(shard, source.scan_fraction(shard, position)), shard)
+    except _Cancelled: # While decompressing a shard
+        return False
+    return True
+
+
+def _shard_name(source, shard):
+    # Path for error messages, which only need it when there are several files.
+    return source.shards[shard].path if len(source.shards) > 1 else None
+
+
+def _chunk_ranges(mm, pos, chunk_bytes):
+    # Byte ranges of about chunk_bytes from `pos` to the end, each ending after a newline.
+    size = len(mm)
+    ranges = []
+    while pos < size:
+        end = pos + chunk_bytes
+        if end < size:
+            newline = mm.find(b"\n", end - 1)
+            end = newline + 1 if newline != -1 else size
+        else:
+            end = size
+        ranges.append((pos, end))
+        pos = end
+    return ranges
+
+
+def _chunk_items(paths, chunk_bytes, start=0):
+    for file_index, path in enumerate(paths):
+        if not os.path.getsize(path):
+            continue
+        with _map_file(path) as mm:
+            pos = start if file_index == 0 and start else (3 if mm[:3] == b"\xef\xbb\xbf" else 0)
+            ranges = _chunk_ranges(mm, pos, chunk_bytes)
+        for start, end in ranges:
+            yield file_index, path, start, end
+
+
+def map_chunks(paths, function, args=(), workers=None, task=None, chunk_bytes=PARALLEL_CHUNK_BYTES, start=0):
+    # Runs function(path, start, end, *args) over newline-aligned byte ranges of the files,
+    # in a pool of `workers` processes (default: one per core), and yields (file_index, end,
+    # first_line, result) in file order, first_line being the number of lines of the file
+    # before the range. `paths` is one path or an iterable, which may be a generator: the
+    # next file is only asked for once the pool has room, so it can be prepared
+    # (decompressed) while earlier ones are scanned. The function must be defined at module
+    # level and return (line_count, result). Raises _Cancelled when the task is cancelled.
+    # A `start` other than 0 is the byte position, at the start of a line, where the first
+    # file is read from; its line numbers then count from there.
+    items = _chunk_items((paths,) if isinstance(paths, str) else paths, chunk_bytes, start)
+    workers = workers or os.cpu_count() or 1
+    head = list(itertools.islice(items, 2))
+    items = itertools.chain(head, items)
+    current, first_line = 0, 0
+
+    if workers <= 1 or len(head) < 2: # One chunk is faster without starting processes
+        for file_index, path, start, end in items:
+            if task is not None and task.cancelled():
+                raise _Cancelled()
+            if file_index != current:
+                current, first_line = file_index, 0
+            line_count, result = function(path, start, end, *args)
+            yield file_index, end, first_line, result
+            first_line += line_count
+        return
+
+    # Spawned rather than forked: the parent may be running Tk and other threads.
+    pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+    pending = deque() # (file_index, end, future), in file order; at most two per worker in flight
+    try:
+        while True:
+            for file_index, path, start, end in items:
+                pending.append((file_index, end, pool.submit(function, path, start, end, *args)))
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                break
+            file_index, end, future = pending.popleft()
+            while True:
+                if task is not None and task.cancelled():
+                    raise _Cancelled()
+                if future.done():
+                    break
+                wait((future,), timeout=0.1)
+            if file_index != current:
+                current, first_line = file_index, 0
+            line_count, result = future.result()
+            yield file_index, end, first_line, result
+            first_line += line_count
+    finally:
+        for _, _, future in pending:
+            future.cancel()
+        pool.shutdown()
+
+
+def _scan_chunk(path, start, end, key, search_keys):
+    # map_chunks() worker of parallel_scan_records(): the valid lines of one chunk with
+    # their hashes, the invalid ones, and the chunk's search postings. Line numbers and
+    # record ids count from the start of the chunk.
+    search = SearchIndex(search_keys)
+    errors = []
+    starts, ends, line_numbers, hashes = array('q'), array('q'), array('q'), array('q')
+    line_count = 0
+    with _map_file(path) as mm:
+        for batch in _scan_lines(mm, start, end):
+            line_count = batch[4]
+            batch = _decode_lines(mm, *batch[:3], key, search, len(starts), errors)
+            for values, new in zip((starts, ends, line_numbers, hashes), batch):
+                values.extend(new)
+    return line_count, (starts, ends, line_numbers, hashes, errors, search._postings)
+
+
+def parallel_scan_records(store, key, task, search, errors, workers=None, resume=None):
+    # scan_and_hash_records() for large datasets: chunks of the files are validated, hashed
+    # and indexed for search by a pool of processes, and merged here in file order, one
+    # "rows" message per chunk. Invalid lines are always collected into `errors`.
+    source = store._source
+    first, start, lines_before, record_id = resume or (0, 0, 0, 0)
+
+    def data_paths(): # Compressed shards are decompressed as the pool gets to them
+        for index in range(first, len(source.shards)):
+            yield source.map_shard(index, task).data_path
+
+    try:
+        for shard, position, first_line, result in map_chunks(data_paths(), _scan_chunk, (key, search.keys), workers, task,
+                                                              start=start):
+            shard += first
+            if shard == first:
+                first_line += lines_before
+            starts, ends, line_numbers, hashes, chunk_errors, postings = result
+            if first_line:
+                line_numbers = array('q', map(first_line.__add__, line_numbers))
+            path = _shard_name(source, shard)
+            errors.extend(RecordDecodeError(first_line + e.line_number, e.line_text, e.error, path) for e in chunk_errors)
+            search.merge(postings, record_id, len(starts))
+            record_id += len(starts)
+            task.post("rows", starts, ends, line_numbers, hashes,
+                      *source.progress(shard, source.scan_fraction(shard, position)), shard)
+    except _Cancelled:
+        return False
+    return True
+
+
+def _validate_chunk(path, start, end, required):
+    # map_chunks() worker of validate_file(); line numbers count from the start of the chunk.
+    problems = [] # (line number, RecordDecodeError or message)
+    records = 0
+    line_count = 0
+    with _map_file(path) as mm:
+        for starts, ends, line_numbers, _, line_count in _scan_lines(mm, start, end):
+            for line_start, line_end, line_number in zip(starts, ends, line_numbers):
+                try:
+                    record = decode_line(mm[line_start:line_end], line_number)
+                except RecordDecodeError as e:
+                    problems.append((line_number, e))
+                    continue
+                records += 1
+                if not isinstance(record, dict):
+                    problems.append((line_number, f"expected a JSON object, got {type(record).__name__}"))
+                    continue
+                missing = [key for key in required if key not in record]
+                if missing:
+                    problems.append((line_number, f"missing keys {', '.join(missing)}"))
+    return line_count, (records, problems)
+
+
+def validate_file(path, required=(), workers=None):
+    # Checks that every line is a JSON object with the required keys, chunks of the files
+    # in parallel (see map_chunks). `path` may be compressed or a set of shards; messages
+    # then name the shard. Yields (records, problems) per chunk in file order: the number
+    # of valid JSON lines and a list of (line_number, message).
+    paths = dataset_files(path)
+    spools = {} # file index -> decompressed copy, removed once the file is done
+
+    def data_paths():
+        for index, shard_path in enumerate(paths):
+            if compression_of(shard_path) is None:
+                yield shard_path
+            else:
+                spools[index] = _spool(shard_path)
+                yield spools[index]
+
+    try:
+        for index, _, first_line, (records, problems) in map_chunks(data_paths(), _validate_chunk, (tuple(required),), workers):
+            for done in [i for i in spools if i < index]:
+                _remove_quietly(spools.pop(done))
+            shard = paths[index] if len(paths) > 1 else None
+            messages = []
+            for line_number, problem in problems:
+                line_number += first_line
+                if isinstance(problem, RecordDecodeError):
+                    messages.append((line_number, str(RecordDecodeError(line_number, problem.line_text, problem.error, shard))))
+                else:
+                    where = f"Line {line_number} of {os.path.basename(shard)}" if shard else f"Line {line_number}"
+                    messages.append((line_number, f"{where}: {problem}"))
+            yield records, messages
+    finally:
+        for spool in spools.values():
+            _remove_quietly(spool)
+
+
+# --- Contamination checks: hashes of reference files (eval sets), kept on disk ---
+
+
+def reference_hashes(record, keys, ngram, anchor_mask, min_words):
+    # (exact hashes, n-gram hashes) of a record's values for `keys`, as arrays of 8-byte
+    # blake2b digests in native byte order. Values are normalized to lower-case words. A
+    # value of min_words words or more hashes whole; n-grams of `ngram` words are hashed
+    # only where they start at an anchor word (one whose crc32 has no bits of anchor_mask
+    # set), so a shared passage shares its anchors on both sides while only a fraction of
+    # the n-grams is kept.
+    exact, grams = array('q'), array('q')
+    if not isinstance(record, dict):
+        return exact, grams
+    blake2b = hashlib.blake2b
+    for key in keys:
+        value = record.get(key)
+        if value is None:
+            continue
+        words = _WORD_RE.findall((value if isinstance(value, str) else str(value)).lower())
+        if len(words) < min_words:
+            continue
+        data = " ".join(words).encode('utf-8')
+        exact.frombytes(blake2b(data, digest_size=8).digest())
+        if len(words) < ngram:
+            continue
+        words = data.split(b" ")
+        anchors = itertools.compress(itertools.count(), map(operator.not_, map(
+            anchor_mask.__and__, map(zlib.crc32, words[:len(words) - ngram + 1]))))
+        grams.frombytes(b"".join([blake2b(b" ".join(words[i:i + ngram]), digest_size=8).digest() for i in anchors]))
+    return exact, grams
+
+
+class _SortedHashWriter:
+    """Writes a set of 8-byte hashes, sorted and without repeats, in bounded memory.
+
+    Up to SPILL_VALUES hashes are kept in memory. Past that they are sorted and
+    split into 256 temporary bucket files by their top byte, in signed order,
+    and write() then sorts one bucket at a time.
+    """
+    SPILL_VALUES = 4 * 1024 * 1024
+    BUCKETS = 256
+
+    def __init__(self):
+        self._values = array('q')
+        self._spill_dir = None
+
+    def add(self, values):
+        self._values.extend(values)
+        if len(self._values) >= self.SPILL_VALUES:
+            self._spill()
+
+    def _spill(self):
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix="jsonl-hashes-")
+        values = sorted(self._values)
+        self._values = array('q')
+        start = 0
+        for bucket in range(self.BUCKETS):
+            end = bisect_left(values, (bucket - self.BUCKETS // 2 + 1) << 56) if bucket < self.BUCKETS - 1 else len(values)
+            if end > start:
+                with open(os.path.join(self._spill_dir, str(bucket)), 'ab') as f:
+                    array('q', values[start:end]).tofile(f)
+            start = end
+
+    def write(self, f):
+        # Writes the hashes to `f` and returns how many there were.
+        if self._spill_dir is None:
+            values = array('q', sorted(set(self._values)))
+            values.tofile(f)
+            self._values = array('q')
+            return len(values)
+        self._spill()
+        count = 0
+        for bucket in range(self.BUCKETS):
+            path = os.path.join(self._spill_dir, str(bucket))
+            if not os.path.exists(path):
+                continue
+            values = array('q')
+            with open(path, 'rb') as spill:
+                values.frombytes(spill.read())
+            os.remove(path)
+            values = array('q', sorted(set(values)))
+            values.tofile(f)
+            count += len(values)
+        os.rmdir(self._spill_dir)
+        self._spill_dir = None
+        return count
+
+
+def _reference_chunk(path, start, end, keys, ngram, anchor_mask, min_words):
+    # map_chunks() worker of ReferenceIndex.build(): the hashes of one chunk's records.
+    exact, grams = array('q'), array('q')
+    records = invalid = 0
+    line_count = 0
+    with _map_file(path) as mm:
+        for starts, ends, line_numbers, _, line_count in _scan_lines(mm, start, end):
+            for line_start, line_end in zip(starts, ends):
+                try:
+                    record = json.loads(mm[line_start:line_end])
+                except ValueError:
+                    invalid += 1
+                    continue
+                records += 1
+                record_exact, record_grams = reference_hashes(record, keys, ngram, anchor_mask, min_words)
+                exact.extend(record_exact)
+                grams.extend(record_grams)
+    return line_count, (exact, grams, records, invalid)
+
+
+class ReferenceIndex:
+    """Hashes of the values of a reference dataset, such as a held-out eval set.
+
+    ``<file>.refindex`` holds two sorted arrays of 8-byte hashes: one per
+    normalized ``input`` and ``output`` value for exact matches, and one per
+    anchored word n-gram (see reference_hashes()) for overlapping passages. The
+    file is memory-mapped and searched with bisect, so a reference of millions
+    of rows opens at once and costs no memory beyond the page cache. It is
+    built by worker processes the first time, and again when the reference's
+    size or mtime changes. References in read-only places keep their index in
+    the temp directory.
+
+    The file is a JSON header, padded to HEADER_BYTES, followed by the arrays
+    in native byte order.
+    """
+    SUFFIX = ".refindex"
+    VERSION = 1
+    HEADER_BYTES = 4096
+    KEYS = ("input", "output")
+    NGRAM = 8 # Words per n-gram
+    ANCHOR_MASK = 3 # About one word in four starts an n-gram
+    MIN_WORDS = 4 # Shorter values ("yes", "4") are not worth flagging
+
+    def __init__(self, path, header, mm):
+        self.path = path
+        self.header = header
+        self._mm = mm
+        view = memoryview(mm)
+        exact_end = self.HEADER_BYTES + 8 * header["exact"]
+        self.exact = view[self.HEADER_BYTES:exact_end].cast('q')
+        self.grams = view[exact_end:exact_end + 8 * header["grams"]].cast('q')
+
+    @classmethod
+    def index_paths(cls, path):
+        # Where the index of `path` is looked for: next to it, then in the temp directory.
+        name = hashlib.blake2b(os.path.abspath(path).encode('utf-8'), digest_size=8).hexdigest()
+        return _sidecar_path(path, cls.SUFFIX), os.path.join(tempfile.gettempdir(), f"jsonl-{name}{cls.SUFFIX}")
+
+    @classmethod
+    def _stamp(cls, path):
+        return {"refindex": cls.VERSION, "byteorder": sys.byteorder, "source": list(_dataset_stat(path)), "keys": list(cls.KEYS),
+                "ngram": cls.NGRAM, "anchor_mask": cls.ANCHOR_MASK, "min_words": cls.MIN_WORDS}
+
+    @classmethod
+    def load(cls, path):
+        # The index of the reference at `path`, or None when there is none that is current.
+        stamp = cls._stamp(path)
+        for index_path in cls.index_paths(path):
+            try:
+                mm = _map_file(index_path)
+            except (OSError, ValueError):
+                continue
+            try:
+                header = json.loads(mm[:cls.HEADER_BYTES])
+                if all(header.get(key) == value for key, value in stamp.items()) and \
+                        len(mm) == cls.HEADER_BYTES + 8 * (header["exact"] + header["grams"]):
+                    return cls(path, header, mm)
+            except (ValueError, KeyError, TypeError):
+                pass
+            mm.close()
+        return None
+
+    @classmethod
+    def open(cls, path, task=None, workers=None):
+        # The index of the reference at `path`, built first unless a current one exists.
+        return cls.load(path) or cls.build(path, task, workers)
+
+    @classmethod
+    def build(cls, path, task=None, workers=None):
+        # Hashes every record of the reference in parallel chunks (see map_chunks) and writes
+        # the index. Raises _Cancelled when the task is cancelled.
+        header = cls._stamp(path)
+        exact, grams = _SortedHashWriter(), _SortedHashWriter()
+        records = invalid = 0
+        paths = dataset_files(path)
+        sizes = [os.path.getsize(shard_path) for shard_path in paths]
+        spools = {}
+
+        def data_paths():
+            for index, shard_path in enumerate(paths):
+                if compression_of(shard_path) is None:
+                    yield shard_path
+                else:
+                    spools[index] = _spool(shard_path)
+                    yield spools[index]
+
+        try:
+            args = (cls.KEYS, cls.NGRAM, cls.ANCHOR_MASK, cls.MIN_WORDS)
+            for index, end, _, (chunk_exact, chunk_grams, chunk_records, chunk_invalid) in map_chunks(
+                    data_paths(), _reference_chunk, args, workers, task):
+                for finished in [i for i in spools if i < index]:
+                    _remove_quietly(spools.pop(finished))
+                exact.add(chunk_exact)
+                grams.add(chunk_grams)
+                records += chunk_records
+                invalid += chunk_invalid
+                if task is not None: # Compressed files count once they are done
+                    done = sum(sizes[:index]) + (end if compression_of(paths[index]) is None else 0)
+                    task.post("progress", done, sum(sizes))
+        finally:
+            for spool in spools.values():
+                _remove_quietly(spool)
+
+        for index_path in cls.index_paths(path):
+            tmp_path = index_path + ".tmp"
+            try:
+                with open(tmp_path, 'wb') as f:
+                    f.write(bytes(cls.HEADER_BYTES))
+                    header["exact"] = exact.write(f)
+                    header["grams"] = grams.write(f)
+                    header["records"], header["invalid"] = records, invalid
+                    f.seek(0)
+                    f.write(json.dumps(header).encode('utf-8').ljust(cls.HEADER_BYTES - 1) + b"\n")
+                os.replace(tmp_path, index_path)
+            except OSError: # A read-only directory: try the next place
+                _remove_quietly(tmp_path)
+                continue
+            return cls.load(path)
+        raise OSError(f"could not write an index of {os.path.basename(path)}")
+
+    def close(self):
+        self.exact.release()
+        self.grams.release()
+        self._mm.close()
+
+    def check(self, exact, grams):
+        # 2 when one of the exact hashes is in the reference, 1 when one of the n-gram hashes
+        # is, else 0.
+        if any(_contains_sorted(self.exact, value) for value in exact):
+            return 2
+        if any(_contains_sorted(self.grams, value) for value in grams):
+            return 1
+        return 0
+
+
+class ContaminationIndex:
+    """Records whose input or output is found in reference datasets, kept current from store change events.
+
+    Each record id gets a flag: EXACT when a normalized value equals one in a
+    reference, OVERLAP when a value shares a word n-gram with one, else 0.
+    Only the flags are kept (one byte per record id); an edit rehashes the
+    record that changed and looks its hashes up in the mapped references.
+    Ids whose flag changed accumulate until take_changed().
+    """
+    EXACT = 2
+    OVERLAP = 1
+
+    def __init__(self, references):
+        self.references = list(references) # ReferenceIndex per reference file
+        self.store = None
+        self._flags = bytearray() # record id -> EXACT, OVERLAP or 0
+        self._count = 0
+        self._changed = set()
+
+    def build(self, store, task=None):
+        # Checks every record; safe on a worker thread while the store is not modified, then
+        # listen() keeps the flags current. False if cancelled.
+        self.store = store
+        total = len(store)
+        for n, record_id in enumerate(store.record_ids()):
+            if task is not None and n % 2000 == 0:
+                if task.cancelled():
+                    return False
+                task.post("progress", n, total)
+            self.add(record_id, store.peek(record_id))
+        self._changed.clear()
+        return True
+
+    def listen(self):
+        self.store.add_listener(self._on_change)
+
+    def detach(self):
+        self.store.remove_listener(self._on_change)
+
+    def close(self):
+        for reference in self.references:
+            reference.close()
+
+    def _hashes(self, record):
+        return reference_hashes(record, ReferenceIndex.KEYS, ReferenceIndex.NGRAM, ReferenceIndex.ANCHOR_MASK,
+                                ReferenceIndex.MIN_WORDS)
+
+    def matches(self, record):
+        # (reference index, flag) for each reference the record is found in.
+        exact, grams = self._hashes(record)
+        found = []
+        for reference in self.references:
+            flag = reference.check(exact, grams)
+            if flag:
+                found.append((reference, flag))
+        return found
+
+    def add(self, record_id, record):
+        # A record that is new to the store, such as a line appended to the file.
+        exact, grams = self._hashes(record)
+        flag = max((reference.check(exact, grams) for reference in self.references), default=0)
+        self._set(record_id, flag)
+
+    def _set(self, record_id, flag):
+        if record_id >= len(self._flags):
+            if not flag:
+                return
+            self._flags.extend(bytes(record_id + 1 - len(self._flags)))
+        old = self._flags[record_id]
+        if old != flag: # EXACT and OVERLAP rows are drawn differently, so either change counts
+            if bool(old) != bool(flag):
+                self._count += 1 if flag else -1
+            self._changed.add(record_id)
+            self._flags[record_id] = flag
+
+    def _on_change(self, kind, index, record_id, old, new):
+        if kind == "delete":
+            self._set(record_id, 0)
+            self._changed.discard(record_id)
+        else:
+            self.add(record_id, new)
+
+    def flag(self, record_id):
+        return self._flags[record_id] if record_id < len(self._flags) else 0
+
+    def is_contaminated(self, record_id):
+        return bool(self.flag(record_id))
+
+    def contaminated_count(self):
+        return self._count
+
+    def take_changed(self):
+        changed, self._changed = self._changed, set()
+        return changed
+
+
+class Dataset:
+    """A JSONL dataset as the editor and the command-line tools see it.
+
+    Wraps a LineIndexedStore together with the indexes that follow its change
+    events: duplicate inputs, the undo history and the autosave journal. Edit
+    through the store (``dataset.store``) and every index stays current. The
+    path may name a plain or compressed file, or a directory or glob pattern of
+    shards that is edited as one dataset.
+    """
+    KEY_INSTRUCTION = "instruction"
+    KEY_INPUT = "input"
+    KEY_OUTPUT = "output"
+    SEARCH_KEYS = (KEY_INSTRUCTION, KEY_INPUT, KEY_OUTPUT)
+    UNDO_MEMORY_BUDGET = 64 * 1024 * 1024 # Bytes of recorded changes kept for undo/redo
+    VIEW_FILTERS = ("all", "duplicates", "near_duplicates", "contaminated", "empty_instruction", "empty_input", "empty_output",
+                    "search")
+    VIEW_SORTS = ("position", "length", "instruction_length", "input_length", "output_length")
+
+    def __init__(self, store=None, undo_budget=UNDO_MEMORY_BUDGET):
+        self.store = store if store is not None else LineIndexedStore()
+        self.duplicates = DuplicateInputIndex(self.KEY_INPUT)
+        self.duplicates.attach(self.store)
+        self.history = EditHistory(undo_budget)
+        self.history.attach(self.store)
+        self.journal = EditJournal()
+        self.journal.attach(self.store, self.store.path)
+        self.near_duplicates = None # NearDuplicateIndex once near-duplicate detection is turned on
+        self.contamination = None # ContaminationIndex once reference files are attached
+        self.stats = None # DatasetStats once statistics are asked for
+        self.search = SearchIndex(self.SEARCH_KEYS)
+        self.search.attach(self.store)
+        self.invalid_lines = [] # RecordDecodeError per line left out by scan(); dropped on save
+        self.view = None # RecordView while the rows are filtered or sorted
+
+    @classmethod
+    def open(cls, path, **kwargs):
+        # Indexes and validates the whole file before returning.
+        return cls(LineIndexedStore.open(path), **kwargs)
+
+    @classmethod
+    def map(cls, path, **kwargs):
+        # Maps the file only; feed it with scan() batches passed to extend_scanned().
+        return cls(LineIndexedStore.map(path), **kwargs)
+
+    def scan(self, task, workers=None, use_cache=True):
+        # Worker side of a background load. Invalid lines do not stop it: they are left out
+        # of the dataset and reported. Returns (search index, invalid lines) to be installed
+        # with finish_scan() on the Tk thread, or None if cancelled. Datasets of
+        # PARALLEL_SCAN_BYTES or more on disk are scanned by `workers` processes (default:
+        # one per core); compressed shards are decompressed to temporary files on the way.
+        # Datasets of ScanCache.MIN_BYTES or more keep a ScanCache next to them, and only
+        # what changed since it was written is scanned.
+        search = SearchIndex(self.SEARCH_KEYS)
+        errors = []
+        workers = workers or os.cpu_count() or 1
+        source = self.store._source
+        cache = None
+        if use_cache and self.store.file_size >= ScanCache.MIN_BYTES:
+            cache = ScanCache.load(self.path, self.KEY_INPUT, self.SEARCH_KEYS)
+            task = _RecordingTask(task)
+        resume = None
+        if cache is not None:
+            try:
+                resume = cache.replay(source, task, search, errors)
+            except _Cancelled:
+                return None
+            if resume[0] >= len(source.shards): # Nothing changed
+                return search, errors
+        first, start = resume[:2] if resume else (0, 0)
+        remaining = sum(shard.disk_size for shard in source.shards[first:])
+        if source.shards[first:] and not source.shards[first].compressed:
+            remaining -= start
+        if workers > 1 and remaining >= PARALLEL_SCAN_BYTES:
+            done = parallel_scan_records(self.store, self.KEY_INPUT, task, search, errors, workers, resume)
+        else:
+            done = scan_and_hash_records(self.store, self.KEY_INPUT, task, search=search, errors=errors, resume=resume)
+        if not done:
+            return None
+        if isinstance(task, _RecordingTask):
+            ScanCache.write(self.path, source, self.KEY_INPUT, self.SEARCH_KEYS, task.rows, errors, search)
+        return search, errors
+
+    def finish_scan(self, result):
+        search, self.invalid_lines = result
+        self.set_search(search)
+        self.store.mark_changed(e.path for e in self.invalid_lines) # Saving drops them
+
+    def set_search(self, search):
+        self.search.detach()
+        search.store = self.store
+        search.listen()
+        self.search = search
+
+    def extend_scanned(self, starts, ends, line_numbers, hashes, shard=0):
+        first_id = self.store.extend_scanned(starts, ends, line_numbers, shard)
+        self.duplicates.add_hashes(first_id, hashes)
+        if self.view is not None:
+            self.view.extend(first_id, len(starts))
+        return first_id
+
+    @property
+    def path(self):
+        return self.store.path
+
+    def __len__(self):
+        return len(self.store)
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __getitem__(self, index):
+        return self.store[index]
+
+    def is_duplicate(self, index):
+        return self.duplicates.is_duplicate(self.store.record_id(index))
+
+    def build_near_duplicates(self, threshold, task=None):
+        # Returns a NearDuplicateIndex over the current records, or None if cancelled; install
+        # it with set_near_duplicates(). Safe on a worker thread while the store is not
+        # modified. Signatures of the installed index are reused.
+        index = NearDuplicateIndex(self.KEY_INPUT, threshold)
+        if not index.build(self.store, task, signatures_from=self.near_duplicates):
+            return None
+        return index
+
+    def build_contamination(self, paths, task=None, workers=None):
+        # Returns a ContaminationIndex of the current records against the reference files at
+        # `paths`, or None if cancelled; install it with set_contamination(). References
+        # without a current index are indexed first. Safe on a worker thread while the store
+        # is not modified.
+        references = []
+        index = None
+        try:
+            for path in paths:
+                references.append(ReferenceIndex.open(path, task, workers))
+            built = ContaminationIndex(references)
+            if built.build(self.store, task):
+                index = built
+        except _Cancelled:
+            pass
+        finally:
+            if index is None:
+                for reference in references:
+                    reference.close()
+        return index
+
+    def build_stats(self, task=None):
+        # Returns DatasetStats of the current records, or None if cancelled; install them with
+        # set_stats(). Safe on a worker thread while the store is not modified.
+        stats = DatasetStats(self.duplicates, self.SEARCH_KEYS)
+        return stats if stats.build(self.store, task) else None
+
+    def find(self, query, mode="token", task=None):
+        # Dataset positions of the records matching the query. Token and phrase queries use
+        # the search index; regex queries scan every record (None if cancelled).
+        if mode == "regex":
+            record_ids = scan_regex(self.store, self.SEARCH_KEYS, re.compile(query), task)
+            if record_ids is None:
+                return None
+        else:
+            record_ids = self.search.search(query, mode)
+        return self.store.positions(record_ids)
+
+    # --- Batch operations; the caller opens one undo step for each ---
+    def move(self, positions, target):
+        # Moves the records at `positions` in front of the record at position `target`
+        # (len(self) for the end), keeping their order, with one delete_many() and one
+        # insert_many(). Moved records are re-added, so they get new record ids. Returns the
+        # positions they end up at.
+        positions = sorted(set(positions))
+        records = [self.store[position] for position in positions]
+        target -= bisect_left(positions, target) # Moved records before the target no longer count
+        self.store.delete_many(positions)
+        moved = range(target, target + len(records))
+        self.store.insert_many(zip(moved, records))
+        return moved
+
+    def later_duplicates(self):
+        # Positions of the records whose input repeats the input of an earlier record;
+        # deleting them keeps the first of each duplicate group. Nothing is decoded.
+        duplicates = self.duplicates
+        seen = set()
+        later = []
+        for position, record_id in enumerate(self.store.record_ids()):
+            if duplicates.is_duplicate(record_id):
+                value_hash = duplicates.hash_of(record_id)
+                if value_hash in seen:
+                    later.append(position)
+                else:
+                    seen.add(value_hash)
+        return later
+
+    def find_replacements(self, pattern, replacement, keys=SEARCH_KEYS, positions=None, task=None):
+        # (record id, edited copy) for each record where the compiled `pattern` matches a string
+        # value of one of `keys`, with re.sub() applied to those values; only the records at
+        # `positions` when given. Apply the edits with replace_records(). Safe on a worker
+        # thread while the store is not modified; None if cancelled.
+        store = self.store
+        record_ids = store.record_ids() if positions is None else [store.record_id(p) for p in positions]
+        total = len(store) if positions is None else len(positions)
+        edits = []
+        for n, record_id in enumerate(record_ids):
+            if task is not None and n % 5000 == 0:
+                if task.cancelled():
+                    return None
+                task.post("progress", n, total)
+            record = store.peek(record_id)
+            if not isinstance(record, dict):
+                continue
+            edited = None
+            for key in keys:
+                value = record.get(key)
+                if isinstance(value, str):
+                    new_value = pattern.sub(replacement, value)
+                    if new_value != value:
+                        edited = edited or dict(record)
+                        edited[key] = new_value
+            if edited is not None:
+                edits.append((record_id, edited))
+        return edits
+
+    def replace_records(self, edits):
+        # Writes (record id, record) pairs back with one pass over the order to find their
+        # positions. Returns the positions.
+        edits = dict(edits)
+        positions = []
+        for position, record_id in enumerate(self.store.record_ids()):
+            if record_id in edits:
+                positions.append(position)
+        for position in positions:
+            self.store[position] = edits[self.store.record_id(position)]
+        return positions
+
+    def build_view(self, filter="all", sort="position", descending=False, query=None, mode="token", task=None):
+        # Returns a RecordView of the records passing `filter` (see VIEW_FILTERS), in dataset
+        # order or by the character count of one field or all three (VIEW_SORTS), or None if
+        # cancelled; install it with set_view(). Safe on a worker thread while the store is
+        # not modified.
+        store = self.store
+        members = None
+        if filter == "all":
+            predicate = None
+        elif filter == "duplicates":
+            predicate = self.duplicates.is_duplicate
+        elif filter == "near_duplicates":
+            predicate = lambda record_id: self.near_duplicates is not None and self.near_duplicates.is_duplicate(record_id)
+        elif filter == "contaminated":
+            predicate = lambda record_id: self.contamination is not None and self.contamination.is_contaminated(record_id)
+        elif filter.startswith("empty_") and filter in self.VIEW_FILTERS:
+            key = filter[len("empty_"):]
+            predicate = lambda record_id: not _field_text(store.peek(record_id), key).strip()
+        elif filter == "search":
+            predicate = self._search_predicate(query, mode)
+            if mode != "regex": # The index already knows the matches; edits are checked one by one
+                members = self.search.search(query, mode)
+        else:
+            raise ValueError(f"unknown view filter: {filter}")
+        if sort == "position":
+            sort_key = None
+        elif sort in self.VIEW_SORTS:
+            keys = self.SEARCH_KEYS if sort == "length" else (sort[:-len("_length")],)
+
+            def sort_key(record_id):
+                record = store.peek(record_id)
+                return sum(len(_field_text(record, key)) for key in keys)
+        else:
+            raise ValueError(f"unknown view sort: {sort}")
+        view = RecordView(predicate, sort_key, descending)
+        if not view.build(store, task, members):
+            return None
+        return view
+
+    def _search_predicate(self, query, mode):
+        # The test SearchIndex.search() and scan_regex() apply, for one record at a time.
+        store = self.store
+        if mode == "regex":
+            pattern = re.compile(query)
+            return lambda record_id: _regex_matches(store.peek(record_id), self.SEARCH_KEYS, pattern)
+        words = SearchIndex.words(query)
+        wanted = set(words)
+        phrase = f" {' '.join(words)} " if mode == "phrase" and len(words) > 1 else None
+
+        def matches(record_id):
+            record = store.peek(record_id)
+            if not wanted or not wanted <= self.search.record_words(record):
+                return False
+            return phrase is None or self.search._has_phrase(record, phrase)
+        return matches
+
+    def set_view(self, view):
+        if self.view is not None:
+            self.view.detach()
+        self.view = view
+        if view is not None:
+            view.listen()
+
+    def set_near_duplicates(self, index):
+        if self.near_duplicates is not None:
+            self.near_duplicates.detach()
+        self.near_duplicates = index
+        if index is not None:
+            index.listen()
+
+    def set_contamination(self, index):
+        if self.contamination is not None:
+            self.contamination.detach()
+            self.contamination.close()
+        self.contamination = index
+        if index is not None:
+            index.listen()
+
+    def set_stats(self, stats):
+        if self.stats is not None:
+            self.stats.detach()
+        self.stats = stats
+        if stats is not None:
+            stats.listen()
+
+    def save(self, path=None):
+        path = path or self.path
+        self.store.save(path)
+        self.journal.reset(path)
+        self.invalid_lines = []
+
+    def close(self):
+        self.set_contamination(None)
+        self.store.close()
+
+
+class TailFollower:
+    """Takes in the lines another program appends to a dataset's file (follow mode).
+
+    poll() maps the file again when it grew and scans only the new bytes, up
+    to the last complete line; a line still being written is read once its
+    newline arrives. New records go to the end of the dataset and into its
+    duplicate, near-duplicate, contamination and search indexes and its
+    statistics, but not into the undo history or the journal: they are part of
+    the file. Only a single uncompressed file can be followed. Saving while
+    following is safe: the store refuses to write over lines it has not seen
+    (FileChangedError), and the follower picks up again after the rewrite.
+    """
+    BATCH_BYTES = 8 * 1024 * 1024 # Most bytes scanned per poll, so one poll never blocks for long
+
+    def __init__(self, dataset):
+        source = dataset.store._source
+        if len(source.shards) != 1 or source.shards[0].compressed:
+            raise ValueError("Only a single uncompressed file can be followed")
+        self.dataset = dataset
+        self.shard = source.shards[0]
+        self.position = 0 # End of the complete lines taken in so far
+        self.lines = 0 # Lines of the file before position, blank and invalid ones included
+        self._mm = None # Mapping position refers to; a save maps a new file
+        self._tail = b"" # Last bytes before position as they were read, to tell a rewritten file
+
+    def _reset(self):
+        source = self.dataset.store._source
+        mm = self._mm = self.shard.mm
+        self._tail = b""
+        if mm is None:
+            self.position = self.lines = 0
+            return
+        size = len(mm)
+        tail = mm.rfind(b"\n") + 1
+        starts = source.starts
+        last = starts.index(max(starts)) if starts else None # Record with the last line in the file
+        if last is not None and starts[last] < 0:
+            last = None
+        if last is not None and tail < size and starts[last] >= tail:
+            # The final line has no newline but is a whole record
+            self.position, self.lines = size, source.line_numbers[last]
+            self._tail = mm[max(0, size - 64):size]
+            return
+        self.position = tail
+        self._tail = mm[max(0, tail - 64):tail]
+        if last is None:
+            self.lines = mm[:tail].count(b"\n")
+        else:
+            self.lines = source.line_numbers[last] - 1 + mm[starts[last]:tail].count(b"\n")
+        # A final line that did not parse may be incomplete; it is read again once it is
+        self.dataset.invalid_lines = [e for e in self.dataset.invalid_lines if e.line_number <= self.lines]
+
+    def poll(self, max_bytes=BATCH_BYTES):
+        # Returns (records added, invalid lines found). Raises FileChangedError when the file
+        # no longer starts with what was read (truncated or replaced).
+        dataset = self.dataset
+        shard = self.shard
+        if shard.mm is not self._mm:
+            self._reset()
+        size = os.path.getsize(shard.path)
+        if size != shard.size:
+            # Checked before the old mapping is read: its pages past a truncation are gone,
+            # and after a rewrite in place they show the new bytes.
+            if size < self.position:
+                raise FileChangedError(f"{os.path.basename(shard.path)} was truncated")
+            shard.remap()
+            self._mm = shard.mm
+            if shard.mm is not None and shard.mm[max(0, self.position - 64):self.position] != self._tail:
+                raise FileChangedError(f"{os.path.basename(shard.path)} was replaced")
+            dataset.journal.restamp()
+        mm = shard.mm
+        if mm is None or self.position >= len(mm):
+            return 0, []
+        limit = min(len(mm), self.position + max_bytes)
+        stop = mm.rfind(b"\n", self.position, limit)
+        if stop == -1:
+            stop = mm.find(b"\n", limit) # One line longer than max_bytes
+            if stop == -1:
+                return 0, []
+        end = stop + 1
+        errors = []
+        added = 0
+        near = dataset.near_duplicates
+        contamination = dataset.contamination
+        stats = dataset.stats
+        for starts, ends, line_numbers, _, lines in _scan_lines(mm, self.position, end):
+            if self.lines:
+                line_numbers = array('q', map(self.lines.__add__, line_numbers))
+            batch = _decode_lines(mm, starts, ends, line_numbers, dataset.KEY_INPUT, dataset.search,
+                                  dataset.store._source.next_id, errors)
+            first_id = dataset.extend_scanned(*batch)
+            added += len(batch[0])
+            followers = [index for index in (near, contamination, stats) if index is not None]
+            if followers:
+                for record_id in range(first_id, first_id + len(batch[0])):
+                    record = dataset.store.peek(record_id)
+                    for index in followers:
+                        index.add(record_id, record)
+        self.lines += lines
+        self.position = end
+        self._tail = mm[max(0, end - 64):end]
+        if errors:
+            dataset.invalid_lines.extend(errors)
+            dataset.store.mark_changed([None]) # Saving drops them
+        return added, errors
+
+
+# --- Streaming helpers: one line in memory at a time, for files of any size ---
+
+
+def iter_lines(path):
+    # Yields (line_number, line) for every non-blank line, stripped, as bytes. Compressed
+    # files are decompressed as they are read.
+    with open_data_file(path) as f:
+        for line_number, line in enumerate(f, 1):
+            if line_number == 1 and line.startswith(b"\xef\xbb\xbf"):
+                line = line[3:]
+            line = line.strip()
+            if line:
+                yield line_number, line
+
+
+def iter_records(path, errors=None):
+    # Yields (line_number, line, record). Invalid lines raise RecordDecodeError, or are
+    # collected into `errors` and skipped when a list is given.
+    for line_number, line in iter_lines(path):
+        try:
+            record = decode_line(line, line_number)
+        except RecordDecodeError as e:
+            if errors is None:
+                raise
+            errors.append(e)
+            continue
+        yield line_number, line, record
+
+
+def dedupe_records(records, key=Dataset.KEY_INPUT, removed=None, near_threshold=None):
+    # Keeps the first record of each normalised `key` value, with the editor's rule
+    # (stripped, non-empty). Memory grows with the number of distinct values (8-byte
+    # hashes), not with the size of the records. Line numbers of dropped records are
+    # appended to `removed` when a list is given. With near_threshold, records that are
+    # near-duplicates of a kept one are dropped as well (MinHash signatures of the kept
+    # records, about 200 bytes each).
+    seen = set()
+    near = NearDuplicateIndex(key, near_threshold) if near_threshold else None
+    kept = 0
+    for line_number, line, record in records:
+        value_hash = DuplicateInputIndex.value_hash(record, key)
+        if value_hash:
+            if value_hash in seen:
+                if removed is not None:
+                    removed.append(line_number)
+                continue
+            seen.add(value_hash)
+        if near is not None:
+            if not near.add_unique(kept, record):
+                if removed is not None:
+                    removed.append(line_number)
+                continue
+        kept += 1
+        yield line_number, line, record
+
+
+def split_records(records, ratios, seed=0, by_content=False, key=None):
+    # Yields (part_index, line_number, line, record), assigning each record to a part at
+    # random with the given ratios; the same seed gives the same split. With by_content the
+    # draw is a hash of the record instead (see content_draw), so a record lands in the
+    # same part in every version of the dataset and copies of it share a part.
+    rng = random.Random(seed)
+    total = float(sum(ratios))
+    bounds = []
+    acc = 0.0
+    for ratio in ratios:
+        acc += ratio / total
+        bounds.append(acc)
+    bounds[-1] = 1.0
+    for line_number, line, record in records:
+        draw = content_draw(record, seed, key) if by_content else rng.random()
+        part = next(i for i, bound in enumerate(bounds) if draw < bound)
+        yield part, line_number, line, record
+
+
+def content_draw(record, seed=0, key=None):
+    # A number in [0, 1) fixed by the record's content and the seed: a hash of the record
+    # as canonical JSON (sorted keys, no spaces), or of the stripped value of `key` alone,
+    # so that editing other fields keeps the record where it was.
+    if key is None:
+        text = json.dumps(record, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    else:
+        text = _field_text(record, key).strip()
+    digest = hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=8, key=str(seed).encode()).digest()
+    return int.from_bytes(digest, 'little') / 2.0 ** 64
+
+
+class RecordStats:
+    """Running per-field statistics over a stream of records.
+
+    Whatever add() counts, remove() takes back, so the statistics of an edited
+    dataset can be kept current without a rescan (see DatasetStats). Lengths
+    are counted per distinct length rather than per record, which stays small
+    and keeps the longest value and the histograms exact after removals.
+    Token counts are estimates: one token per TOKEN_CHARS characters. A value
+    counts as empty when Dataset.build_view() would list it under empty_*, so
+    missing ones are counted both as missing and as empty. Counting duplicate
+    inputs and repeated instructions keeps a hash of every distinct value;
+    without them (count_inputs, count_instructions) memory does not grow with
+    the records. count_values() counts them in files of any size.
+    """
+    TOKEN_CHARS = 4 # Characters per token; close for English text with the common BPE tokenizers
+    TOP_INSTRUCTIONS = 10
+    PREVIEW_CHARS = 200 # Characters kept of each repeated instruction
+
+    def __init__(self, keys=(Dataset.KEY_INSTRUCTION, Dataset.KEY_INPUT, Dataset.KEY_OUTPUT), count_inputs=True,
+                 count_instructions=True):
+        self.keys = tuple(keys)
+        self.records = 0
+        self.missing = dict.fromkeys(self.keys, 0)
+        self.empty = dict.fromkeys(self.keys, 0)
+        self.total_chars = dict.fromkeys(self.keys, 0)
+        self.total_tokens = dict.fromkeys(self.keys, 0)
+        self.lengths = {key: Counter() for key in self.keys} # key -> {length in characters: values}
+        self.duplicate_inputs = 0 # Records repeating an earlier input
+        self._inputs = Counter() if count_inputs else None # input hash -> records
+        self._instructions = Counter() if count_instructions else None # instruction hash -> records
+        self._repeated = {} # instruction hash -> text, for instructions of two or more records
+
+    @classmethod
+    def estimate_tokens(cls, length):
+        return -(-length // cls.TOKEN_CHARS)
+
+    def add(self, record):
+        self._count(record, 1)
+
+    def remove(self, record):
+        # Takes back an earlier add() of the record, such as the old version of an edited one.
+        self._count(record, -1)
+
+    def _count(self, record, step):
+        self.records += step
+        for key in self.keys:
+            text = _field_text(record, key)
+            if not text.strip(): # Missing, null or blank: what the empty_* views list
+                self.empty[key] += step
+            if not isinstance(record, dict) or key not in record:
+                self.missing[key] += step
+                continue
+            length = len(text)
+            self.total_chars[key] += step * length
+            self.total_tokens[key] += step * self.estimate_tokens(length)
+            self._tally(self.lengths[key], length, step)
+        if self._inputs is not None:
+            value_hash = DuplicateInputIndex.value_hash(record, Dataset.KEY_INPUT)
+            if value_hash and self._tally(self._inputs, value_hash, step) > 1:
+                self.duplicate_inputs += step
+        if self._instructions is None:
+            return
+        value_hash = DuplicateInputIndex.value_hash(record, Dataset.KEY_INSTRUCTION)
+        if value_hash and self._tally(self._instructions, value_hash, step) == 2:
+            if step > 0:
+                self._repeated[value_hash] = str(record[Dataset.KEY_INSTRUCTION]).strip()[:self.PREVIEW_CHARS]
+            else:
+                del self._repeated[value_hash]
+
+    @staticmethod
+    def _tally(counts, value, step):
+        # Adds step to the count of value, dropping it at zero. Returns the larger of the
+        # counts before and after, so both directions of a change see the same number.
+        count = counts[value] + step
+        if count:
+            counts[value] = count
+        else:
+            del counts[value]
+        return max(count, count - step)
+
+    def histogram(self, key):
+        # [(shortest, longest, values)] of `key` over length ranges that double: 0, 1, 2-3,
+        # 4-7, ..., from the range of the shortest value to that of the longest.
+        bins = Counter()
+        for length, count in self.lengths[key].items():
+            bins[length.bit_length()] += count
+        if not bins:
+            return []
+        return [(1 << b >> 1, (1 << b) - 1, bins[b]) for b in range(min(bins), max(bins) + 1)]
+
+    def top_instructions(self, count=TOP_INSTRUCTIONS):
+        # [(text, records)] of the instructions shared by the most records, most first.
+        counts, texts = self._instructions, self._repeated
+        top = heapq.nsmallest(count, texts, key=lambda value_hash: (-counts[value_hash], texts[value_hash]))
+        return [(texts[value_hash], counts[value_hash]) for value_hash in top]
+
+    def group_sizes(self):
+        # {records sharing an input: number of such inputs}, smallest groups first.
+        if self._inputs is None:
+            return {}
+        return dict(sorted(Counter(count for count in self._inputs.values() if count > 1).items()))
+
+    def summary(self):
+        fields = {}
+        for key in self.keys:
+            present = self.records - self.missing[key]
+            fields[key] = {
+                "missing": self.missing[key],
+                "empty": self.empty[key],
+                "mean_chars": round(self.total_chars[key] / present, 1) if present else 0,
+                "max_chars": max(self.lengths[key], default=0),
+                "tokens": self.total_tokens[key],
+                "mean_tokens": round(self.total_tokens[key] / present, 1) if present else 0,
+                "histogram": self.histogram(key),
+            }
+        return {"records": self.records, "duplicate_inputs": self.duplicate_inputs,
+                "tokens": sum(self.total_tokens.values()), "fields": fields,
+                "duplicate_groups": self.group_sizes(),
+                "top_instructions": [{"instruction": text, "records": records}
+                                     for text, records in self.top_instructions()]}
+
+
+class DatasetStats:
+    """RecordStats of a store's records, kept current from store change events.
+
+    build() counts every record once, on a worker thread. After that an edit
+    takes the old version of its record out of the counts and puts the new one
+    in, so the statistics never need a rescan. Duplicate groups come from the
+    dataset's DuplicateInputIndex, which tracks them already. `version` changes
+    with every update, so a view can tell when to redraw.
+    """
+
+    def __init__(self, duplicates, keys=Dataset.SEARCH_KEYS):
+        self.duplicates = duplicates
+        self.stats = RecordStats(keys, count_inputs=False)
+        self.store = None
+        self.version = 0
+
+    def build(self, store, task=None):
+        # Counts every record; safe on a worker thread while the store is not modified, then
+        # listen() keeps the counts current. False if cancelled.
+        self.store = store
+        total = len(store)
+        for n, record_id in enumerate(store.record_ids()):
+            if task is not None and n % 2000 == 0:
+                if task.cancelled():
+                    return False
+                task.post("progress", n, total)
+            self.stats.add(store.peek(record_id))
+        return True
+
+    def listen(self):
+        self.store.add_listener(self._on_change)
+
+    def detach(self):
+        self.store.remove_listener(self._on_change)
+
+    def add(self, record_id, record):
+        # A record that is new to the store, such as a line appended to the file.
+        self.stats.add(record)
+        self.version += 1
+
+    def _on_change(self, kind, index, record_id, old, new):
+        if kind != "insert":
+            self.stats.remove(old)
+        if kind != "delete":
+            self.stats.add(new)
+        self.version += 1
+
+    def summary(self):
+        # RecordStats.summary(), with the duplicate counts of the dataset's duplicate index.
+        summary = self.stats.summary()
+        groups = self.duplicates.group_sizes()
+        summary["duplicate_inputs"] = sum((size - 1) * count for size, count in groups.items())
+        summary["duplicate_groups"] = groups
+        return summary
+
+
+# --- Deduplicating files larger than memory: hash-partitioned buckets on disk ---
+DEDUPE_MEMORY_BUDGET = 1024 * 1024 * 1024 # Default bytes dedupe_file() may use across its processes
+_DEDUPE_BUCKETS = 256 # By the top byte of the value hash
+_DEDUPE_ENTRY_BYTES = 100 # Memory per distinct hash remembered by a bucket worker (int and set slot)
+_DEDUPE_BLOCK_BYTES = 16 * 1024 * 1024 # Bytes of a bucket file read at a time
+
+
+def _dedupe_hash_chunk(path, start, end, key):
+    # map_chunks() worker of dedupe_file(): (value hash, line number) pairs of the records
+    # with a non-empty `key`, split into _DEDUPE_BUCKETS arrays, and the invalid lines.
+    # Line numbers count from the start of the chunk.
+    buckets = [array('q') for _ in range(_DEDUPE_BUCKETS)]
+    problems = [] # RecordDecodeError per invalid line
+    value_hash = DuplicateInputIndex.value_hash
+    line_count = 0
+    with _map_file(path) as mm:
+        for starts, ends, line_numbers, _, line_count in _scan_lines(mm, start, end):
+            for line_start, line_end, line_number in zip(starts, ends, line_numbers):
+                try:
+                    record = decode_line(mm[line_start:line_end], line_number)
+                except RecordDecodeError as e:
+                    problems.append(e)
+                    continue
+                record_hash = value_hash(record, key)
+                if record_hash:
+                    buckets[(record_hash >> 56) + 128].extend((record_hash, line_number))
+    return line_count, (buckets, problems)
+
+
+def _dedupe_bucket(bucket_path, max_entries):
+    # Worker of dedupe_file(): the line numbers, in one bucket file, of the records whose
+    # value hash is on an earlier line. The file holds (hash, line number) pairs in file
+    # order, the line numbers counting from the last (0, first line of the chunk) pair. A
+    # bucket of more than max_entries pairs is read in several passes, each remembering the
+    # hashes of one share of the values.
+    passes = max(1, -(-os.path.getsize(bucket_path) // 16 // max_entries))
+    removed = array('q')
+    for part in range(passes):
+        seen = set()
+        base = 0
+        with open(bucket_path, 'rb') as f:
+            while True:
+                block = array('q', f.read(_DEDUPE_BLOCK_BYTES))
+                if not block:
+                    break
+                for record_hash, line_number in zip(block[::2], block[1::2]):
+                    if not record_hash:
+                        base = line_number
+                    elif passes == 1 or record_hash % passes == part:
+                        if record_hash in seen:
+                            removed.append(base + line_number)
+                        else:
+                            seen.add(record_hash)
+    os.remove(bucket_path)
+    return removed
+
+
+def dedupe_file(path, out, key=Dataset.KEY_INPUT, report=None, errors=None, memory_budget=DEDUPE_MEMORY_BUDGET,
+                workers=None, task=None):
+    # Writes the first record of each normalised `key` value to the binary file `out`, with
+    # the rule of dedupe_records() and the same output, for files of any number of distinct
+    # values. Records are hashed in parallel chunks (see map_chunks) into bucket files in the
+    # temp directory, split by hash, so equal values share a bucket; worker processes then
+    # find the later copies within each bucket, and a last pass copies the other lines in
+    # file order. Besides the buckets on disk (16 bytes per record), memory stays near
+    # memory_budget bytes: a bit per line for the removed ones, the rest shared by the
+    # bucket workers. Line numbers of dropped records are written to the text file `report`
+    # in order. Invalid lines raise RecordDecodeError, or are collected into `errors` and
+    # left out. Returns (kept, removed); raises _Cancelled when the task is cancelled.
+    data_path = _spool(path) if compression_of(path) is not None else path
+    bucket_dir = tempfile.mkdtemp(prefix="jsonl-dedupe-")
+    bucket_paths = [os.path.join(bucket_dir, str(bucket)) for bucket in range(_DEDUPE_BUCKETS)]
+    size = os.path.getsize(data_path)
+    workers = workers or os.cpu_count() or 1
+    try:
+        # Pass 1: hash every record into the buckets
+        invalid, last_line = _hash_into_buckets(data_path, bucket_paths, key, errors, workers, task, 3 * size)
+
+        # Pass 2: the later copies within each bucket, one bucket per worker at a time
+        removed = bytearray(last_line // 8 + 1) # Bit per line number
+        max_entries = max(64 * 1024, (memory_budget - len(removed)) // workers // _DEDUPE_ENTRY_BYTES)
+        removed_count = 0
+        for done, lines in enumerate(_map_buckets(_dedupe_bucket, bucket_paths, (max_entries,), workers, task), 1):
+            for line_number in lines:
+                removed[line_number >> 3] |= 1 << (line_number & 7)
+            removed_count += len(lines)
+            if task is not None:
+                task.post("progress", size + size * done // _DEDUPE_BUCKETS, 3 * size)
+
+        # Pass 3: copy the records that were kept
+        kept = 0
+        with _map_file(data_path) as mm:
+            start = 3 if mm[:3] == b"\xef\xbb\xbf" else 0
+            for starts, ends, line_numbers, position, _ in _scan_lines(mm, start, len(mm)):
+                if task is not None:
+                    if task.cancelled():
+                        raise _Cancelled()
+                    task.post("progress", 2 * size + position, 3 * size)
+                for line_start, line_end, line_number in zip(starts, ends, line_numbers):
+                    if line_number <= last_line and removed[line_number >> 3] >> (line_number & 7) & 1:
+                        if report is not None:
+                            report.write(f"{line_number}\n")
+                    elif line_number not in invalid:
+                        out.write(mm[line_start:line_end].strip())
+                        out.write(b"\n")
+                        kept += 1
+        return kept, removed_count
+    finally:
+        shutil.rmtree(bucket_dir, ignore_errors=True)
+        if data_path != path:
+            _remove_quietly(data_path)
+
+
+def count_values(path, key=Dataset.KEY_INPUT, top=0, errors=None, memory_budget=DEDUPE_MEMORY_BUDGET, workers=None,
+                 task=None):
+    # Counts the records sharing each normalised `key` value, with the rule of
+    # dedupe_records(), for files of any number of distinct values: the records are hashed
+    # into buckets on disk as by dedupe_file(), and worker processes count each bucket
+    # within memory_budget. Returns ({records sharing a value: number of such values},
+    # smallest groups first, and [(records, line number)] of the first record of each of
+    # the `top` values shared by the most records, most first and ties in file order).
+    # Invalid lines raise RecordDecodeError, or are collected into `errors`.
+    data_path = _spool(path) if compression_of(path) is not None else path
+    bucket_dir = tempfile.mkdtemp(prefix="jsonl-count-")
+    bucket_paths = [os.path.join(bucket_dir, str(bucket)) for bucket in range(_DEDUPE_BUCKETS)]
+    size = os.path.getsize(data_path)
+    workers = workers or os.cpu_count() or 1
+    try:
+        _hash_into_buckets(data_path, bucket_paths, key, errors, workers, task, 2 * size)
+        max_entries = max(64 * 1024, memory_budget // workers // _DEDUPE_ENTRY_BYTES)
+        groups = Counter()
+        best = [] # (-records, line number)
+        for done, (bucket_groups, bucket_best) in enumerate(
+                _map_buckets(_count_bucket, bucket_paths, (max_entries, top), workers, task), 1):
+            groups.update(bucket_groups)
+            best = heapq.nsmallest(top, itertools.chain(best, bucket_best))
+            if task is not None:
+                task.post("progress", size + size * done // _DEDUPE_BUCKETS, 2 * size)
+        return dict(sorted(groups.items())), [(-records, line_number) for records, line_number in best]
+    finally:
+        shutil.rmtree(bucket_dir, ignore_errors=True)
+        if data_path != path:
+            _remove_quietly(data_path)
+
+
+def _hash_into_buckets(data_path, bucket_paths, key, errors, workers, task, total):
+    # First pass of dedupe_file() and count_values(): the (value hash, line number) pairs of
+    # the records, hashed in parallel chunks, appended in file order to the bucket file of
+    # each hash (see _dedupe_bucket for the layout). Progress counts the bytes read out of
+    # `total`. Returns (line numbers of invalid lines, largest line number in a bucket).
+    invalid = set()
+    last_line = 0
+    bucket_files = [open(bucket_path, 'wb') for bucket_path in bucket_paths]
+    try:
+        for _, end, first_line, (buckets, problems) in map_chunks(data_path, _dedupe_hash_chunk, (key,), workers, task):
+            for e in problems:
+                e.line_number += first_line
+                if errors is None:
+                    raise RecordDecodeError(e.line_number, e.line_text, e.error)
+                errors.append(RecordDecodeError(e.line_number, e.line_text, e.error))
+                invalid.add(e.line_number)
+            for f, bucket in zip(bucket_files, buckets):
+                if bucket:
+                    array('q', (0, first_line)).tofile(f)
+                    bucket.tofile(f)
+                    last_line = max(last_line, first_line + bucket[-1])
+            if task is not None:
+                task.post("progress", end, total)
+    finally:
+        for f in bucket_files:
+            f.close()
+    return invalid, last_line
+
+
+def _count_bucket(bucket_path, max_entries, top):
+    # Worker of count_values(): ({records sharing a value: number of such values} of the
+    # values in one bucket file that more than one record shares, and [(-records, line
+    # number of the first)] of the `top` shared by the most). Passes as in _dedupe_bucket.
+    passes = max(1, -(-os.path.getsize(bucket_path) // 16 // max_entries))
+    groups = Counter()
+    best = []
+    for part in range(passes):
+        counts = {} # value hash -> first line number << 32 | records
+        base = 0
+        with open(bucket_path, 'rb') as f:
+            while True:
+                block = array('q', f.read(_DEDUPE_BLOCK_BYTES))
+                if not block:
+                    break
+                for record_hash, line_number in zip(block[::2], block[1::2]):
+                    if not record_hash:
+                        base = line_number
+                    elif passes == 1 or record_hash % passes == part:
+                        count = counts.get(record_hash)
+                        counts[record_hash] = (base + line_number) << 32 | 1 if count is None else count + 1
+        shared = [(-(count & 0xFFFFFFFF), count >> 32) for count in counts.values() if count & 0xFFFFFFFF > 1]
+        groups.update(-records for records, _ in shared)
+        if top:
+            best = heapq.nsmallest(top, itertools.chain(best, shared))
+    os.remove(bucket_path)
+    return groups, best
+
+
+def _map_buckets(worker, bucket_paths, args, workers, task):
+    # Yields worker(bucket path, *args) for each non-empty bucket (see _dedupe_bucket and
+    # _count_bucket), in any order.
+    bucket_paths = [bucket_path for bucket_path in bucket_paths if os.path.getsize(bucket_path)]
+    if workers <= 1 or len(bucket_paths) < 2:
+        for bucket_path in bucket_paths:
+            if task is not None and task.cancelled():
+                raise _Cancelled()
+            yield worker(bucket_path, *args)
+        return
+    pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+    pending = set()
+    try:
+        for bucket_path in bucket_paths:
+            pending.add(pool.submit(worker, bucket_path, *args))
+            while len(pending) >= workers or (pending and bucket_path == bucket_paths[-1]):
+                if task is not None and task.cancelled():
+                    raise _Cancelled()
+                done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown()
+
+
+# --- Sampling, shuffling and sharded output for files larger than memory ---
+SHUFFLE_MEMORY_BUDGET = 1024 * 1024 * 1024 # Default bytes of lines shuffle_lines() shuffles in memory at a time
+_LINE_OVERHEAD = 90 # Memory per line held in a list, besides its bytes (bytes object and list slot)
+_RUN_BUFFER_SIZE = 256 * 1024 # Write buffer of each run file shuffle_lines() scatters lines into
+
+
+def sample_records(records, count, seed=0):
+    # Returns (line_number, line) for `count` records picked uniformly at random from a stream
+    # of (line_number, line, record), in file order, keeping only the picked lines in
+    # memory. Reservoir sampling with geometric skips (Li's algorithm L), so the random
+    # numbers drawn grow with log(records / count) rather than with the number of records.
+    rng = random.Random(seed)
+    records = iter(records)
+    reservoir = [(line_number, line) for line_number, line, _ in itertools.islice(records, max(count, 0))]
+    if len(reservoir) < count or not reservoir:
+        return reservoir
+
+    def draw():
+        return math.log(1.0 - rng.random()) # log of a uniform number in (0, 1]
+
+    weight = math.exp(draw() / count)
+    while True:
+        skip = int(draw() / math.log1p(-weight)) if weight < 1 else 0
+        item = next(itertools.islice(records, skip, None), None)
+        if item is None:
+            break
+        reservoir[rng.randrange(count)] = (item[0], item[1])
+        weight *= math.exp(draw() / count)
+    reservoir.sort()
+    return reservoir
+
+
+def shuffle_lines(lines, seed=0, memory_budget=SHUFFLE_MEMORY_BUDGET, size_hint=0):
+    # Yields the byte strings of `lines` (without newlines) in a random order fixed by the
+    # seed, holding about memory_budget bytes of them at a time. Lines that do not fit are
+    # scattered at random into run files in the temp directory, each run is shuffled in
+    # memory, and the runs are yielded one after another: a uniform shuffle, since every
+    # line picks its run independently. A run that turns out larger than the budget is
+    # shuffled the same way in turn. size_hint, the expected bytes of input, sets the
+    # number of runs up front.
+    rng = random.Random(seed)
+    lines = iter(lines)
+    held, held_bytes = [], 0
+    for line in lines: # Small inputs never touch the disk
+        held.append(line)
+        held_bytes += len(line) + _LINE_OVERHEAD
+        if held_bytes > memory_budget:
+            break
+    else:
+        rng.shuffle(held)
+        yield from held
+        return
+    held, lines = None, itertools.chain(held, lines) # The list is freed once it has been scattered
+    run_dir = tempfile.mkdtemp(prefix="jsonl-shuffle-")
+    try:
+        yield from _shuffle_runs(lines, rng, memory_budget, max(size_hint, held_bytes), run_dir)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def _shuffle_runs(lines, rng, memory_budget, size_hint, run_dir):
+    runs = max(2, min(1024, -(-2 * size_hint // memory_budget))) # About half the budget each
+    run_dir = tempfile.mkdtemp(dir=run_dir) # Runs of runs get their own directory
+    paths = [os.path.join(run_dir, str(run)) for run in range(runs)]
+    sizes, counts = [0] * runs, [0] * runs
+    outputs = [open(path, 'wb', buffering=_RUN_BUFFER_SIZE) for path in paths]
+    try:
+        while True:
+            batch = list(itertools.islice(lines, 10000))
+            if not batch:
+                break
+            for line, run in zip(batch, rng.choices(range(runs), k=len(batch))):
+                outputs[run].write(line)
+                outputs[run].write(b"\n")
+                sizes[run] += len(line) + _LINE_OVERHEAD
+                counts[run] += 1
+    finally:
+        for out in outputs:
+            out.close()
+    for path, size, count in zip(paths, sizes, counts):
+        with open(path, 'rb', buffering=IO_BUFFER_SIZE) as f:
+            run_lines = (line[:-1] for line in f)
+            if size > memory_budget and count > 1:
+                yield from _shuffle_runs(run_lines, rng, memory_budget, size, run_dir)
+                held = []
+            else:
+                held = list(run_lines)
+        os.remove(path)
+        rng.shuffle(held)
+        yield from held
+
+
+class ShardedWriter:
+    """A binary output file that rolls over to a new shard every `shard_lines` lines or `shard_bytes` bytes.
+
+    Shards are named after `path` the way sharded datasets are
+    (``train.jsonl.gz`` -> ``train-00000-of-00012.jsonl.gz``), compressed like
+    it, and can be opened again as one dataset with dataset_files(). They are
+    numbered while they are written and get their total when the writer is
+    closed. Without a limit it writes `path` itself. Bytes are counted before
+    compression, and a shard only ends after a newline.
+    """
+
+    def __init__(self, path, shard_lines=None, shard_bytes=None):
+        self.path = path
+        self.shard_lines = shard_lines
+        self.shard_bytes = shard_bytes
+        self.paths = [] # Shards written so far
+        self._out = None
+        self._lines = self._bytes = 0
+        directory, name = os.path.split(path)
+        compressed = name[len(_strip_compression(name)):]
+        stem, suffix = os.path.splitext(_strip_compression(name))
+        self._pattern = os.path.join(directory, stem + "-{index:05d}{total}" + (suffix or ".jsonl") + compressed)
+
+    @property
+    def sharded(self):
+        return bool(self.shard_lines or self.shard_bytes)
+
+    def write(self, data):
+        if self._out is None:
+            shard_path = self._pattern.format(index=len(self.paths), total="") if self.sharded else self.path
+            self._out = open_data_file(shard_path, 'wb')
+            self.paths.append(shard_path)
+        self._out.write(data)
+        self._bytes += len(data)
+        if data.endswith(b"\n"):
+            self._lines += 1
+            if (self.shard_lines and self._lines >= self.shard_lines) or \
+                    (self.shard_bytes and self._bytes >= self.shard_bytes):
+                self._out.close()
+                self._out = None
+                self._lines = self._bytes = 0
+
+    def close(self):
+        # Closes the last shard and names every shard with the total; returns their paths.
+        if self._out is None and not self.paths:
+            self.write(b"") # An empty output is still one file
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+        if self.sharded:
+            total = f"-of-{len(self.paths):05d}"
+            final = [self._pattern.format(index=index, total=total) for index in range(len(self.paths))]
+            for shard_path, final_path in zip(self.paths, final):
+                os.replace(shard_path, final_path)
+            self.paths = final
+            self.shard_lines = self.shard_bytes = None # Closing again leaves the names alone
+        return self.paths
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# --- Comparing and merging versions of a dataset: 8-byte hashes per record, records only for changes ---
+
+
+def changed_fields(old, new):
+    # Keys whose values differ between two versions of a record, in the key order of `new`
+    # then `old`; (None,) when the versions differ and either one is not an object.
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return () if old == new else (None,)
+    keys = list(new) + [key for key in old if key not in new]
+    return tuple(key for key in keys if old.get(key, _MISSING) != new.get(key, _MISSING))
+
+
+class _FileProgress:
+    """Bytes read across two passes over a set of files, posted to a task as progress.
+
+    Raises _Cancelled from advance() once the task is cancelled. Compressed
+    files have no known decompressed size, so they report no total.
+    """
+
+    def __init__(self, task, paths, passes=2):
+        self.task = task
+        plain = all(compression_of(path) is None for path in paths)
+        self.total = passes * sum(os.path.getsize(path) for path in paths) if plain else 0
+        self.done = 0
+        self._next_post = 0
+
+    def advance(self, size):
+        self.done += size
+        if self.task is not None and self.done >= self._next_post:
+            self._next_post = self.done + IO_BUFFER_SIZE
+            if self.task.cancelled():
+                raise _Cancelled()
+            self.task.post("progress", min(self.done, self.total), self.total)
+
+
+class _Fingerprints:
+    """Hash and line number of each non-blank line of a file, in file order.
+
+    16 bytes a line, and no line is decoded: equal lines are equal records,
+    so two versions are matched on these alone, and only the lines left
+    unmatched (the changes) are decoded, by records(). A record rewritten
+    with other spacing or key order is told apart from an edit there.
+    """
+
+    def __init__(self, path, progress=None):
+        self.path = path
+        self.content = array('q')
+        self.lines = array('q')
+        for line_number, line in iter_lines(path):
+            digest = hashlib.blake2b(line, digest_size=8).digest()
+            self.content.append(int.from_bytes(digest, 'little', signed=True))
+            self.lines.append(line_number)
+            if progress is not None:
+                progress.advance(len(line) + 1)
+
+    def __len__(self):
+        return len(self.content)
+
+    def iter_lines(self, progress=None):
+        # Yields (position, line_number, line), reading the file again.
+        for position, (line_number, line) in enumerate(iter_lines(self.path)):
+            if progress is not None:
+                progress.advance(len(line) + 1)
+            yield position, line_number, line
+
+    def records(self, positions, progress=None, errors=None):
+        # {position: (line, record)} for the given positions. Lines that are not valid JSON
+        # raise RecordDecodeError, or are collected into `errors` and left out.
+        wanted = bytearray(len(self.content))
+        for position in positions:
+            wanted[position] = 1
+        found = {}
+        if not any(wanted):
+            return found
+        for position, line_number, line in self.iter_lines(progress):
+            if position < len(wanted) and wanted[position]:
+                try:
+                    found[position] = (line, decode_line(line, line_number, self.path))
+                except RecordDecodeError as e:
+                    if errors is None:
+                        raise
+                    errors.append(e)
+        return found
+
+
+def _pair_equal(old_hashes, old_positions, new_hashes, new_positions, old_to_new, new_to_old):
+    # Pairs positions whose hashes are equal and not 0, the n-th occurrence of a value on one
+    # side with the n-th on the other: a merge of the positions sorted by hash. The sort is
+    # stable, so occurrences of a value stay in file order.
+    old_sorted = sorted(old_positions, key=old_hashes.__getitem__)
+    new_sorted = sorted(new_positions, key=new_hashes.__getitem__)
+    i = j = 0
+    while i < len(old_sorted) and j < len(new_sorted):
+        old_hash, new_hash = old_hashes[old_sorted[i]], new_hashes[new_sorted[j]]
+        if old_hash < new_hash:
+            i += 1
+        elif old_hash > new_hash:
+            j += 1
+        else:
+            if old_hash:
+                old_to_new[old_sorted[i]] = new_sorted[j]
+                new_to_old[new_sorted[j]] = old_sorted[i]
+            i += 1
+            j += 1
+
+
+def _match_lines(old, new):
+    # Pairs the equal lines of two _Fingerprints. Returns (old_to_new, new_to_old) position
+    # arrays, -1 where a line has no equal. The unchanged head and tail, usually most of
+    # the file, are paired without sorting.
+    n, m = len(old), len(new)
+    old_to_new = array('q', [-1]) * n
+    new_to_old = array('q', [-1]) * m
+    head = 0
+    while head < min(n, m) and old.content[head] == new.content[head]:
+        head += 1
+    tail = 0
+    while tail < min(n, m) - head and old.content[n - 1 - tail] == new.content[m - 1 - tail]:
+        tail += 1
+    old_to_new[:head] = new_to_old[:head] = array('q', range(head))
+    old_to_new[n - tail:] = array('q', range(m - tail, m))
+    new_to_old[m - tail:] = array('q', range(n - tail, n))
+    _pair_equal(old.content, range(head, n - tail), new.content, range(head, m - tail), old_to_new, new_to_old)
+    return old_to_new, new_to_old
+
+
+def _match_keys(old_records, new_records, key, old_to_new, new_to_old):
+    # Pairs the unmatched, decoded records of both sides that have the same `key` value:
+    # the same record, edited.
+    old_keys = {i: DuplicateInputIndex.value_hash(record, key) for i, (line, record) in old_records.items()}
+    new_keys = {j: DuplicateInputIndex.value_hash(record, key) for j, (line, record) in new_records.items()}
+    _pair_equal(old_keys, list(old_keys), new_keys, list(new_keys), old_to_new, new_to_old)
+
+
+def _moved_records(new_to_old):
+    # Flags, by new position, the paired records that moved: all but one longest run of
+    # records whose old positions still increase (patience sorting, O(n log n)).
+    paired = array('q', (j for j, i in enumerate(new_to_old) if i >= 0))
+    tails = array('q') # Smallest old position ending an increasing run of each length
+    tail_at = array('q') # Index in `paired` of that record
+    previous = array('q', [-1]) * len(paired)
+    for n, j in enumerate(paired):
+        old_position = new_to_old[j]
+        length = bisect_left(tails, old_position)
+        if length:
+            previous[n] = tail_at[length - 1]
+        if length == len(tails):
+            tails.append(old_position)
+            tail_at.append(n)
+        else:
+            tails[length] = old_position
+            tail_at[length] = n
+    moved = bytearray(len(new_to_old))
+    for j in paired:
+        moved[j] = 1
+    n = tail_at[-1] if tail_at else -1
+    while n >= 0:
+        moved[paired[n]] = 0
+        n = previous[n]
+    return moved
+
+
+class DiffEntry:
+    """One record that differs between two versions of a dataset.
+
+    ``kind`` is "added", "removed", "modified" or "moved"; a moved record may
+    have been edited as well. Positions count records from 0 and line numbers
+    from 1, and are None on the side the record is missing from. ``fields``
+    lists the keys whose values changed (see changed_fields()).
+    """
+    __slots__ = ("kind", "old_position", "new_position", "old_line", "new_line", "old_record", "new_record", "fields")
+
+    def __init__(self, kind, old_position, new_position, old_line, new_line, old_record, new_record, fields=()):
+        self.kind = kind
+        self.old_position = old_position
+        self.new_position = new_position
+        self.old_line = old_line
+        self.new_line = new_line
+        self.old_record = old_record
+        self.new_record = new_record
+        self.fields = fields
+
+    def to_json(self):
+        return {"kind": self.kind, "old_line": self.old_line, "new_line": self.new_line, "fields": list(self.fields),
+                "old": self.old_record, "new": self.new_record}
+
+
+def diff_files(old_path, new_path, key=Dataset.KEY_INPUT, errors=None, task=None):
+    # Yields a DiffEntry for each record added, removed, modified or moved between two
+    # versions of a dataset, in the order of the new version, with removed records where
+    # they used to be. Lines are paired by hash first; the rest are decoded and paired by
+    # `key` (an edited record keeps its key, or has an id field to pass as `key`). Moves are
+    # the pairs outside the longest run still in their old order. Each file is read twice
+    # and only the changed records are decoded and held. Invalid lines that changed raise
+    # RecordDecodeError, or are collected into `errors` and skipped; raises _Cancelled when
+    # `task` is cancelled. Positions count the non-blank lines.
+    progress = _FileProgress(task, (old_path, new_path))
+    old = _Fingerprints(old_path, progress)
+    new = _Fingerprints(new_path, progress)
+    old_to_new, new_to_old = _match_lines(old, new)
+    old_records = old.records((i for i, j in enumerate(old_to_new) if j < 0), progress, errors)
+    new_records = new.records((j for j, i in enumerate(new_to_old) if i < 0), progress, errors)
+    _match_keys(old_records, new_records, key, old_to_new, new_to_old)
+    moved = _moved_records(new_to_old)
+    new_records.update(new.records((j for j in range(len(new)) if moved[j] and j not in new_records), progress))
+
+    def removed(start, stop):
+        for i in range(start, stop):
+            if old_to_new[i] < 0 and i in old_records:
+                yield DiffEntry("removed", i, None, old.lines[i], None, old_records[i][1], None, ())
+
+    reported = 0 # Removed records before this old position have been yielded
+    for j in range(len(new)):
+        i = new_to_old[j]
+        if i < 0:
+            if j in new_records:
+                yield DiffEntry("added", None, j, None, new.lines[j], None, new_records[j][1], ())
+            continue
+        if not moved[j]: # Old positions only increase along the records that stayed in order
+            yield from removed(reported, i)
+            reported = i + 1
+        if j in new_records:
+            record = new_records[j][1]
+            old_record = old_records[i][1] if i in old_records else record
+            fields = changed_fields(old_record, record)
+            if fields or moved[j]: # Not just respaced
+                yield DiffEntry("moved" if moved[j] else "modified", i, j, old.lines[i], new.lines[j],
+                                old_record, record, fields)
+    yield from removed(reported, len(old))
+
+
+def compare_files(old_path, new_path, key=Dataset.KEY_INPUT, task=None):
+    # diff_files() as (entries, invalid lines skipped), for a worker thread; None if cancelled.
+    errors = []
+    try:
+        return list(diff_files(old_path, new_path, key, errors, task)), errors
+    except _Cancelled:
+        return None
+
+
+def _merge_fields(base, ours, theirs, prefer):
+    # (merged record, conflicting keys) for a record both sides edited: each key takes the
+    # side that changed it, and `prefer` where both changed it differently.
+    if not (isinstance(base, dict) and isinstance(ours, dict) and isinstance(theirs, dict)):
+        return (theirs if prefer == "theirs" else ours), (None,)
+    merged = {}
+    conflicting = []
+    keys = list(ours) + [key for key in theirs if key not in ours] + \
+        [key for key in base if key not in ours and key not in theirs]
+    for key in keys:
+        base_value, ours_value, theirs_value = (record.get(key, _MISSING) for record in (base, ours, theirs))
+        if ours_value == theirs_value or theirs_value == base_value:
+            value = ours_value
+        elif ours_value == base_value:
+            value = theirs_value
+        else:
+            conflicting.append(key)
+            value = theirs_value if prefer == "theirs" else ours_value
+        if value is not _MISSING:
+            merged[key] = value
+    return merged, tuple(conflicting)
+
+
+def merge_files(base_path, ours_path, theirs_path, out, key=Dataset.KEY_INPUT, prefer="ours",
+                conflicts=None, errors=None, task=None):
+    # Three-way merge of two versions of a dataset edited from the same base, written to the
+    # binary file `out` in a single pass over ours. A record changed on one side takes that
+    # change; changed on both, the fields each side changed are combined. Records added on
+    # either side are kept, once if both added the same record; theirs go after the record
+    # they follow in theirs. The order is that of ours, so moves made only in theirs are not
+    # carried over. Where both sides changed a field differently, or one deleted a record
+    # the other edited, `prefer` ("ours" or "theirs") wins and a dict describing the
+    # conflict is appended to `conflicts`. Unchanged lines are copied byte for byte.
+    # Invalid lines are handled as in diff_files(). Returns counts of what was written.
+    progress = _FileProgress(task, (base_path, ours_path, theirs_path))
+    base = _Fingerprints(base_path, progress)
+    ours = _Fingerprints(ours_path, progress)
+    theirs = _Fingerprints(theirs_path, progress)
+    base_to_ours, ours_to_base = _match_lines(base, ours)
+    base_to_theirs, theirs_to_base = _match_lines(base, theirs)
+    # Every record that is not the same line on all sides is decoded and held: the changes
+    base_records = base.records((i for i in range(len(base)) if base_to_ours[i] < 0 or base_to_theirs[i] < 0), progress, errors)
+    ours_records = ours.records((j for j, i in enumerate(ours_to_base) if i < 0), progress, errors)
+    theirs_records = theirs.records((k for k, i in enumerate(theirs_to_base) if i < 0), progress, errors)
+    _match_keys({i: base_records[i] for i in base_records if base_to_ours[i] < 0}, ours_records, key, base_to_ours, ours_to_base)
+    _match_keys({i: base_records[i] for i in base_records if base_to_theirs[i] < 0}, theirs_records, key,
+                base_to_theirs, theirs_to_base)
+    counts = {"records": 0, "from_theirs": 0, "combined": 0, "added": 0, "deleted": 0, "conflicts": 0}
+
+    ours_added = {} # Line hash -> number of records ours added with it
+    for j, i in enumerate(ours_to_base):
+        if i < 0 and j in ours_records:
+            ours_added[ours.content[j]] = ours_added.get(ours.content[j], 0) + 1
+    theirs_after = {} # Ours position -> theirs positions written after it; -1 for the top of the file
+    late_conflicts = [] # (base position, theirs position) edited in theirs, deleted in ours
+    anchor = -1
+    for k, i in enumerate(theirs_to_base):
+        if i >= 0 and base_to_ours[i] >= 0:
+            anchor = base_to_ours[i]
+        elif i < 0:
+            if k not in theirs_records:
+                continue # Invalid
+            if ours_added.get(theirs.content[k]):
+                ours_added[theirs.content[k]] -= 1 # Added on both sides
+            else:
+                theirs_after.setdefault(anchor, []).append(k)
+        elif theirs.content[k] != base.content[i]:
+            late_conflicts.append((i, k))
+            if prefer == "theirs":
+                theirs_after.setdefault(anchor, []).append(k)
+
+    def conflict(fields, i, j, k, ours_record):
+        counts["conflicts"] += 1
+        if conflicts is not None:
+            conflicts.append({
+                "fields": list(fields),
+                "base_line": base.lines[i], "ours_line": ours.lines[j] if j >= 0 else None,
+                "theirs_line": theirs.lines[k] if k >= 0 else None,
+                "base": base_records[i][1], "ours": ours_record,
+                "theirs": theirs_records[k][1] if k >= 0 else None})
+
+    def write(line):
+        out.write(line)
+        out.write(b"\n")
+        counts["records"] += 1
+
+    def write_theirs(after):
+        for k in theirs_after.get(after, ()):
+            write(theirs_records[k][0])
+            counts["added" if theirs_to_base[k] < 0 else "from_theirs"] += 1
+
+    for i, k in late_conflicts:
+        conflict((None,), i, -1, k, None)
+    write_theirs(-1)
+    for j, line_number, line in ours.iter_lines(progress):
+        i = ours_to_base[j]
+        k = base_to_theirs[i] if i >= 0 else -1
+        ours_edited = i >= 0 and ours.content[j] != base.content[i]
+        if i < 0:
+            if j in ours_records: # Not an invalid line
+                write(line)
+                counts["added"] += 1
+        elif k < 0: # Deleted in theirs
+            if ours_edited:
+                conflict((None,), i, j, k, ours_records[j][1])
+            if ours_edited and prefer == "ours":
+                write(line)
+            else:
+                counts["deleted"] += 1
+        elif theirs.content[k] == base.content[i] or theirs.content[k] == ours.content[j]:
+            write(line)
+        elif not ours_edited:
+            write(theirs_records[k][0])
+            counts["from_theirs"] += 1
+        else:
+            merged, conflicting = _merge_fields(base_records[i][1], ours_records[j][1], theirs_records[k][1], prefer)
+            if conflicting:
+                conflict(conflicting, i, j, k, ours_records[j][1])
+            write(json.dumps(merged).encode('utf-8'))
+            counts["combined"] += 1
+        write_theirs(j)
+    counts["deleted"] += sum(1 for i, j in enumerate(base_to_ours) if j < 0 and i in base_records) - \
+        len(late_conflicts) * (prefer == "theirs")
+    return counts
+
+
+def merge_to_file(base_path, ours_path, theirs_path, out_path, key=Dataset.KEY_INPUT, prefer="ours", task=None):
+    # merge_files() into out_path for a worker thread, skipping invalid lines. Returns
+    # (counts, conflicts, invalid lines), or None if cancelled; a partial file is removed.
+    conflicts = []
+    errors = []
+    try:
+        with open_data_file(out_path, 'wb') as out:
+            counts = merge_files(base_path, ours_path, theirs_path, out, key, prefer, conflicts, errors, task)
+    except BaseException as e:
+        _remove_quietly(out_path)
+        if isinstance(e, _Cancelled):
+            return None
+        raise
+    return counts, conflicts, errors
@@ -1,35 +1,403 @@
 import tkinter as tk
-from tkinter import filedialog, messagebox, scrolledtext
+from tkinter import filedialog, messagebox, scrolledtext, simpledialog, ttk
+import tkinter.font as tkfont
+import argparse
+import bisect
+import itertools
 import json
+import multiprocessing
 import os
-import copy # For deepcopy in undo/redo
-from collections import defaultdict # For counting duplicates
+import queue
+import re
+import sys
+import threading
+import time
+
+import jsonl_cli
+from jsonl_dataset import Dataset, EditJournal, FileChangedError, RecordStats, TailFollower, compare_files, merge_to_file
+from jsonl_instrumentation import Instrumentation
+
+class BackgroundTask:
+    """Runs ``work(task)`` on a worker thread and hands its messages to the Tk loop.
+
+    The worker reports through post() and checks cancelled(); the Tk thread
+    drains the queue every POLL_MS with root.after, so neither side blocks the
+    other. on_done(result, error) runs on the Tk thread once the worker returns.
+    """
+    POLL_MS = 50
+    POLL_BUDGET_S = 0.03 # Time spent handling messages per poll, to keep the UI responsive
+
+    def __init__(self, root, work, on_message=None, on_done=None):
+        self.root = root
+        self.work = work
+        self.on_message = on_message
+        self.on_done = on_done
+        self.result = None
+        self.error = None
+        self._queue = queue.Queue()
+        self._cancel = threading.Event()
+        self._finished = tk.BooleanVar(root, False)
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        self.root.after(self.POLL_MS, self._poll)
+        return self
+
+    def post(self, *message):
+        self._queue.put(message)
+
+    def cancel(self):
+        self._cancel.set()
+
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def wait(self):
+        # Keeps processing Tk events (progress, the cancel button) until the task is done.
+        if not self._finished.get():
+            self.root.wait_variable(self._finished)
+
+    def _run(self):
+        try:
+            self._queue.put(("__done__", self.work(self), None))
+        except BaseException as e:
+            self._queue.put(("__done__", None, e))
 
-class JsonlEditorAppTk:
-    MAX_UNDO_LEVELS = 50
-    KEY_INSTRUCTION = "instruction"
-    KEY_INPUT = "input"
-    KEY_OUTPUT = "output"
+    def _poll(self):
+        deadline = time.monotonic() + self.POLL_BUDGET_S
+        while time.monotonic() < deadline:
+            try:
+                message = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if message[0] == "__done__":
+                self.result, self.error = message[1], message[2]
+                if self.on_done:
+                    self.on_done(self.result, self.error)
+                self._finished.set(True)
+                return
+            if self.on_message:
+                self.on_message(*message)
+        self.root.after(self.POLL_MS, self._poll)
+
+
+class VirtualListbox(tk.Frame):
+    """Listbox that only materialises the rows currently in view.
+
+    Rows are pulled from ``row_source(index) -> (text, bg, fg)`` as they scroll
+    into view, so a redraw costs the same for ten rows or ten million. The
+    selection is a row index, and ``<<ListboxSelect>>`` is fired on this frame
+    like tk.Listbox fires it on itself.
+
+    Rows for which ``row_marked(row)`` is true are drawn selected as well; the
+    owner keeps that multi-selection. Control-click, Shift-click, Shift+arrows
+    and Control+A set ``mark_request`` to ("toggle" | "range" | "all", anchor
+    row, row) and fire ``<<ListboxMark>>`` instead.
+    """
+
+    def __init__(self, master, row_source, row_marked=None, **listbox_options):
+        super().__init__(master)
+        self.row_source = row_source
+        self.row_marked = row_marked
+        self.row_count = 0
+        self.first = 0 # Data index of the top row in view
+        self.selected = -1
+        self.anchor = -1 # Row a Shift-click range starts from
+        self.mark_request = None
+        self._line_height = None
+
+        self.scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL, command=self.yview)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.listbox = tk.Listbox(self, exportselection=False, **listbox_options)
+        self.listbox.pack(fill=tk.BOTH, expand=True)
+
+        self.listbox.bind('<<ListboxSelect>>', self._on_click_select)
+        self.listbox.bind('<Configure>', lambda e: self.refresh())
+        self.listbox.bind('<B1-Leave>', lambda e: "break") # No autoscan: the inner listbox never scrolls
+        for sequence in ('<MouseWheel>', '<Button-4>', '<Button-5>'):
+            self.listbox.bind(sequence, self._on_mouse_wheel)
+        self.listbox.bind('<Up>', lambda e: self._move_selection(-1))
+        self.listbox.bind('<Down>', lambda e: self._move_selection(1))
+        self.listbox.bind('<Prior>', lambda e: self._move_selection(-self._visible_rows()))
+        self.listbox.bind('<Next>', lambda e: self._move_selection(self._visible_rows()))
+        self.listbox.bind('<Home>', lambda e: self._move_selection(-self.row_count))
+        self.listbox.bind('<End>', lambda e: self._move_selection(self.row_count))
+        self.listbox.bind('<Control-Button-1>', lambda e: self._on_mark_click(e, "toggle"))
+        self.listbox.bind('<Shift-Button-1>', lambda e: self._on_mark_click(e, "range"))
+        self.listbox.bind('<Shift-Up>', lambda e: self._move_selection(-1, extend=True))
+        self.listbox.bind('<Shift-Down>', lambda e: self._move_selection(1, extend=True))
+        self.listbox.bind('<Control-a>', lambda e: self._request_mark("all", self.selected))
+
+    # --- tk.Listbox-compatible subset ---
+    def size(self):
+        return self.row_count
+
+    def curselection(self):
+        return (self.selected,) if 0 <= self.selected < self.row_count else ()
+
+    def selection_set(self, index):
+        self.selected = index
+        self.listbox.selection_clear(0, tk.END)
+        if self.row_marked is not None:
+            for row in range(self.first, self.first + self.listbox.size()):
+                if self.row_marked(row):
+                    self.listbox.selection_set(row - self.first)
+        if self.first <= index < self.first + self.listbox.size():
+            self.listbox.selection_set(index - self.first)
+
+    def selection_clear(self):
+        self.selected = -1
+        self.listbox.selection_clear(0, tk.END)
+
+    def activate(self, index):
+        if self.first <= index < self.first + self.listbox.size():
+            self.listbox.activate(index - self.first)
+
+    def see(self, index):
+        rows = self._visible_rows()
+        if index < self.first:
+            self._scroll_to(index)
+        elif index >= self.first + rows:
+            self._scroll_to(index - rows + 1)
+
+    def yview(self, *args):
+        if args[0] == tk.MOVETO:
+            self._scroll_to(int(float(args[1]) * self.row_count))
+        elif args[0] == tk.SCROLL:
+            step = self._visible_rows() if args[2] == tk.PAGES else 1
+            self._scroll_to(self.first + int(args[1]) * step)
+
+    # --- Data binding ---
+    def set_row_count(self, row_count):
+        self.row_count = row_count
+        if self.selected >= row_count:
+            self.selected = -1
+        self.refresh()
+
+    def refresh(self):
+        rows = self._visible_rows()
+        self.first = max(0, min(self.first, self.row_count - rows))
+        last = min(self.row_count, self.first + rows + 1) # One extra for the partially visible row
+        self.listbox.delete(0, tk.END)
+        for index in range(self.first, last):
+            self._insert_row(index)
+        self.listbox.yview_moveto(0)
+        self.selection_set(self.selected)
+        self.activate(self.selected)
+        self._update_scrollbar(rows)
+
+    def visible_range(self):
+        return self.first, self.first + self.listbox.size()
+
+    def refresh_row(self, index):
+        if not (self.first <= index < self.first + self.listbox.size()):
+            return
+        self.listbox.delete(index - self.first)
+        self._insert_row(index)
+        if index == self.selected:
+            self.selection_set(index)
+
+    def _insert_row(self, index):
+        text, bg, fg = self.row_source(index)
+        position = index - self.first
+        self.listbox.insert(position, text)
+        self.listbox.itemconfig(position, bg=bg, fg=fg)
+
+    def _visible_rows(self):
+        if self._line_height is None:
+            font = tkfont.Font(root=self, font=self.listbox.cget('font'))
+            # Same row pitch tk.Listbox uses internally.
+            self._line_height = font.metrics('linespace') + 1 + 2 * int(self.listbox.cget('selectborderwidth'))
+        chrome = 2 * (int(self.listbox.cget('borderwidth')) + int(self.listbox.cget('highlightthickness')))
+        return max(1, (self.listbox.winfo_height() - chrome) // self._line_height)
+
+    def _scroll_to(self, first):
+        first = max(0, min(first, self.row_count - self._visible_rows()))
+        if first != self.first:
+            self.first = first
+            self.refresh()
+
+    def _update_scrollbar(self, rows):
+        if self.row_count <= rows:
+            self.scrollbar.set(0, 1)
+        else:
+            self.scrollbar.set(self.first / self.row_count, (self.first + rows) / self.row_count)
+
+    # --- Input handling ---
+    def _on_click_select(self, event):
+        selection = self.listbox.curselection()
+        if not selection:
+            return
+        index = self.first + selection[0]
+        if index < self.row_count:
+            self.selected = self.anchor = index
+            self.event_generate('<<ListboxSelect>>')
+
+    def _on_mark_click(self, event, kind):
+        row = self.first + self.listbox.nearest(event.y)
+        if 0 <= row < self.row_count:
+            self._request_mark(kind, row)
+        return "break"
+
+    def _request_mark(self, kind, row):
+        # A range runs from the row last clicked without Shift; a toggle passes the row in
+        # focus, which joins the selection when one starts.
+        anchor = self.selected if kind == "toggle" or self.anchor < 0 else self.anchor
+        self.mark_request = (kind, anchor, row)
+        if kind == "toggle":
+            self.anchor = row
+        self.event_generate('<<ListboxMark>>')
+        return "break"
+
+    def _on_mouse_wheel(self, event):
+        if event.num == 4:
+            units = -3
+        elif event.num == 5:
+            units = 3
+        else:
+            units = -3 * event.delta // 120 if abs(event.delta) >= 120 else -event.delta # macOS sends small deltas
+        self._scroll_to(self.first + units)
+        return "break"
+
+    def _move_selection(self, delta, extend=False):
+        if self.row_count:
+            start = self.selected if self.selected >= 0 else 0
+            target = max(0, min(self.row_count - 1, start + delta))
+            self.see(target)
+            if extend:
+                return self._request_mark("range", target)
+            self.anchor = target
+            self.selection_set(target)
+            self.activate(target)
+            self.event_generate('<<ListboxSelect>>')
+        return "break"
+
+
+class UiUpdateScheduler:
+    """Coalesces UI updates into one flush per idle cycle, and at most one per FRAME_MS.
+
+    Event handlers mark() the parts of the UI that need redrawing instead of
+    redrawing them; parts marked several times before the flush are updated
+    once. ``handlers`` is a sequence of (part, callable), called in that order.
+    A part that is updated directly in the meantime can be discard()ed.
+    """
+    FRAME_MS = 16
+
+    def __init__(self, root, handlers):
+        self.root = root
+        self.handlers = list(handlers)
+        self.dirty = set()
+        self._after_id = None
+        self._last_flush = 0.0
+
+    def mark(self, *parts):
+        self.dirty.update(parts)
+        if self._after_id is None:
+            wait_ms = int((self._last_flush + self.FRAME_MS / 1000 - time.monotonic()) * 1000)
+            if wait_ms > 0:
+                self._after_id = self.root.after(wait_ms, self._flush_when_idle)
+            else:
+                self._after_id = self.root.after_idle(self.flush)
+
+    def discard(self, part):
+        self.dirty.discard(part)
 
-    def __init__(self, root_window):
+    def flush(self):
+        if self._after_id is not None:
+            self.root.after_cancel(self._after_id)
+            self._after_id = None
+        self._last_flush = time.monotonic()
+        for part, handler in self.handlers:
+            if part in self.dirty:
+                self.dirty.discard(part) # Before the call, which may mark it again
+                handler()
+
+    def _flush_when_idle(self):
+        self._after_id = self.root.after_idle(self.flush)
+
+
+class JsonlEditorAppTk:
+    COMPACT_IDLE_MS = 60 * 1000 # Autosaved edits are written into the file after this long without edits
+    FOLLOW_POLL_MS = 1000 # How often a followed file is checked for appended lines
+    NEAR_DUPLICATE_THRESHOLD = 0.8 # Default similarity for near-duplicate detection
+    STATS_REFRESH_MS = 500 # How often the statistics panel checks whether the counts changed
+    STATS_BAR_WIDTH = 40 # Characters of the longest histogram bar in the statistics panel
+    SEARCH_MODES = {"Words": "token", "Phrase": "phrase", "Regex": "regex"} # Label -> Dataset.find mode
+    VIEW_FILTERS = {"All items": "all", "Duplicates": "duplicates", "Near duplicates": "near_duplicates",
+                    "Eval overlap": "contaminated", "Empty instruction": "empty_instruction", "Empty input": "empty_input",
+                    "Empty output": "empty_output", "Search matches": "search"} # Label -> Dataset.build_view filter
+    VIEW_SORTS = {"File order": ("position", False), "Shortest first": ("length", False),
+                  "Longest first": ("length", True), "Shortest output": ("output_length", False),
+                  "Longest output": ("output_length", True)} # Label -> Dataset.build_view sort, descending
+    FILE_TYPES = [("JSONL files", "*.jsonl *.jsonl.gz *.jsonl.bz2 *.jsonl.xz"), ("All files", "*.*")] # Compressed ones are read and written transparently
+    # Timed as spans when instrumentation is on: user-facing operations first, then their sub-steps
+    INSTRUMENTED_METHODS = (
+        "new_file", "load_file", "load_folder", "save_data_to_file_manual", "save_data_as", "undo_action", "redo_action",
+        "add_item", "delete_item", "on_list_item_select", "on_text_edit_focus_out", "mark_ui_field_dirty",
+        "toggle_theme", "run_search", "show_search_result", "toggle_near_duplicates", "toggle_follow", "apply_view",
+        "on_list_item_mark", "select_all_items", "move_selected_items", "keep_first_duplicates",
+        "populate_listbox", "_find_duplicate_inputs", "_refresh_duplicate_rows", "_push_state_to_undo",
+        "_restore_state_from_stack", "_commit_ui_edits_if_any", "update_current_item_from_text_fields",
+        "_load_item_data_to_fields", "save_data_to_file", "_save_store", "_write_back_journal",
+        "_compact_when_idle", "_on_load_batch", "_on_load_done", "_recover_journal", "_update_ui_element_states",
+        "_take_appended_lines", "_delete_positions", "_on_replacements_found", "compare_with_file", "three_way_merge",
+        "add_reference_files", "clear_reference_files", "_check_contamination",
+        "show_statistics", "_compute_statistics", "_draw_statistics",
+    )
+    SLOW_OPERATION_MS = 100 # Latencies above this are flagged in the latency bar
+    LARGE_FIELD_CHARS = 256 * 1024 # Longer field values are loaded into their pane in chunks, between events
+    FIELD_CHUNK_CHARS = 64 * 1024
+    KEY_INSTRUCTION = Dataset.KEY_INSTRUCTION
+    KEY_INPUT = Dataset.KEY_INPUT
+    KEY_OUTPUT = Dataset.KEY_OUTPUT
+
+    def __init__(self, root_window, instrumentation=None, scan_workers=None):
         self.root = root_window
         self.root.title("Tkinter JSONL Editor (with Duplicate Input Detection)") # Updated title
         self.root.geometry("1000x700")
 
         # --- Data and State ---
         self.current_file_path = None
-        self.data = []
-        self.selected_index = -1 # Index in self.data
+        # Records plus the indexes that follow their edits: duplicate inputs, undo history
+        # and the autosave journal (compacted into the file on save or when idle).
+        self.dataset = Dataset()
+        self.selected_index = -1 # Index in self.data; list rows map to it through self.dataset.view
+        self.scan_workers = scan_workers # Processes scanning large files; None for one per core
 
-        self.undo_stack = []
-        self.redo_stack = []
+        self._compact_after_id = None
+        self.busy_task = None # BackgroundTask while a file is being loaded or saved
+        self._pending_builds = [] # Index builds queued after a load, each started when the task before it is done
 
         self.is_dirty_file = False
         self.ui_text_field_is_dirty = False
+        self._pending_status = None # Status message waiting for the next UI flush
+        self._field_loads = {} # Text widget -> after id while a large value is still being loaded into it
+
+        # --- Search State ---
+        self.search_results = [] # Sorted positions of the matching rows
+        self.search_query = None # (query, mode) the results belong to
+        self.search_version = -1 # store.version when the results were computed
+
+        # --- Multi-Selection State ---
+        self.marks = bytearray() # record id -> 1 for the items selected together for a batch operation
+        self.mark_count = 0
+
+        # --- Follow Mode State ---
+        self.follower = None # TailFollower while appended lines are taken in
+        self._follow_after_id = None
+
+        # --- Near-Duplicate Detection State ---
+        self.near_duplicates_enabled = False # Rebuilt in the background after each load
+        self.near_threshold_var = tk.StringVar(value=str(self.NEAR_DUPLICATE_THRESHOLD))
 
-        # --- Duplicate Detection State ---
-        self.duplicate_input_indices = set() # Store indices of items with duplicate inputs
-        self.input_counts = defaultdict(int) # To count occurrences of each input string
+        # --- Contamination Check State ---
+        self.reference_paths = [] # Eval sets checked against; rechecked in the background after each load
+
+        # --- Statistics Panel State ---
+        self.stats_panel = None # Toplevel while open; the statistics are recounted after each load meanwhile
+        self.stats_text = None
+        self._stats_shown = None # (DatasetStats, version) drawn last
+        self._stats_after_id = None
 
         # --- Theme Management ---
         self.themes = {
@@ -41,6 +409,12 @@ class JsonlEditorAppTk:
                 "disabled_fg": "#a0a0a0", "status_bar_bg": "#e0e0e0", "status_bar_fg": "black",
                 "duplicate_item_bg": "#ffe0e0", # Light red for duplicate background in light theme
                 "duplicate_item_fg": "black",  #
+                "near_duplicate_item_bg": "#fff2c8", # Light amber for near-duplicate clusters
+                "near_duplicate_item_fg": "black",
+                "contaminated_item_bg": "#ecdcf5", # Light purple for records found in a reference file
+                "contaminated_item_fg": "black",
+                "diff_added_bg": "#dff5dd", "diff_removed_bg": "#ffe0e0", # Compare window rows and field changes
+                "diff_modified_bg": "#fff2c8", "diff_moved_bg": "#dde8ff", "diff_fg": "black",
             },
             "dark": {
                 "bg": "#2e2e2e", "fg": "white", "button_bg": "#555555", "button_fg": "white",
@@ -50,16 +424,40 @@ class JsonlEditorAppTk:
                 "disabled_fg": "#777777", "status_bar_bg": "#404040", "status_bar_fg": "white",
                 "duplicate_item_bg": "#703030", # Darker red for duplicate background in dark theme
                 "duplicate_item_fg": "white", #
+                "near_duplicate_item_bg": "#665520", # Dark amber for near-duplicate clusters
+                "near_duplicate_item_fg": "white",
+                "contaminated_item_bg": "#563a6b", # Dark purple for records found in a reference file
+                "contaminated_item_fg": "white",
+                "diff_added_bg": "#2f5a2f", "diff_removed_bg": "#703030",
+                "diff_modified_bg": "#665520", "diff_moved_bg": "#2f4570", "diff_fg": "white",
             }
         }
         self.current_theme_name = "light"
 
+        # --- Instrumentation (opt-in) ---
+        self.instrumentation = instrumentation or Instrumentation()
+        self.latency_panel = None
+        for name in self.INSTRUMENTED_METHODS: # Before _build_ui, which binds the methods to widgets
+            setattr(self, name, self.instrumentation.wrap(name, getattr(self, name)))
+
+        # Keystrokes and list changes mark these parts dirty; they are redrawn once per idle cycle
+        self.ui_updates = UiUpdateScheduler(self.root, (
+            ("select", lambda: self.on_list_item_select(None)),
+            ("preview", lambda: self.listbox.refresh_row(self._row_of(self.selected_index))),
+            ("states", self._update_ui_element_states),
+            ("status", lambda: self._set_status(self._pending_status)),
+        ))
+
         self._build_ui()
         self.apply_theme(self.current_theme_name)
         self._update_ui_element_states()
         self.root.protocol("WM_DELETE_WINDOW", self._on_closing)
 
 
+    @property
+    def data(self):
+        return self.dataset.store
+
     def _build_ui(self):
         # ... (rest of your _build_ui method remains largely the same) ...
         # Top Frame
@@ -70,6 +468,8 @@ class JsonlEditorAppTk:
         self.new_button.pack(side=tk.LEFT, padx=5)
         self.load_button = tk.Button(self.top_frame, text="Load JSONL", command=self.load_file)
         self.load_button.pack(side=tk.LEFT, padx=5)
+        self.load_folder_button = tk.Button(self.top_frame, text="Load Folder", command=self.load_folder)
+        self.load_folder_button.pack(side=tk.LEFT, padx=5)
         self.save_button = tk.Button(self.top_frame, text="Save", command=self.save_data_to_file_manual)
         self.save_button.pack(side=tk.LEFT, padx=5)
         self.save_as_button = tk.Button(self.top_frame, text="Save As...", command=self.save_data_as)
@@ -80,6 +480,30 @@ class JsonlEditorAppTk:
         self.redo_button.pack(side=tk.LEFT, padx=5)
         self.theme_button = tk.Button(self.top_frame, text="Toggle Theme", command=self.toggle_theme)
         self.theme_button.pack(side=tk.LEFT, padx=5)
+        self.near_button = tk.Button(self.top_frame, text="Near Duplicates: Off", command=self.toggle_near_duplicates)
+        self.near_button.pack(side=tk.LEFT, padx=5)
+        self.near_threshold_spinbox = tk.Spinbox(self.top_frame, from_=0.5, to=0.95, increment=0.05, width=5,
+                                                 textvariable=self.near_threshold_var, command=self._on_near_threshold_change)
+        self.near_threshold_spinbox.pack(side=tk.LEFT)
+        self.near_threshold_spinbox.bind("<Return>", lambda e: self._on_near_threshold_change())
+        self.follow_button = tk.Button(self.top_frame, text="Follow: Off", command=self.toggle_follow)
+        self.follow_button.pack(side=tk.LEFT, padx=5)
+        # Other versions of the dataset: a diff against the open file, or a three-way merge into a new file
+        self.compare_button = tk.Menubutton(self.top_frame, text="Compare", relief=tk.RAISED)
+        self.compare_button.pack(side=tk.LEFT, padx=5)
+        self.compare_menu = tk.Menu(self.compare_button, tearoff=False)
+        self.compare_menu.add_command(label="Compare With Other Version...", command=self.compare_with_file)
+        self.compare_menu.add_command(label="Three-Way Merge...", command=self.three_way_merge)
+        self.compare_button.config(menu=self.compare_menu)
+        # Held-out eval sets: records whose input or output appears in one of them are flagged
+        self.reference_button = tk.Menubutton(self.top_frame, text="Eval Sets", relief=tk.RAISED)
+        self.reference_button.pack(side=tk.LEFT, padx=5)
+        self.reference_menu = tk.Menu(self.reference_button, tearoff=False)
+        self.reference_menu.add_command(label="Add Reference Files...", command=self.add_reference_files)
+        self.reference_menu.add_command(label="Clear References", command=self.clear_reference_files)
+        self.reference_button.config(menu=self.reference_menu)
+        self.stats_button = tk.Button(self.top_frame, text="Statistics", command=self.show_statistics)
+        self.stats_button.pack(side=tk.LEFT, padx=5)
         self.file_label = tk.Label(self.top_frame, text="No file loaded.")
         self.file_label.pack(side=tk.LEFT, padx=10, expand=True, anchor="w")
 
@@ -93,12 +517,47 @@ class JsonlEditorAppTk:
         self.list_frame.pack_propagate(False)
         self.listbox_label = tk.Label(self.list_frame, text="JSONL Items (Duplicates Highlighted):") # Updated Label
         self.listbox_label.pack(anchor=tk.W)
-        self.listbox_scrollbar = tk.Scrollbar(self.list_frame, orient=tk.VERTICAL)
-        self.listbox = tk.Listbox(self.list_frame, yscrollcommand=self.listbox_scrollbar.set, exportselection=False)
-        self.listbox_scrollbar.config(command=self.listbox.yview)
-        self.listbox_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+        # Search over instruction, input and output; word and phrase queries use the search index
+        self.search_frame = tk.Frame(self.list_frame)
+        self.search_frame.pack(fill=tk.X, pady=(0, 5))
+        self.search_var = tk.StringVar()
+        self.search_entry = tk.Entry(self.search_frame, textvariable=self.search_var)
+        self.search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.search_entry.bind("<Return>", lambda e: self.run_search())
+        self.search_entry.bind("<Shift-Return>", lambda e: self.show_search_result(-1))
+        self.search_mode_var = tk.StringVar(value="Words")
+        self.search_mode_box = ttk.Combobox(self.search_frame, textvariable=self.search_mode_var, width=7,
+                                            values=list(self.SEARCH_MODES), state="readonly")
+        self.search_mode_box.pack(side=tk.LEFT, padx=(2, 0))
+        self.search_mode_box.bind("<<ComboboxSelected>>", lambda e: self._clear_search_results())
+        self.search_nav_frame = tk.Frame(self.list_frame)
+        self.search_nav_frame.pack(fill=tk.X, pady=(0, 5))
+        self.search_prev_button = tk.Button(self.search_nav_frame, text="< Prev", command=lambda: self.show_search_result(-1))
+        self.search_prev_button.pack(side=tk.LEFT)
+        self.search_next_button = tk.Button(self.search_nav_frame, text="Next >", command=lambda: self.show_search_result(1))
+        self.search_next_button.pack(side=tk.LEFT, padx=(2, 0))
+        self.search_label = tk.Label(self.search_nav_frame, text="")
+        self.search_label.pack(side=tk.LEFT, padx=5)
+
+        # Filtered and sorted views list record ids only; edits in them go to the dataset positions
+        self.view_frame = tk.Frame(self.list_frame)
+        self.view_frame.pack(fill=tk.X, pady=(0, 5))
+        self.view_filter_var = tk.StringVar(value="All items")
+        self.view_filter_box = ttk.Combobox(self.view_frame, textvariable=self.view_filter_var, width=16,
+                                            values=list(self.VIEW_FILTERS), state="readonly")
+        self.view_filter_box.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.view_filter_box.bind("<<ComboboxSelected>>", lambda e: self.apply_view())
+        self.view_sort_var = tk.StringVar(value="File order")
+        self.view_sort_box = ttk.Combobox(self.view_frame, textvariable=self.view_sort_var, width=14,
+                                          values=list(self.VIEW_SORTS), state="readonly")
+        self.view_sort_box.pack(side=tk.LEFT, padx=(2, 0))
+        self.view_sort_box.bind("<<ComboboxSelected>>", lambda e: self.apply_view())
+
+        self.listbox = VirtualListbox(self.list_frame, self._listbox_row, self._row_is_marked) # Draws only the rows in view
         self.listbox.pack(fill=tk.BOTH, expand=True)
         self.listbox.bind('<<ListboxSelect>>', self.on_list_item_select)
+        self.listbox.bind('<<ListboxMark>>', self.on_list_item_mark)
 
         self.item_button_frame = tk.Frame(self.list_frame)
         self.item_button_frame.pack(fill=tk.X, pady=5)
@@ -106,6 +565,19 @@ class JsonlEditorAppTk:
         self.add_item_button.pack(side=tk.LEFT, expand=True, fill=tk.X, padx=(0,2))
         self.delete_item_button = tk.Button(self.item_button_frame, text="Delete Item", command=self.delete_item)
         self.delete_item_button.pack(side=tk.LEFT, expand=True, fill=tk.X, padx=(2,0))
+        # Batch operations on the items selected with Ctrl/Shift-click; each is one undo step
+        self.batch_button = tk.Menubutton(self.item_button_frame, text="Batch", relief=tk.RAISED)
+        self.batch_button.pack(side=tk.LEFT, fill=tk.X, padx=(4,0))
+        self.batch_menu = tk.Menu(self.batch_button, tearoff=False)
+        self.batch_menu.add_command(label="Select All", accelerator="Ctrl+A", command=self.select_all_items)
+        self.batch_menu.add_separator()
+        self.batch_menu.add_command(label="Move to Top", command=lambda: self.move_selected_items("top"))
+        self.batch_menu.add_command(label="Move to Bottom", command=lambda: self.move_selected_items("bottom"))
+        self.batch_menu.add_command(label="Move Before Item...", command=lambda: self.move_selected_items("before"))
+        self.batch_menu.add_separator()
+        self.batch_menu.add_command(label="Find and Replace...", command=self.find_and_replace)
+        self.batch_menu.add_command(label="Keep First of Each Duplicate", command=self.keep_first_duplicates)
+        self.batch_button.config(menu=self.batch_menu)
 
         # Right: Text areas
         self.details_frame = tk.Frame(self.main_frame)
@@ -135,14 +607,29 @@ class JsonlEditorAppTk:
         # Status bar
         self.status_bar = tk.Label(self.root, text="Ready", bd=1, relief=tk.SUNKEN, anchor=tk.W)
         self.status_bar.pack(side=tk.BOTTOM, fill=tk.X)
+        self.latency_label = tk.Label(self.root, text="Instrumentation on. F12 shows the latency panel.", bd=1, relief=tk.SUNKEN, anchor=tk.W)
+        if self.instrumentation.enabled:
+            self._instrument_ui()
+
+        # Progress of background loads and saves; only packed while one is running
+        self.progress_frame = tk.Frame(self.root)
+        self.progress_label = tk.Label(self.progress_frame, text="")
+        self.progress_label.pack(side=tk.LEFT, padx=5)
+        self.progress_cancel_button = tk.Button(self.progress_frame, text="Cancel", command=self.cancel_background_task)
+        self.progress_cancel_button.pack(side=tk.RIGHT, padx=5, pady=2)
+        self.progress_bar = ttk.Progressbar(self.progress_frame, mode='determinate', maximum=1000)
+        self.progress_bar.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
 
         self.themeable_widgets = [
             self.root, self.top_frame, self.main_frame, self.list_frame, self.item_button_frame, self.details_frame,
-            self.new_button, self.load_button, self.save_button, self.save_as_button, self.undo_button, self.redo_button,
-            self.theme_button, self.add_item_button, self.delete_item_button,
-            self.file_label, self.listbox_label, self.instruction_label, self.input_label, self.output_label,
-            self.status_bar, self.listbox,
-            self.instruction_text, self.input_text, self.output_text
+            self.search_frame, self.search_nav_frame, self.view_frame, self.search_entry, self.search_prev_button, self.search_next_button, self.search_label,
+            self.new_button, self.load_button, self.load_folder_button, self.save_button, self.save_as_button, self.undo_button, self.redo_button,
+            self.theme_button, self.near_button, self.near_threshold_spinbox, self.follow_button, self.add_item_button, self.delete_item_button,
+            self.batch_button, self.batch_menu, self.compare_button, self.compare_menu, self.reference_button, self.reference_menu,
+            self.stats_button, self.file_label, self.listbox_label, self.instruction_label, self.input_label, self.output_label,
+            self.status_bar, self.listbox, self.listbox.listbox,
+            self.instruction_text, self.input_text, self.output_text,
+            self.progress_frame, self.progress_label, self.progress_cancel_button, self.latency_label
         ]
         self.root.bind_all("<Control-n>", lambda e: self.new_file())
         self.root.bind_all("<Control-o>", lambda e: self.load_file())
@@ -150,10 +637,14 @@ class JsonlEditorAppTk:
         self.root.bind_all("<Control-Shift-S>", lambda e: self.save_data_as())
         self.root.bind_all("<Control-z>", lambda e: self.undo_action())
         self.root.bind_all("<Control-y>", lambda e: self.redo_action())
+        self.root.bind_all("<Control-f>", lambda e: self.search_entry.focus_set())
 
 
     def _on_closing(self):
         # ... (same as before) ...
+        if self.busy_task is not None:
+            self.cancel_background_task()
+            return
         self._commit_ui_edits_if_any()
         if self.is_dirty_file:
             response = messagebox.askyesnocancel("Unsaved Changes", "You have unsaved changes. Save before closing?")
@@ -162,8 +653,70 @@ class JsonlEditorAppTk:
                     return
             elif response is None:
                 return
+        self._write_back_journal()
         self.root.destroy()
 
+    # --- Instrumentation ---
+    def _instrument_ui(self):
+        instrumentation = self.instrumentation
+        self.latency_label.pack(side=tk.BOTTOM, fill=tk.X)
+        instrumentation.listeners.append(self._show_latency)
+        self.listbox.refresh = instrumentation.wrap("listbox.refresh", self.listbox.refresh)
+        self.listbox.set_row_count = instrumentation.wrap("listbox.set_row_count", self.listbox.set_row_count)
+        self.ui_updates.flush = instrumentation.wrap("ui_updates.flush", self.ui_updates.flush)
+        # Waiting for the user in a dialog is not a stall; it is subtracted from the enclosing spans
+        for module, names in ((messagebox, ("showinfo", "showwarning", "showerror", "askyesno", "askyesnocancel")),
+                              (filedialog, ("askopenfilename", "asksaveasfilename", "askdirectory"))):
+            for name in names:
+                setattr(module, name, instrumentation.wrap(f"dialog: {name}", getattr(module, name), exclude=True))
+        self.root.bind_all("<F12>", lambda e: self.show_latency_panel())
+
+    def _show_latency(self, name, seconds, depth):
+        if depth: # Only user-facing operations; their sub-steps are in the panel
+            return
+        stats = self.instrumentation.stats[name]
+        slow = "  SLOW" if seconds * 1000 > self.SLOW_OPERATION_MS else ""
+        self.latency_label.config(text=f"{name}: {seconds * 1000:.1f} ms{slow}   p50 {stats.percentile(0.5) * 1000:.1f} ms   "
+                                       f"p99 {stats.percentile(0.99) * 1000:.1f} ms   n={stats.count}   (F12: all operations)")
+
+    def show_latency_panel(self):
+        if self.latency_panel is not None and self.latency_panel.winfo_exists():
+            self.latency_panel.lift()
+            return
+        panel = self.latency_panel = tk.Toplevel(self.root)
+        panel.title("Latency")
+        text = scrolledtext.ScrolledText(panel, width=96, height=24, wrap=tk.NONE, font="TkFixedFont")
+        text.pack(fill=tk.BOTH, expand=True)
+        buttons = tk.Frame(panel)
+        buttons.pack(fill=tk.X, pady=5)
+        profile_var = tk.StringVar()
+
+        def refresh():
+            if not panel.winfo_exists():
+                return
+            text.config(state=tk.NORMAL)
+            text.delete('1.0', tk.END)
+            text.insert('1.0', self.instrumentation.format_summary())
+            text.config(state=tk.DISABLED)
+            profile_box.config(values=sorted(set(self.INSTRUMENTED_METHODS) | set(self.instrumentation.stats)))
+            panel.after(1000, refresh)
+
+        def copy():
+            self.root.clipboard_clear()
+            self.root.clipboard_append(self.instrumentation.format_summary())
+
+        def profile_next():
+            if profile_var.get():
+                self.instrumentation.profile_next(profile_var.get())
+                self._set_status(f"The next {profile_var.get()} runs under cProfile; the report goes to {self.instrumentation.profile_dir}")
+
+        tk.Button(buttons, text="Reset", command=lambda: self.instrumentation.stats.clear()).pack(side=tk.LEFT, padx=5)
+        tk.Button(buttons, text="Copy", command=copy).pack(side=tk.LEFT, padx=5)
+        tk.Button(buttons, text="Profile Next", command=profile_next).pack(side=tk.RIGHT, padx=5)
+        profile_box = ttk.Combobox(buttons, textvariable=profile_var, width=32, state="readonly")
+        profile_box.pack(side=tk.RIGHT)
+        refresh()
+
     # --- Theme Management ---
     def toggle_theme(self):
         # ... (same as before) ...
@@ -191,12 +744,33 @@ class JsonlEditorAppTk:
                         activeforeground=colors["button_fg"],
                         disabledforeground=colors["disabled_fg"]
                     )
+                elif widget_type in ["Menubutton", "Menu"]:
+                    widget.configure(
+                        bg=colors["button_bg"], fg=colors["button_fg"],
+                        activebackground=colors["button_active_bg"],
+                        activeforeground=colors["button_fg"],
+                        disabledforeground=colors["disabled_fg"]
+                    )
+                elif widget_type == "Entry":
+                    widget.configure(
+                        bg=colors["text_bg"], fg=colors["text_fg"],
+                        insertbackground=colors["text_fg"],
+                        selectbackground=colors["text_select_bg"],
+                        selectforeground=colors["text_select_fg"]
+                    )
+                elif widget_type == "Spinbox":
+                    widget.configure(
+                        bg=colors["text_bg"], fg=colors["text_fg"],
+                        buttonbackground=colors["button_bg"],
+                        insertbackground=colors["text_fg"],
+                        disabledforeground=colors["disabled_fg"]
+                    )
                 elif widget_type == "Listbox":
                     widget.configure(
                         bg=colors["listbox_bg"], fg=colors["listbox_fg"],
                         selectbackground=colors["listbox_select_bg"],
                         selectforeground=colors["listbox_select_fg"]
-                        # itemcget for individual item colors will be handled in populate_listbox
+                        # Per-row colors come from _listbox_row as rows are drawn
                     )
                 elif widget_type == "ScrolledText":
                     text_widget = widget.component('text')
@@ -211,32 +785,22 @@ class JsonlEditorAppTk:
                 print(f"Warning: Could not apply theme to {widget_type} ({widget}): {e}")
         
         # Re-apply item-specific colors if listbox is populated
-        self.populate_listbox(force_refresh_colors=True) # Added force_refresh_colors
+        self.listbox.refresh() # Rows pick up the new colors as they are redrawn
 
 
     # --- Undo/Redo Logic ---
     def _push_state_to_undo(self, description="Action"):
-        # ... (same as before) ...
-        current_data_snapshot = copy.deepcopy(self.data)
-        current_selected_index_snapshot = self.selected_index
-        if self.undo_stack:
-            last_data, last_idx, _ = self.undo_stack[-1]
-            if last_data == current_data_snapshot and last_idx == current_selected_index_snapshot:
-                return
-
-        if len(self.undo_stack) >= self.MAX_UNDO_LEVELS:
-            self.undo_stack.pop(0)
-
-        self.undo_stack.append((current_data_snapshot, current_selected_index_snapshot, description))
-        self.redo_stack.clear()
+        # Opens a new undo step; the history records the store changes that follow it.
+        # Steps that end up changing nothing are discarded.
+        self.dataset.history.begin(description, self.selected_index)
         self._update_undo_redo_buttons_state()
 
-    def _restore_state_from_stack(self, data_snapshot, selected_index_snapshot, action_description="Restored"):
-        # ... (same as before, but will call populate_listbox which now handles dupes) ...
-        self.data = copy.deepcopy(data_snapshot)
+    def _restore_state_from_stack(self, selected_index_snapshot, action_description="Restored"):
+        # The history has already replayed its changes into self.data (and the duplicate index).
         self.selected_index = selected_index_snapshot
+        self._clear_marks()
 
-        self.populate_listbox() # This will re-evaluate duplicates
+        self.populate_listbox()
 
         if 0 <= self.selected_index < len(self.data):
             self._load_item_data_to_fields(self.data[self.selected_index])
@@ -255,35 +819,30 @@ class JsonlEditorAppTk:
 
     def undo_action(self):
         # ... (same as before) ...
-        if not self.undo_stack: return
+        if self.busy_task is not None or not self.dataset.history.can_undo(): return
         self._commit_ui_edits_if_any()
 
-        current_state_for_redo = (copy.deepcopy(self.data), self.selected_index, "Redo State")
-        self.redo_stack.append(current_state_for_redo)
-
-        data_to_restore, idx_to_restore, desc = self.undo_stack.pop()
-        self._restore_state_from_stack(data_to_restore, idx_to_restore, f"Undo: {desc}")
+        entry = self.dataset.history.undo(self.selected_index)
+        self._restore_state_from_stack(entry.selected_before, f"Undo: {entry.description}")
 
 
     def redo_action(self):
         # ... (same as before) ...
-        if not self.redo_stack: return
-
-        current_state_for_undo = (copy.deepcopy(self.data), self.selected_index, "Undo State after Redo")
+        if self.busy_task is not None or not self.dataset.history.can_redo(): return
 
-        data_to_restore, idx_to_restore, desc_from_redo = self.redo_stack.pop()
-        self.undo_stack.append((current_state_for_undo[0], current_state_for_undo[1], f"State before Redo of '{desc_from_redo.replace('Redo State', 'Action')}'"))
-
-        self._restore_state_from_stack(data_to_restore, idx_to_restore, f"Redo: {desc_from_redo.replace('Redo State', 'Action')}")
+        entry = self.dataset.history.redo()
+        self._restore_state_from_stack(entry.selected_after, f"Redo: {entry.description}")
 
     def _update_undo_redo_buttons_state(self):
         # ... (same as before) ...
-        self.undo_button.config(state=tk.NORMAL if self.undo_stack else tk.DISABLED)
-        self.redo_button.config(state=tk.NORMAL if self.redo_stack else tk.DISABLED)
+        idle = self.busy_task is None
+        self.undo_button.config(state=tk.NORMAL if idle and self.dataset.history.can_undo() else tk.DISABLED)
+        self.redo_button.config(state=tk.NORMAL if idle and self.dataset.history.can_redo() else tk.DISABLED)
 
     # --- UI Control and State Management ---
     def _set_status(self, message):
         # ... (same as before) ...
+        self.ui_updates.discard("status") # A newer message wins over a scheduled one
         filename_prefix = f"{os.path.basename(self.current_file_path)}{'*' if self.is_dirty_file else ''} - " if self.current_file_path else ""
         if not self.current_file_path and self.data and self.is_dirty_file: # For new, unsaved file with data
             filename_prefix = f"Untitled.jsonl* - "
@@ -292,117 +851,981 @@ class JsonlEditorAppTk:
 
     def _update_ui_element_states(self):
         # ... (same as before) ...
+        self.ui_updates.discard("states")
         file_context_exists = bool(self.current_file_path or self.data)
         data_exists = bool(self.data)
         item_is_selected = (0 <= self.selected_index < len(self.data))
-
-        self.save_button.config(state=tk.NORMAL if self.current_file_path and self.is_dirty_file else tk.DISABLED)
-        self.save_as_button.config(state=tk.NORMAL if data_exists or self.current_file_path else tk.DISABLED)
-        self.add_item_button.config(state=tk.NORMAL)
-        self.delete_item_button.config(state=tk.NORMAL if item_is_selected else tk.DISABLED)
-
-        text_fields_state = tk.NORMAL if item_is_selected else tk.DISABLED
-        for widget in [self.instruction_text, self.input_text, self.output_text]:
-            if widget.cget('state') != text_fields_state: # Avoid redundant config calls
-                widget.config(state=text_fields_state)
+        idle = self.busy_task is None # Rows can be browsed, not edited, while a load or save runs
+
+        self.new_button.config(state=tk.NORMAL if idle else tk.DISABLED)
+        self.load_button.config(state=tk.NORMAL if idle else tk.DISABLED)
+        self.load_folder_button.config(state=tk.NORMAL if idle else tk.DISABLED)
+        self.save_button.config(state=tk.NORMAL if idle and self.current_file_path and self.is_dirty_file else tk.DISABLED)
+        self.save_as_button.config(state=tk.NORMAL if idle and (data_exists or self.current_file_path) else tk.DISABLED)
+        self.add_item_button.config(state=tk.NORMAL if idle else tk.DISABLED)
+        self.near_button.config(state=tk.NORMAL if idle else tk.DISABLED)
+        self.follow_button.config(state=tk.NORMAL if idle and (self.current_file_path or self.follower) else tk.DISABLED)
+        for button in (self.search_prev_button, self.search_next_button):
+            button.config(state=tk.NORMAL if idle and self.search_results else tk.DISABLED)
+        for box in (self.view_filter_box, self.view_sort_box):
+            box.config(state="readonly" if idle else tk.DISABLED)
+        self.delete_item_button.config(state=tk.NORMAL if idle and (item_is_selected or self.mark_count) else tk.DISABLED,
+                                       text=f"Delete {self.mark_count} Items" if self.mark_count > 1 else "Delete Item")
+        self.batch_button.config(state=tk.NORMAL if idle and data_exists else tk.DISABLED)
+        self.compare_button.config(state=tk.NORMAL if idle else tk.DISABLED)
+        self.reference_button.config(state=tk.NORMAL if idle else tk.DISABLED)
+        self.stats_button.config(state=tk.NORMAL if idle else tk.DISABLED)
+
+        text_fields_state = tk.NORMAL if idle and item_is_selected else tk.DISABLED
+        for key, widget in self._field_widgets():
+            state = tk.DISABLED if widget in self._field_loads else text_fields_state # Read-only until loaded
+            if widget.cget('state') != state: # Avoid redundant config calls
+                widget.config(state=state)
 
         self._update_undo_redo_buttons_state()
 
 
+    def _schedule_status(self, message):
+        self._pending_status = message
+        self.ui_updates.mark("status")
+
     def mark_ui_field_dirty(self):
-        # ... (same as before) ...
-        if self.selected_index != -1 and self.instruction_text.cget("state") == tk.NORMAL:
-             self.ui_text_field_is_dirty = True
-             self.is_dirty_file = True
-             self._update_ui_element_states()
-             self._set_status(f"Editing Item {self.selected_index + 1}. Changes not saved.")
+        # Runs on every key: only the edited row's preview is redrawn live, and the buttons
+        # and status only change on the first key of an edit. All of it waits for the next flush.
+        # Keys that change nothing (arrows, modifiers) leave the widgets' modified flags unset.
+        if self.selected_index == -1 or not any(widget.edit_modified() for key, widget in self._field_widgets()):
+            return
+        if not self.ui_text_field_is_dirty:
+            self.ui_text_field_is_dirty = True
+            self.is_dirty_file = True
+            self.ui_updates.mark("states")
+            self._schedule_status(f"Editing Item {self.selected_index + 1}. Changes not saved.")
+        self.ui_updates.mark("preview")
 
     # --- Duplicate Detection ---
     def _find_duplicate_inputs(self):
-        self.input_counts.clear()
-        self.duplicate_input_indices.clear()
-        temp_input_indices = defaultdict(list) # Store all indices for each input
+        # Full rescan, only needed when self.data is replaced; edits, adds and deletes
+        # keep the index current through the store's change events.
+        self.dataset.duplicates.attach(self.data)
+
+    def _refresh_duplicate_rows(self):
+        # Redraw only the rows in view whose duplicate status flipped.
+        changed = self.dataset.duplicates.take_changed()
+        if self.dataset.contamination is not None:
+            changed |= self.dataset.contamination.take_changed()
+        near = self.dataset.near_duplicates
+        near_changed = near.take_changed() if near is not None else set()
+        view = self.dataset.view
+        if view is not None and view.refresh(changed | near_changed): # Rows joined or left the view
+            self.populate_listbox()
+            return
+        if near_changed:
+            self.listbox.refresh() # Clusters may have merged or split; cheap for the rows in view
+            return
+        if not changed:
+            return
+        first, last = self.listbox.visible_range()
+        for row in range(first, min(last, self._row_count())):
+            if self._row_record_id(row) in changed:
+                self.listbox.refresh_row(row)
+
+
+    def toggle_near_duplicates(self):
+        if self.busy_task is not None: return
+        self.near_duplicates_enabled = not self.near_duplicates_enabled
+        self.near_button.config(text=f"Near Duplicates: {'On' if self.near_duplicates_enabled else 'Off'}")
+        if self.near_duplicates_enabled:
+            self._find_near_duplicates()
+        else:
+            self.dataset.set_near_duplicates(None)
+            self.listbox.refresh()
+            self._set_status("Near-duplicate detection turned off.")
+            self._refresh_near_duplicate_view()
+
+    # --- Follow Mode ---
+    def toggle_follow(self):
+        if self.busy_task is not None: return
+        if self.follower is not None:
+            self._stop_following()
+            self._set_status("Stopped following the file.")
+            return
+        if not self.current_file_path or self.data.path != self.current_file_path:
+            return
+        try:
+            self.follower = TailFollower(self.dataset)
+        except ValueError as e:
+            messagebox.showwarning("Follow", f"{e}.")
+            return
+        self.follow_button.config(text="Follow: On")
+        self._set_status(f"Following {os.path.basename(self.current_file_path)}: lines appended to it are added as they arrive.")
+        self._poll_follow()
+
+    def _stop_following(self):
+        if self._follow_after_id is not None:
+            self.root.after_cancel(self._follow_after_id)
+            self._follow_after_id = None
+        self.follower = None
+        self.follow_button.config(text="Follow: Off")
+        self._update_ui_element_states()
+
+    def _poll_follow(self):
+        self._follow_after_id = None
+        if self.follower is None:
+            return
+        if self.follower.dataset is not self.dataset:
+            self._stop_following()
+            return
+        if self.busy_task is None: # The store is not touched while a load or save runs
+            try:
+                self._take_appended_lines()
+            except (FileChangedError, OSError) as e:
+                self._stop_following()
+                messagebox.showwarning("Follow", f"Stopped following the file: {e}.\n\nReload it to see its current contents.")
+                return
+        self._follow_after_id = self.root.after(self.FOLLOW_POLL_MS, self._poll_follow)
+
+    def _take_appended_lines(self):
+        # Appends the records that arrived since the last poll; the list follows the end of
+        # the file when its last row was in view. Raises FileChangedError when the file was
+        # truncated or replaced.
+        at_end = self.listbox.visible_range()[1] >= self._row_count()
+        total_added, total_errors = 0, 0
+        while True: # A large burst is taken in BATCH_BYTES at a time
+            added, errors = self.follower.poll()
+            total_added += added
+            total_errors += len(errors)
+            if not added and not errors:
+                break
+        if not total_added and not total_errors:
+            return
+        self.populate_listbox()
+        if at_end and self._row_count():
+            self.listbox.see(self._row_count() - 1)
+        skipped = f", skipped {total_errors} invalid lines" if total_errors else ""
+        self._schedule_status(f"Following {os.path.basename(self.current_file_path)}: {total_added} new items, {len(self.data)} in total{skipped}")
 
-        for i, item_data in enumerate(self.data):
-            input_val = item_data.get(self.KEY_INPUT, "").strip() # Normalize by stripping
-            if input_val: # Only consider non-empty inputs for duplication
-                self.input_counts[input_val] += 1
-                temp_input_indices[input_val].append(i)
+    def _near_threshold(self):
+        try:
+            threshold = float(self.near_threshold_var.get())
+        except ValueError:
+            threshold = self.NEAR_DUPLICATE_THRESHOLD
+        threshold = min(1.0, max(0.5, threshold))
+        self.near_threshold_var.set(f"{threshold:.2f}")
+        return threshold
+
+    def _on_near_threshold_change(self):
+        if self.near_duplicates_enabled and self.busy_task is None:
+            self._find_near_duplicates() # Signatures are reused; only the buckets are rebuilt
+
+    def _find_near_duplicates(self):
+        # Hashes every input on a worker thread; edits are blocked meanwhile, and afterwards
+        # the index follows them through the store's change events.
+        self._commit_ui_edits_if_any()
+        threshold = self._near_threshold()
+        dataset = self.dataset
+        if not dataset.store:
+            dataset.set_near_duplicates(dataset.build_near_duplicates(threshold))
+            return
+        self._start_task("Finding near-duplicates",
+                         lambda task: dataset.build_near_duplicates(threshold, task),
+                         on_message=lambda kind, done, total: self._show_progress(done, total),
+                         on_done=lambda index, error: self._on_near_duplicates_found(dataset, threshold, index, error))
 
-        for input_val, count in self.input_counts.items():
-            if count > 1:
-                for index in temp_input_indices[input_val]:
-                    self.duplicate_input_indices.add(index)
-        # print(f"DEBUG: Duplicate indices: {self.duplicate_input_indices}")
+    def _on_near_duplicates_found(self, dataset, threshold, index, error):
+        if dataset is not self.dataset:
+            return
+        if error is not None or index is None:
+            if error is not None:
+                messagebox.showerror("Near Duplicates", f"Could not find near-duplicates: {error}")
+            self.near_duplicates_enabled = False
+            self.near_button.config(text="Near Duplicates: Off")
+            dataset.set_near_duplicates(None)
+            self.listbox.refresh()
+            if error is None:
+                self._set_status("Near-duplicate detection cancelled.")
+            self._refresh_near_duplicate_view()
+            return
+        dataset.set_near_duplicates(index)
+        self.listbox.refresh()
+        self._set_status(f"{index.duplicate_count()} near-duplicate items in {index.cluster_count()} clusters (similarity {threshold:.2f} or more)")
+        self._refresh_near_duplicate_view()
+
+    # --- Contamination Check ---
+    def add_reference_files(self):
+        # Reference files (eval sets) are indexed once, next to themselves; records of the
+        # open dataset found in them are flagged and stay flagged through edits.
+        if self.busy_task is not None: return
+        paths = filedialog.askopenfilenames(title="Add Reference Files (Eval Sets)", filetypes=self.FILE_TYPES)
+        if not paths:
+            return
+        self.reference_paths.extend(path for path in paths if path not in self.reference_paths)
+        self._check_contamination()
+
+    def clear_reference_files(self):
+        if self.busy_task is not None: return
+        self.reference_paths = []
+        self.dataset.set_contamination(None)
+        self.listbox.refresh()
+        self._set_status("Reference files cleared.")
+        self._refresh_contamination_view()
+
+    def _check_contamination(self):
+        # Indexes new or changed reference files and checks every record on a worker thread;
+        # edits are blocked meanwhile, and afterwards the index follows them through the
+        # store's change events.
+        self._commit_ui_edits_if_any()
+        dataset = self.dataset
+        paths = list(self.reference_paths)
+        self._start_task("Checking against reference files",
+                         lambda task: dataset.build_contamination(paths, task, self.scan_workers),
+                         on_message=lambda kind, done, total: self._show_progress(done, total),
+                         on_done=lambda index, error: self._on_contamination_checked(dataset, paths, index, error))
+
+    def _on_contamination_checked(self, dataset, paths, index, error):
+        if dataset is not self.dataset:
+            if index is not None:
+                index.close()
+            return
+        if error is not None or index is None:
+            if error is not None:
+                messagebox.showerror("Eval Sets", f"Could not check against the reference files: {error}")
+                self.reference_paths = []
+            else:
+                self._set_status("Contamination check cancelled.")
+            dataset.set_contamination(None)
+            self.listbox.refresh()
+            self._refresh_contamination_view()
+            return
+        dataset.set_contamination(index)
+        self.listbox.refresh()
+        names = ", ".join(os.path.basename(path) for path in paths)
+        self._set_status(f"{index.contaminated_count()} items found in {names}")
+        self._refresh_contamination_view()
+
+    def _contamination_note(self, index):
+        contamination = self.dataset.contamination
+        if contamination is None or not contamination.is_contaminated(self.data.record_id(index)):
+            return ""
+        notes = [f"{'in' if flag == contamination.EXACT else 'overlaps'} {os.path.basename(reference.path)}"
+                 for reference, flag in contamination.matches(self.data[index])]
+        return f" (eval set: {', '.join(notes)})"
+
+    # --- Statistics Panel ---
+    def show_statistics(self):
+        # Field lengths, token estimates, missing and empty fields, repeated instructions and
+        # duplicate groups of the whole dataset. Counted once on a worker thread; after that
+        # every edit, add and delete updates the counts, and the panel redraws shortly after.
+        if self.stats_panel is not None and self.stats_panel.winfo_exists():
+            self.stats_panel.lift()
+            return
+        if self.busy_task is not None: return
+        panel = self.stats_panel = tk.Toplevel(self.root)
+        panel.title("Statistics")
+        panel.protocol("WM_DELETE_WINDOW", self._close_statistics)
+        text = self.stats_text = scrolledtext.ScrolledText(panel, width=96, height=32, wrap=tk.NONE, font="TkFixedFont")
+        text.pack(fill=tk.BOTH, expand=True)
+        buttons = tk.Frame(panel)
+        buttons.pack(fill=tk.X, pady=5)
+
+        def copy():
+            self.root.clipboard_clear()
+            self.root.clipboard_append(text.get('1.0', 'end-1c'))
+
+        tk.Button(buttons, text="Copy", command=copy).pack(side=tk.LEFT, padx=5)
+        tk.Button(buttons, text="Close", command=self._close_statistics).pack(side=tk.RIGHT, padx=5)
+        self._stats_shown = None
+        if self.dataset.stats is None:
+            self._compute_statistics()
+        self._refresh_statistics()
+
+    def _close_statistics(self):
+        if self._stats_after_id is not None:
+            self.root.after_cancel(self._stats_after_id)
+            self._stats_after_id = None
+        if self.stats_panel is not None and self.stats_panel.winfo_exists():
+            self.stats_panel.destroy()
+        self.stats_panel = self.stats_text = self._stats_shown = None
+        self.dataset.set_stats(None) # Edits stop updating counts nobody looks at
+
+    def _compute_statistics(self):
+        if self.stats_panel is None: # Closed while queued behind another build
+            return
+        self._commit_ui_edits_if_any()
+        dataset = self.dataset
+        if not dataset.store:
+            dataset.set_stats(dataset.build_stats())
+            return
+        self._start_task("Computing statistics", lambda task: dataset.build_stats(task),
+                         on_message=lambda kind, done, total: self._show_progress(done, total),
+                         on_done=lambda stats, error: self._on_statistics_computed(dataset, stats, error))
 
+    def _on_statistics_computed(self, dataset, stats, error):
+        if dataset is not self.dataset or self.stats_panel is None: # Closed meanwhile
+            return
+        if error is not None or stats is None:
+            if error is not None:
+                messagebox.showerror("Statistics", f"Could not compute the statistics: {error}")
+            else:
+                self._set_status("Statistics cancelled.")
+            self._close_statistics()
+            return
+        dataset.set_stats(stats)
+        self._set_status(f"Statistics of {len(self.data)} items computed; they follow your edits.")
+
+    def _refresh_statistics(self):
+        # Polled while the panel is open, so a burst of edits is drawn once.
+        self._stats_after_id = None
+        if self.stats_panel is None or not self.stats_panel.winfo_exists():
+            return
+        stats = self.dataset.stats
+        shown = (stats, stats.version if stats is not None else None)
+        if shown != self._stats_shown:
+            self._stats_shown = shown
+            self._draw_statistics(stats)
+        self._stats_after_id = self.root.after(self.STATS_REFRESH_MS, self._refresh_statistics)
+
+    def _draw_statistics(self, stats):
+        text = self.stats_text
+        top = text.yview()[0]
+        text.config(state=tk.NORMAL)
+        text.delete('1.0', tk.END)
+        text.insert('1.0', self._statistics_report(stats.summary()) if stats is not None else "Counting...")
+        text.config(state=tk.DISABLED)
+        text.yview_moveto(top)
+
+    def _statistics_report(self, summary):
+        groups = summary["duplicate_groups"]
+        lines = [f"{summary['records']:,} items, about {summary['tokens']:,} tokens "
+                 f"(one per {RecordStats.TOKEN_CHARS} characters)",
+                 f"Duplicate inputs: {summary['duplicate_inputs']:,} items repeat an earlier input"
+                 + (f", in {sum(groups.values()):,} groups: " + ", ".join(f"{count:,} of {size}" for size, count in groups.items())
+                    if groups else ""),
+                 "",
+                 f"{'Field':<14}{'Missing':>10}{'Empty':>10}{'Mean chars':>12}{'Max chars':>12}{'Mean tokens':>13}{'Tokens':>14}"]
+        for key, field in summary["fields"].items():
+            lines.append(f"{key:<14}{field['missing']:>10,}{field['empty']:>10,}{field['mean_chars']:>12,}"
+                         f"{field['max_chars']:>12,}{field['mean_tokens']:>13,}{field['tokens']:>14,}")
+        for key, field in summary["fields"].items():
+            lines += ["", f"{key} length in characters"]
+            peak = max((values for low, high, values in field["histogram"]), default=0)
+            for low, high, values in field["histogram"]:
+                label = f"{low:,}" if low == high else f"{low:,}-{high:,}"
+                lines.append(f"{label:>16}{values:>11,}  {'█' * round(self.STATS_BAR_WIDTH * values / peak)}")
+        if summary["top_instructions"]:
+            lines += ["", "Most repeated instructions"]
+            for entry in summary["top_instructions"]:
+                preview = entry["instruction"].replace('\n', ' ')
+                lines.append(f"{entry['records']:>11,}  {preview[:80]}{'...' if len(preview) > 80 else ''}")
+        return "\n".join(lines)
+
+    # --- Search ---
+    def run_search(self):
+        # Runs the query in the search box and selects the first match after the current row.
+        # A repeated query that is still current just moves on to the next match.
+        if self.busy_task is not None: return
+        self._commit_ui_edits_if_any()
+        query = self.search_var.get().strip()
+        mode = self.SEARCH_MODES.get(self.search_mode_var.get(), "token")
+        if not query:
+            self._clear_search_results()
+            return
+        if (query, mode) == self.search_query and self.search_version == self.data.version:
+            self.show_search_result(1)
+            return
+        if mode == "regex":
+            try:
+                re.compile(query)
+            except re.error as e:
+                self._clear_search_results()
+                self._set_status(f"Invalid regular expression: {e}")
+                return
+            dataset = self.dataset
+            self._start_task("Searching", lambda task: dataset.find(query, mode, task),
+                             on_message=lambda kind, done, total: self._show_progress(done, total),
+                             on_done=lambda positions, error: self._on_search_done(dataset, query, mode, positions, error))
+            return
+        self._on_search_done(self.dataset, query, mode, self.dataset.find(query, mode), None)
+
+    def _on_search_done(self, dataset, query, mode, positions, error):
+        if dataset is not self.dataset:
+            return
+        if error is not None:
+            messagebox.showerror("Search", f"Search failed: {error}")
+            return
+        if positions is None:
+            self._set_status("Search cancelled.")
+            return
+        self.search_results = positions
+        self.search_query = (query, mode)
+        self.search_version = self.data.version
+        self.show_search_result(1, include_current=True)
+
+    def show_search_result(self, step, include_current=False):
+        # Selects the next (step=1) or previous (step=-1) match, wrapping around.
+        if self.busy_task is not None: return
+        if self.search_query is not None and self.search_version != self.data.version:
+            if self.search_query[1] != "regex": # Cheap to refresh after edits; a regex scan is not
+                self.search_results = self.dataset.find(*self.search_query)
+                self.search_version = self.data.version
+        results = self.search_results
+        if not results:
+            self.search_label.config(text="No matches" if self.search_query else "")
+            self._update_ui_element_states()
+            return
+        current = self.selected_index
+        if step > 0:
+            i = bisect.bisect_left(results, current) if include_current else bisect.bisect_right(results, current)
+            i = i if i < len(results) else 0
+        else:
+            i = bisect.bisect_left(results, current) - 1
+            i = i if i >= 0 else len(results) - 1
+        position = results[i]
+        if position >= len(self.data):
+            return
+        stale = " (before edits)" if self.search_version != self.data.version else ""
+        self.search_label.config(text=f"{i + 1} of {len(results)}{stale}")
+        self._select_row(position)
+
+    def _clear_search_results(self):
+        self.search_results = []
+        self.search_query = None
+        self.search_label.config(text="")
+        self._update_ui_element_states()
+
+    # --- Views ---
+    def apply_view(self):
+        # Filters and sorts the list as chosen in the view boxes. The view is built on a
+        # worker thread and then follows edits; rows keep their item numbers.
+        if self.busy_task is not None: return
+        self._commit_ui_edits_if_any()
+        filter_name = self.VIEW_FILTERS.get(self.view_filter_var.get(), "all")
+        sort, descending = self.VIEW_SORTS.get(self.view_sort_var.get(), ("position", False))
+        query = self.search_var.get().strip()
+        mode = self.SEARCH_MODES.get(self.search_mode_var.get(), "token")
+        if filter_name == "search":
+            error = None if query else "Type a query in the search box first."
+            if query and mode == "regex":
+                try:
+                    re.compile(query)
+                except re.error as e:
+                    error = f"Invalid regular expression: {e}"
+            if error:
+                messagebox.showinfo("View", error)
+                self.view_filter_var.set("All items")
+                filter_name = "all"
+        dataset = self.dataset
+        if filter_name == "all" and sort == "position":
+            dataset.set_view(None)
+            self.populate_listbox()
+            self._set_status(f"Showing all {len(self.data)} items.")
+            return
+        self._start_task("Building view", lambda task: dataset.build_view(filter_name, sort, descending, query, mode, task),
+                         on_message=lambda kind, done, total: self._show_progress(done, total),
+                         on_done=lambda view, error: self._on_view_built(dataset, view, error))
+
+    def _on_view_built(self, dataset, view, error):
+        if dataset is not self.dataset:
+            return
+        if error is not None:
+            messagebox.showerror("View", f"Could not build the view: {error}")
+            return
+        if view is None:
+            self._set_status("View cancelled.")
+            return
+        dataset.set_view(view)
+        if self._row_of(self.selected_index) < 0:
+            self.selected_index = -1 # Select the first row of the view instead
+        self.populate_listbox()
+        self._schedule_status(f"Showing {len(view)} of {len(self.data)} items.")
+
+    def _reset_view_boxes(self):
+        # A new dataset starts without a view.
+        self.view_filter_var.set("All items")
+        self.view_sort_var.set("File order")
+
+    def _refresh_near_duplicate_view(self):
+        if self.VIEW_FILTERS.get(self.view_filter_var.get()) == "near_duplicates" and self.dataset.view is not None:
+            self.apply_view() # Its rows came from the index that was just replaced
+
+    def _refresh_contamination_view(self):
+        if self.VIEW_FILTERS.get(self.view_filter_var.get()) == "contaminated" and self.dataset.view is not None:
+            self.apply_view()
+
+    def _select_row(self, index):
+        self._commit_ui_edits_if_any()
+        self.listbox.selection_clear()
+        row = self._row_of(index)
+        if row < 0: # Left out by the view: shown in the fields only
+            self.selected_index = index
+            self._load_item_data_to_fields(self.data[index])
+            self._set_status(f"Displaying Item {index + 1} of {len(self.data)} (not in the current view)")
+            self.ui_text_field_is_dirty = False
+            self._update_ui_element_states()
+            return
+        self.listbox.selection_set(row)
+        self.listbox.see(row)
+        self.listbox.activate(row)
+        self.listbox.anchor = row
+        self.selected_index = -1 # Let on_list_item_select load the row even if it is selected already
+        self.on_list_item_select(None)
 
     # --- File Operations ---
     def new_file(self):
         # ... (same as before, but populate_listbox will handle dupe detection) ...
+        if self.busy_task is not None: return
         self._commit_ui_edits_if_any()
         if self.is_dirty_file:
             if not messagebox.askyesno("Unsaved Changes", "You have unsaved changes. Discard them and create a new file?"):
                 return
 
+        self._write_back_journal()
         self.clear_all_app_state(is_new_file=True)
         self.file_label.config(text="Untitled.jsonl")
         self.is_dirty_file = False
         self._set_status("New file created. Add items or load data.")
-        self._push_state_to_undo("New Empty File")
         self._update_ui_element_states()
         self._find_duplicate_inputs() # Check for duplicates in (empty) data
         self.populate_listbox() # Refresh listbox
+        if self.reference_paths:
+            self._check_contamination()
 
 
-    def load_file(self):
+    def load_file(self, filepath=None):
         # ... (same as before, but populate_listbox will handle dupe detection) ...
+        if self.busy_task is not None: return
         self._commit_ui_edits_if_any()
         if self.is_dirty_file:
             if messagebox.askyesno("Unsaved Changes", "You have unsaved changes. Save them before loading a new file?"):
                 if not self.save_data_to_file(autosave=False): return
 
-        filepath = filedialog.askopenfilename(
-            defaultextension=".jsonl",
-            filetypes=[("JSONL files", "*.jsonl"), ("All files", "*.*")]
-        )
+        if filepath is None:
+            filepath = filedialog.askopenfilename(defaultextension=".jsonl", filetypes=self.FILE_TYPES)
         if not filepath: return
 
+        self._write_back_journal()
         self.current_file_path = filepath
-        loaded_data = []
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                for line_num, line in enumerate(f):
-                    line = line.strip()
-                    if line:
-                        try: loaded_data.append(json.loads(line))
-                        except json.JSONDecodeError as e:
-                            messagebox.showerror("JSON Error", f"Error parsing JSON on line {line_num+1}: {e}\n\n'{line[:100]}{'...' if len(line)>100 else ''}'")
-                            self.clear_all_app_state()
-                            return
-
-            self.data = loaded_data
-            self.undo_stack.clear()
-            self.redo_stack.clear()
-            self._push_state_to_undo("Initial Load")
-
-            self.populate_listbox() # This will now also color duplicates
-            self.file_label.config(text=os.path.basename(filepath))
-            self._set_status(f"Loaded {len(self.data)} items from {os.path.basename(filepath)}")
+            # Only maps the file; a worker thread indexes, validates and hashes the lines
+            # while the rows found so far can already be browsed.
+            loaded = Dataset.map(filepath)
+        except Exception as e:
+            messagebox.showerror("Error loading file", str(e))
+            self.clear_all_app_state()
+            return
 
-            if not self.data:
-                self.clear_text_fields()
+        self._stop_following()
+        self.dataset.close()
+        self.dataset = loaded # Empty history and duplicate index; filled as batches arrive
+        self.selected_index = -1 # Select the first row of the new file
+        self._clear_search_results()
+        self._reset_view_boxes()
+        self._clear_marks()
+        self.populate_listbox()
+        self.file_label.config(text=self._file_title(filepath))
+        self.is_dirty_file = False
+        self.ui_text_field_is_dirty = False
+        self._set_status(f"Loading {os.path.basename(filepath)}...")
+
+        self._start_task(f"Loading {os.path.basename(filepath)}",
+                         lambda task: loaded.scan(task, self.scan_workers),
+                         on_message=lambda *message: self._on_load_batch(loaded, *message),
+                         on_done=lambda result, error: self._on_load_done(loaded, result, error))
+
+    def load_folder(self):
+        # A directory of shards (train-00000-of-00128.jsonl.gz...) is opened as one dataset.
+        if self.busy_task is not None: return
+        folder = filedialog.askdirectory(mustexist=True)
+        if folder:
+            self.load_file(folder)
+
+    def _file_title(self, path):
+        shards = self.dataset.store.shard_paths if path == self.dataset.path else []
+        name = os.path.basename(path.rstrip("/\\"))
+        return f"{name} ({len(shards)} shards)" if len(shards) > 1 else name
+
+    def _on_load_batch(self, dataset, kind, *message):
+        if dataset is not self.dataset:
+            return
+        if kind == "progress": # Decompressing a shard
+            self._show_progress(*message)
+            return
+        starts, ends, line_numbers, hashes, position, total, shard = message
+        dataset.extend_scanned(starts, ends, line_numbers, hashes, shard)
+        self.populate_listbox() # Selects the first row once there is one
+        self._show_progress(position, total)
+        self._set_status(f"Loading {os.path.basename(dataset.path)}... {len(dataset)} items so far")
+
+    def _on_load_done(self, dataset, result, error):
+        if dataset is not self.dataset:
+            return
+        filepath = dataset.path
+        if error is not None:
+            messagebox.showerror("Error loading file", str(error))
+            self.clear_all_app_state()
+            return
+        if result is None:
+            self.clear_all_app_state() # A partial dataset must never be saved over the file
+            self._set_status("Loading cancelled.")
+            return
 
-            self.is_dirty_file = False
-            self.ui_text_field_is_dirty = False
-            self._update_ui_element_states()
+        dataset.finish_scan(result) # Search index built by the load worker; follows edits from here on
+
+        recovered = self._recover_journal(filepath)
+        self._set_status(f"Loaded {len(self.data)} items from {os.path.basename(filepath)}")
+        if recovered:
+            self.dataset.history.clear() # Recovered edits are not undo steps
+            self.populate_listbox()
+            if 0 <= self.selected_index < len(self.data):
+                self._load_item_data_to_fields(self.data[self.selected_index])
+            self._set_status(f"Loaded {len(self.data)} items from {os.path.basename(filepath)}, recovered {recovered} autosaved edits")
+            self._schedule_compaction()
+
+        if not self.data:
+            self.clear_text_fields()
+        self._update_ui_element_states()
+        if dataset.invalid_lines:
+            self._set_status(f"Loaded {len(self.data)} items from {os.path.basename(filepath)}, skipped {len(dataset.invalid_lines)} invalid lines")
+            self.show_invalid_lines_report(dataset)
+        self._rebuild_indexes()
+
+    def show_invalid_lines_report(self, dataset):
+        # Lines that are not valid JSON are left out of the dataset rather than aborting the
+        # load; they are listed here and removed from the file if it is saved.
+        errors = dataset.invalid_lines
+        report = "\n".join(f"{e}\n    {e.line_text[:200]}{'...' if len(e.line_text) > 200 else ''}" for e in errors)
+        panel = tk.Toplevel(self.root)
+        panel.title(f"Invalid Lines - {os.path.basename(dataset.path)}")
+        tk.Label(panel, anchor=tk.W, justify=tk.LEFT,
+                 text=f"{len(errors)} lines are not valid JSON and were not loaded.\n"
+                      "Saving the file removes them; fix them in a text editor to keep them.").pack(fill=tk.X, padx=5, pady=5)
+        text = scrolledtext.ScrolledText(panel, width=100, height=20, wrap=tk.NONE, font="TkFixedFont")
+        text.pack(fill=tk.BOTH, expand=True)
+        text.insert('1.0', report)
+        text.config(state=tk.DISABLED)
+        buttons = tk.Frame(panel)
+        buttons.pack(fill=tk.X, pady=5)
+
+        def save_report():
+            path = filedialog.asksaveasfilename(parent=panel, defaultextension=".txt",
+                                                initialfile=f"{os.path.basename(dataset.path)}.errors.txt",
+                                                filetypes=[("Text files", "*.txt"), ("All files", "*.*")])
+            if not path:
+                return
+            try:
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(report + "\n")
+            except OSError as e:
+                messagebox.showerror("Save Error", f"Could not write the report: {e}", parent=panel)
+
+        tk.Button(buttons, text="Save Report...", command=save_report).pack(side=tk.LEFT, padx=5)
+        tk.Button(buttons, text="Close", command=panel.destroy).pack(side=tk.RIGHT, padx=5)
+
+    # --- Comparing and Merging Versions ---
+    DIFF_LABELS = {"added": "+", "removed": "-", "modified": "~", "moved": ">"} # Kind -> row prefix
+
+    def compare_with_file(self):
+        # Lists what changed between another version of the dataset and the open file (or a
+        # second file when none is open). Both files are streamed on a worker thread.
+        if self.busy_task is not None: return
+        self._commit_ui_edits_if_any()
+        new_path = self.current_file_path if self.current_file_path and os.path.isfile(self.current_file_path) else None
+        if new_path and self.is_dirty_file:
+            messagebox.showinfo("Compare", "The comparison reads the open file as last saved; save it first to include your latest edits.")
+        old_path = filedialog.askopenfilename(title="Compare with which other version?", filetypes=self.FILE_TYPES)
+        if not old_path: return
+        if new_path is None:
+            new_path = filedialog.askopenfilename(title="...and which newer version?", filetypes=self.FILE_TYPES)
+            if not new_path: return
+        dataset = self.dataset if new_path == self.current_file_path else None
+        self._start_task(f"Comparing {os.path.basename(old_path)}",
+                         lambda task: compare_files(old_path, new_path, task=task),
+                         on_message=lambda kind, done, total: self._show_progress(done, total),
+                         on_done=lambda result, error: self._on_compare_done(old_path, new_path, dataset, result, error))
+
+    def _on_compare_done(self, old_path, new_path, dataset, result, error):
+        if error is not None:
+            messagebox.showerror("Compare", f"Could not compare the files: {error}")
+            return
+        if result is None:
+            self._set_status("Comparison cancelled.")
+            return
+        entries, errors = result
+        if not entries:
+            messagebox.showinfo("Compare", f"{os.path.basename(old_path)} and {os.path.basename(new_path)} have the same records.")
+            return
+        self.show_diff_window(entries, errors, old_path, new_path, dataset)
+
+    def show_diff_window(self, entries, errors, old_path, new_path, dataset):
+        # One row per difference, colored by kind; the selected one is shown below with the
+        # fields it changed highlighted. Go to Item selects it in the editor when the newer
+        # version is the open dataset.
+        colors = self.themes[self.current_theme_name]
+        counts = {kind: 0 for kind in self.DIFF_LABELS}
+        for entry in entries:
+            counts[entry.kind] += 1
+        panel = tk.Toplevel(self.root)
+        panel.title(f"Compare - {os.path.basename(old_path)} -> {os.path.basename(new_path)}")
+        panel.geometry("900x600")
+        summary = ", ".join(f"{count} {kind}" for kind, count in counts.items())
+        skipped = f"; {len(errors)} invalid lines skipped" if errors else ""
+        tk.Label(panel, anchor=tk.W, text=f"{summary}{skipped}").pack(fill=tk.X, padx=5, pady=5)
+
+        def row(index):
+            entry = entries[index]
+            record = entry.new_record if entry.new_record is not None else entry.old_record
+            preview = str(record.get(self.KEY_INSTRUCTION, '') if isinstance(record, dict) else record)[:60].replace('\n', ' ')
+            if entry.kind == "removed":
+                where = f"was Item {entry.old_position + 1}"
+            elif entry.kind == "moved":
+                where = f"Item {entry.new_position + 1}, was {entry.old_position + 1}"
+            else:
+                where = f"Item {entry.new_position + 1}"
+            fields = f" ({', '.join(str(key) for key in entry.fields)})" if entry.fields and entry.fields != (None,) else ""
+            return f"{self.DIFF_LABELS[entry.kind]} {where}{fields}: {preview}", colors[f"diff_{entry.kind}_bg"], colors["diff_fg"]
+
+        rows = VirtualListbox(panel, row, height=12)
+        rows.pack(fill=tk.BOTH, expand=True, padx=5)
+        rows.listbox.configure(bg=colors["listbox_bg"], fg=colors["listbox_fg"], selectbackground=colors["listbox_select_bg"],
+                               selectforeground=colors["listbox_select_fg"])
+        detail = scrolledtext.ScrolledText(panel, height=14, wrap=tk.WORD)
+        detail.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        detail.configure(background=colors["text_bg"], foreground=colors["text_fg"])
+        detail.heading_font = tkfont.Font(font=detail.cget('font')) # Kept alive with the widget
+        detail.heading_font.configure(weight="bold")
+        detail.tag_configure("heading", font=detail.heading_font)
+        for kind in ("added", "removed"):
+            detail.tag_configure(kind, background=colors[f"diff_{kind}_bg"], foreground=colors["diff_fg"])
+
+        def value_text(record, key):
+            if not isinstance(record, dict):
+                return str(record)
+            if key not in record:
+                return "(missing)"
+            value = record[key]
+            return value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+
+        def show(event=None):
+            selection = rows.curselection()
+            if not selection:
+                return
+            entry = entries[selection[0]]
+            old, new = entry.old_record, entry.new_record
+            detail.config(state=tk.NORMAL)
+            detail.delete('1.0', tk.END)
+            keys = [key for key in (new if isinstance(new, dict) else {})]
+            keys += [key for key in (old if isinstance(old, dict) else {}) if key not in keys]
+            for key in keys or [None]:
+                detail.insert(tk.END, f"{key}:\n" if key is not None else "", "heading")
+                changed = entry.kind in ("added", "removed") or key in entry.fields or entry.fields == (None,)
+                if not changed:
+                    detail.insert(tk.END, value_text(new, key) + "\n\n")
+                    continue
+                if old is not None:
+                    detail.insert(tk.END, value_text(old, key) + "\n", "removed")
+                if new is not None:
+                    detail.insert(tk.END, value_text(new, key) + "\n", "added")
+                detail.insert(tk.END, "\n")
+            detail.config(state=tk.DISABLED)
+            go_button.config(state=tk.NORMAL if can_go_to(entry) else tk.DISABLED)
+
+        def can_go_to(entry):
+            return (dataset is not None and dataset is self.dataset and self.busy_task is None
+                    and entry.new_position is not None and entry.new_position < len(self.data))
+
+        def go_to_item():
+            selection = rows.curselection()
+            if selection and can_go_to(entries[selection[0]]):
+                self._select_row(entries[selection[0]].new_position)
+
+        def save_report():
+            path = filedialog.asksaveasfilename(parent=panel, defaultextension=".jsonl",
+                                                initialfile=f"{os.path.basename(new_path)}.diff.jsonl",
+                                                filetypes=[("JSON Lines files", "*.jsonl"), ("All files", "*.*")])
+            if not path:
+                return
+            try:
+                with open(path, 'w', encoding='utf-8') as f:
+                    for entry in entries:
+                        f.write(json.dumps(entry.to_json()) + "\n")
+            except OSError as e:
+                messagebox.showerror("Save Error", f"Could not write the report: {e}", parent=panel)
+
+        rows.bind('<<ListboxSelect>>', show)
+        buttons = tk.Frame(panel)
+        buttons.pack(fill=tk.X, pady=5)
+        go_button = tk.Button(buttons, text="Go to Item", command=go_to_item, state=tk.DISABLED)
+        go_button.pack(side=tk.LEFT, padx=5)
+        tk.Button(buttons, text="Save Report...", command=save_report).pack(side=tk.LEFT, padx=5)
+        tk.Button(buttons, text="Close", command=panel.destroy).pack(side=tk.RIGHT, padx=5)
+        rows.set_row_count(len(entries))
+        rows.selection_set(0)
+        show()
+
+    def three_way_merge(self):
+        # Merges two versions edited from the same base into a new file, on a worker thread.
+        # Conflicts keep the chosen side and are written next to the merged file for review.
+        if self.busy_task is not None: return
+        self._commit_ui_edits_if_any()
+        paths = []
+        for title in ("Merge: the base version both sides started from", "Merge: your version",
+                      "Merge: their version"):
+            path = filedialog.askopenfilename(title=title, filetypes=self.FILE_TYPES)
+            if not path: return
+            paths.append(path)
+        out_path = filedialog.asksaveasfilename(title="Save the merged dataset as", defaultextension=".jsonl",
+                                                filetypes=self.FILE_TYPES)
+        if not out_path: return
+        if any(os.path.abspath(out_path) == os.path.abspath(path) for path in paths):
+            messagebox.showerror("Three-Way Merge", "Save the merge to a new file; it cannot replace one of the versions it reads.")
+            return
+        answer = messagebox.askyesnocancel("Three-Way Merge", "Where both versions changed the same field differently, "
+                                           "keep your version?\n\nYes keeps yours, No keeps theirs.")
+        if answer is None: return
+        prefer = "ours" if answer else "theirs"
 
+        self._start_task("Merging", lambda task: merge_to_file(*paths, out_path, prefer=prefer, task=task), on_message=lambda kind, done, total: self._show_progress(done, total),
+                         on_done=lambda result, error: self._on_merge_done(out_path, prefer, result, error))
+
+    def _on_merge_done(self, out_path, prefer, result, error):
+        if error is not None:
+            messagebox.showerror("Three-Way Merge", f"Merge failed: {error}")
+            return
+        if result is None:
+            self._set_status("Merge cancelled.")
+            return
+        counts, conflicts, errors = result
+        message = (f"Wrote {counts['records']} records to {os.path.basename(out_path)}: {counts['from_theirs']} changed in "
+                   f"their version only, {counts['combined']} changed in both, {counts['added']} added, {counts['deleted']} deleted.")
+        if errors:
+            message += f" {len(errors)} invalid lines were left out."
+        if conflicts:
+            conflicts_path = f"{out_path}.conflicts.jsonl"
+            try:
+                with open(conflicts_path, 'w', encoding='utf-8') as f:
+                    for conflict in conflicts:
+                        f.write(json.dumps(conflict) + "\n")
+                message += (f"\n\n{len(conflicts)} conflicts kept {'your' if prefer == 'ours' else 'their'} version; "
+                            f"all three versions of each are in {os.path.basename(conflicts_path)}.")
+            except OSError as e:
+                message += f"\n\n{len(conflicts)} conflicts; the conflict list could not be written: {e}"
+        if messagebox.askyesno("Three-Way Merge", message + "\n\nOpen the merged file?"):
+            self.load_file(out_path)
+
+    # --- Background Tasks ---
+    def _start_task(self, label, work, on_message=None, on_done=None):
+        started = time.perf_counter()
+
+        def finished(result, error):
+            if self.instrumentation.enabled:
+                self.instrumentation.record(f"task: {label}", time.perf_counter() - started)
+            self.busy_task = None
+            self.progress_frame.pack_forget()
+            self._update_ui_element_states()
+            if on_done:
+                on_done(result, error)
+            self._next_index_build()
+
+        self.progress_label.config(text=label)
+        self.progress_bar['value'] = 0
+        self.progress_frame.pack(side=tk.BOTTOM, fill=tk.X, before=self.main_frame)
+        self.busy_task = BackgroundTask(self.root, work, on_message, finished).start()
+        self._update_ui_element_states()
+        return self.busy_task
+
+    def _show_progress(self, done, total):
+        self.progress_bar['value'] = 1000 * done / total if total else 0
+
+    def cancel_background_task(self):
+        if self.busy_task is not None:
+            self._pending_builds = []
+            self.busy_task.cancel()
+            self.progress_label.config(text="Cancelling...")
+
+    def _rebuild_indexes(self):
+        # After a load, the near-duplicate index, the contamination flags and the statistics
+        # that are turned on are each rebuilt by a background task. One task runs at a time,
+        # so they are queued and each finished task starts the next one.
+        self._pending_builds = [build for wanted, build in (
+            (self.near_duplicates_enabled, self._find_near_duplicates),
+            (self.reference_paths, self._check_contamination),
+            (self.stats_panel is not None, self._compute_statistics)) if wanted]
+        self._next_index_build()
+
+    def _next_index_build(self):
+        while self._pending_builds and self.busy_task is None: # Builds over an empty dataset finish at once
+            self._pending_builds.pop(0)()
+
+    def _save_store(self, path):
+        # Serializes on a worker thread and waits for it while Tk keeps handling events, so
+        # the window stays responsive and callers still get a result. False if cancelled.
+        store = self.data
+        if self.follower is not None and path == store.path:
+            self._take_appended_lines() # So they are part of what is written
+        task = self._start_task(f"Saving {os.path.basename(path)}",
+                                lambda task: store.write_snapshot(path, task),
+                                on_message=lambda kind, done, total: self._show_progress(done, total))
+        task.wait()
+        if task.error is not None:
+            raise task.error
+        if task.result is None:
+            return False
+        store.commit_save(task.result)
+        return True
+
+
+    def _recover_journal(self, filepath):
+        # Edits autosaved to the journal but never written into the file (crash, kill, power loss).
+        ops = EditJournal.read_ops(filepath)
+        if ops is None:
+            if os.path.exists(EditJournal.journal_path(filepath)):
+                messagebox.showwarning("Autosave Journal", "An autosave journal was found, but the file changed after it was written. It was set aside as a .stale file and not applied.")
+                EditJournal.set_aside(filepath)
+            return 0
+        if not ops:
+            self.dataset.journal.reset(filepath)
+            return 0
+        if not messagebox.askyesno("Recover Autosaved Edits", f"{len(ops)} autosaved edits were not written into {os.path.basename(filepath)} (the editor may have crashed).\n\nRestore them?"):
+            self.dataset.journal.reset(filepath)
+            return 0
+        return self.dataset.journal.replay(ops)
+
+    def _write_back_journal(self):
+        # Before the file is closed, autosaved edits that only exist in the journal are
+        # written into it. Edits made after the last autosave were declined by the user.
+        if not self.dataset.journal.exists():
+            return
+        if self.dataset.invalid_lines:
+            return # Compacting would drop the invalid lines; the journal is offered on the next open
+        try:
+            if self.dataset.journal.has_pending():
+                self.dataset.journal.discard_pending()
+                self.data.close()
+                EditJournal.compact_file(self.current_file_path)
+            elif self._save_store(self.current_file_path):
+                self.dataset.journal.reset(self.current_file_path)
         except Exception as e:
-            messagebox.showerror("Error loading file", str(e))
-            self.clear_all_app_state()
+            messagebox.showerror("Save Error", f"Could not write autosaved edits into the file: {e}\n\nThey are kept in the journal and will be offered again when the file is opened.")
+
+    def _schedule_compaction(self):
+        if self._compact_after_id is not None:
+            self.root.after_cancel(self._compact_after_id)
+        self._compact_after_id = self.root.after(self.COMPACT_IDLE_MS, self._compact_when_idle)
 
+    def _compact_when_idle(self):
+        self._compact_after_id = None
+        if self.busy_task is not None or self.is_dirty_file or not self.current_file_path or not self.dataset.journal.exists():
+            return
+        if self.dataset.invalid_lines: # Only an explicit save may drop them
+            return
+        try:
+            if self._save_store(self.current_file_path):
+                self.dataset.journal.reset(self.current_file_path)
+        except Exception as e:
+            self._set_status(f"Could not write autosaved edits into the file: {e}")
 
     def save_data_to_file_manual(self):
         # ... (same as before) ...
+        if self.busy_task is not None: return
         self._commit_ui_edits_if_any()
         if not self.current_file_path:
             self.save_data_as()
@@ -420,16 +1843,37 @@ class JsonlEditorAppTk:
         if not self.data and not autosave:
             if not messagebox.askyesno("Empty Data", "The document is empty. Save an empty file?"):
                 return False
+        if self.dataset.invalid_lines and not autosave:
+            if not messagebox.askyesno("Invalid Lines", f"{len(self.dataset.invalid_lines)} lines of the file are not valid JSON and were not loaded. Saving removes them from the file.\n\nSave anyway?"):
+                return False
 
         try:
-            with open(self.current_file_path, 'w', encoding='utf-8') as f:
-                for item in self.data: f.write(json.dumps(item) + '\n')
+            if autosave: # Append the edits to the journal; the file is rewritten on save or when idle
+                self.dataset.journal.flush()
+                self._schedule_compaction()
+            else:
+                previous_path = self.data.path
+                if not self._save_store(self.current_file_path):
+                    self._set_status("Save cancelled.")
+                    return False
+                if previous_path and previous_path != self.current_file_path and self.dataset.journal.exists():
+                    # Save As: the previous file still receives the edits autosaved to it.
+                    self.dataset.journal.discard_pending()
+                    try: EditJournal.compact_file(previous_path)
+                    except Exception as e:
+                        messagebox.showwarning("Save As", f"Saved to {os.path.basename(self.current_file_path)}, but the edits autosaved to {os.path.basename(previous_path)} could not be written into it: {e}\n\n{os.path.basename(previous_path)} was left without them.")
+                self.dataset.journal.reset(self.current_file_path)
+                self.dataset.invalid_lines = [] # No longer in the file
 
             self._set_status(f"{'Autosaved' if autosave else 'Saved'} to {os.path.basename(self.current_file_path)}")
             self.is_dirty_file = False
-            self.file_label.config(text=os.path.basename(self.current_file_path))
+            self.file_label.config(text=self._file_title(self.current_file_path))
             self._update_ui_element_states()
             return True
+        except FileChangedError as e:
+            advice = "Follow is on: the new lines are being added. Save again." if self.follower else "Turn on Follow to add the appended lines, or reload the file."
+            messagebox.showerror("Save Error", f"Could not save file: {e}. Nothing was overwritten.\n\n{advice}")
+            return False
         except Exception as e:
             messagebox.showerror("Save Error", f"Could not save file: {e}")
             return False
@@ -437,6 +1881,7 @@ class JsonlEditorAppTk:
 
     def save_data_as(self):
         # ... (same as before) ...
+        if self.busy_task is not None: return
         self._commit_ui_edits_if_any()
         if not self.data and not self.current_file_path :
              if not messagebox.askyesno("Empty Data", "The document is empty. Still want to 'Save As'?"):
@@ -445,72 +1890,113 @@ class JsonlEditorAppTk:
         initial_filename = os.path.basename(self.current_file_path) if self.current_file_path else "untitled.jsonl"
         filepath = filedialog.asksaveasfilename(
             defaultextension=".jsonl",
-            filetypes=[("JSONL files", "*.jsonl"), ("All files", "*.*")],
+            filetypes=self.FILE_TYPES,
             initialfile=initial_filename
         )
         if not filepath: return False
 
         self.current_file_path = filepath
         if self.save_data_to_file(autosave=False):
-            self.file_label.config(text=os.path.basename(self.current_file_path))
+            if self.follower is not None and self.data.path != self.follower.shard.path:
+                self._stop_following() # The dataset is now the new file, which nothing appends to
+            self.file_label.config(text=self._file_title(self.current_file_path))
             self.is_dirty_file = False
             self._update_ui_element_states()
             return True
         return False
 
     # --- Listbox Handling ---
-    def populate_listbox(self, force_refresh_colors=False): # Added force_refresh_colors
-        current_selection_val = None
-        if self.listbox.curselection():
-            current_selection_val = self.listbox.get(self.listbox.curselection()[0])
-
-        # Only re-find duplicates if data actually changed or forced
-        # This is tricky if only one item's input changed.
-        # For simplicity, always re-find on populate, or make it more granular.
-        # If 'force_refresh_colors' is true, it implies a theme change, so don't need to re-find dups.
-        if not force_refresh_colors:
-            self._find_duplicate_inputs() # Detect duplicates before populating
-
-        self.listbox.delete(0, tk.END)
-        colors = self.themes[self.current_theme_name]
-
-        for i, item_data in enumerate(self.data):
-            preview_key = item_data.get(self.KEY_INSTRUCTION, item_data.get(self.KEY_INPUT, item_data.get(self.KEY_OUTPUT, 'No preview')))
-            preview = str(preview_key)[:50].replace('\n', ' ') + "..."
-            display_text = f"Item {i+1}: {preview}"
-
-            self.listbox.insert(tk.END, display_text)
-            if i in self.duplicate_input_indices:
-                self.listbox.itemconfig(i, {'bg': colors["duplicate_item_bg"], 'fg': colors["duplicate_item_fg"]})
-            else: # Explicitly set non-duplicate colors
-                self.listbox.itemconfig(i, {'bg': colors["listbox_bg"], 'fg': colors["listbox_fg"]})
-
-
-        if current_selection_val: # Try to reselect if possible
-            try:
-                idx_to_reselect = self.listbox.get(0, "end").index(current_selection_val)
-                self.selected_index = idx_to_reselect
-            except ValueError: # Item no longer exists or text changed
-                self.selected_index = -1 # Fallback
-        
-        if 0 <= self.selected_index < self.listbox.size():
-            self.listbox.selection_set(self.selected_index)
-            self.listbox.see(self.selected_index)
-            self.listbox.activate(self.selected_index)
+    def populate_listbox(self):
+        # The duplicate index is already current; rows are drawn lazily by the virtual
+        # list, so this only redraws the rows in view.
+        changed = self.dataset.duplicates.take_changed()
+        if self.dataset.near_duplicates is not None:
+            changed |= self.dataset.near_duplicates.take_changed()
+        if self.dataset.contamination is not None:
+            changed |= self.dataset.contamination.take_changed()
+        view = self.dataset.view
+        if view is not None:
+            view.refresh(changed) # Rows whose duplicate status flipped may join or leave it
+        self.listbox.set_row_count(self._row_count())
+
+        row = self._row_of(self.selected_index)
+        if row >= 0: # Selection follows the data index
+            self.listbox.selection_set(row)
+            self.listbox.see(row)
+            self.listbox.activate(row)
             # If this selection is new or forced, on_list_item_select will handle data loading.
+        elif view is not None and 0 <= self.selected_index < len(self.data):
+            self.listbox.selection_clear() # The view leaves the item out; its fields stay open
         elif self.listbox.size() > 0:
-            self.selected_index = 0
+            self.selected_index = self._position_of(0)
             self.listbox.selection_set(0)
             self.listbox.see(0)
             self.listbox.activate(0)
             # Trigger selection event if data exists and first item is auto-selected
-            self.root.after_idle(lambda: self.on_list_item_select(None)) # Simulate event
+            self.ui_updates.mark("select") # Once, however often the list is redrawn before then
         else:
             self.selected_index = -1
+            self.listbox.selection_clear()
             self.clear_text_fields()
 
-        self._update_ui_element_states()
+        self.ui_updates.mark("states")
+
+    def _row_count(self):
+        view = self.dataset.view
+        return len(view) if view is not None else len(self.data)
 
+    def _position_of(self, row):
+        view = self.dataset.view
+        return view.position(row) if view is not None else row
+
+    def _row_of(self, index):
+        # List row of a data index; -1 when there is none or the view leaves it out.
+        view = self.dataset.view
+        if not 0 <= index < len(self.data):
+            return -1
+        return view.row_of(self.data.record_id(index)) if view is not None else index
+
+    def _row_record_id(self, row):
+        view = self.dataset.view
+        return view.record_id(row) if view is not None else self.data.record_id(row)
+
+    def _listbox_row(self, row):
+        i = self._position_of(row) # Rows are numbered by data index, also in a view
+        item_data = self.data[i]
+        if i == self.selected_index and self.ui_text_field_is_dirty:
+            item_data = self._live_preview_record(item_data)
+        preview_key = item_data.get(self.KEY_INSTRUCTION, item_data.get(self.KEY_INPUT, item_data.get(self.KEY_OUTPUT, 'No preview')))
+        preview = str(preview_key)[:50].replace('\n', ' ') + "..."
+        display_text = f"Item {i+1}: {preview}"
+
+        colors = self.themes[self.current_theme_name]
+        record_id = self.data.record_id(i)
+        contamination = self.dataset.contamination
+        if contamination is not None and contamination.is_contaminated(record_id):
+            # Flagged before anything else: a training record that is in an eval set
+            mark = "\u2691" if contamination.flag(record_id) == contamination.EXACT else "\u2690" # Filled flag: exact
+            return f"{mark} {display_text}", colors["contaminated_item_bg"], colors["contaminated_item_fg"]
+        near = self.dataset.near_duplicates
+        if near is not None and near.is_duplicate(record_id):
+            display_text = f"\u2248{near.cluster(record_id)} {display_text}" # Cluster number, e.g. "≈3"
+            if not self.dataset.duplicates.is_duplicate(record_id):
+                return display_text, colors["near_duplicate_item_bg"], colors["near_duplicate_item_fg"]
+        if self.dataset.duplicates.is_duplicate(record_id):
+            return display_text, colors["duplicate_item_bg"], colors["duplicate_item_fg"]
+        return display_text, colors["listbox_bg"], colors["listbox_fg"] # Explicitly set non-duplicate colors
+
+
+    def _live_preview_record(self, item_data):
+        # The row being edited previews what is typed in the fields before it is committed.
+        # Only the start of each field is read; the preview shows 50 characters.
+        item_data = dict(item_data)
+        for key, widget in self._field_widgets():
+            if not widget.edit_modified():
+                continue
+            text = widget.get('1.0', '1.0 + 200 chars').strip()
+            if text or key in item_data:
+                item_data[key] = text
+        return item_data
 
     def on_list_item_select(self, event):
         # ... (same as before) ...
@@ -518,10 +2004,13 @@ class JsonlEditorAppTk:
         # Need to be careful about re-entrancy or infinite loops.
         # Consider a flag to prevent re-entry if on_list_item_select is called from _commit.
         
+        self.ui_updates.discard("select")
+        selection = self.listbox.curselection() # Read before committing: a commit redraws the list
         if event is not None: # Only commit if it's a user-driven selection
              self._commit_ui_edits_if_any()
-
-        selection = self.listbox.curselection()
+             self._clear_marks() # A plain click or arrow key ends a multi-selection
+             if selection:
+                 self.listbox.selection_set(selection[0])
         if not selection:
             if not self.data:
                 self.selected_index = -1
@@ -529,7 +2018,7 @@ class JsonlEditorAppTk:
             self._update_ui_element_states()
             return
 
-        new_idx = selection[0]
+        new_idx = self._position_of(selection[0])
 
         if new_idx == self.selected_index and event is not None:
             self._update_ui_element_states()
@@ -543,12 +2032,23 @@ class JsonlEditorAppTk:
             return
 
         self._load_item_data_to_fields(self.data[self.selected_index])
-        self._set_status(f"Displaying Item {self.selected_index + 1} of {len(self.data)}")
+        self._set_status(f"Displaying Item {self.selected_index + 1} of {len(self.data)}{self._near_duplicate_note(self.selected_index)}"
+                         f"{self._contamination_note(self.selected_index)}")
         self.ui_text_field_is_dirty = False
         self._update_ui_element_states()
 
+    def _near_duplicate_note(self, index):
+        near = self.dataset.near_duplicates
+        if near is None or not near.is_duplicate(self.data.record_id(index)):
+            return ""
+        positions = sorted(self.data.index_of(other) + 1 for other in near.neighbors(self.data.record_id(index)))
+        return f" (similar to item{'s' if len(positions) > 1 else ''} {', '.join(map(str, positions))})"
 
     # --- Item Data and Text Field Handling ---
+    def _field_widgets(self):
+        return ((self.KEY_INSTRUCTION, self.instruction_text), (self.KEY_INPUT, self.input_text),
+                (self.KEY_OUTPUT, self.output_text))
+
     def _load_item_data_to_fields(self, item_data):
         # ... (same as before) ...
         self._set_text_widget_content(self.instruction_text, item_data.get(self.KEY_INSTRUCTION, ''))
@@ -556,16 +2056,41 @@ class JsonlEditorAppTk:
         self._set_text_widget_content(self.output_text, item_data.get(self.KEY_OUTPUT, ''))
 
     def _set_text_widget_content(self, text_widget, content):
-        # ... (same as before) ...
+        # Values longer than LARGE_FIELD_CHARS show their first chunk at once; the rest follows
+        # chunk by chunk between events, with the pane read-only until it is all there.
+        self._cancel_field_load(text_widget)
+        content = str(content) if content is not None else ""
         original_state = text_widget.cget("state")
         if original_state == tk.DISABLED:
             text_widget.config(state=tk.NORMAL)
 
         text_widget.delete('1.0', tk.END)
-        text_widget.insert('1.0', str(content) if content is not None else "")
+        if len(content) > self.LARGE_FIELD_CHARS:
+            text_widget.insert('1.0', content[:self.FIELD_CHUNK_CHARS])
+            text_widget.config(state=tk.DISABLED)
+            self._field_loads[text_widget] = self.root.after(1, self._continue_field_load, text_widget, content, self.FIELD_CHUNK_CHARS)
+        else:
+            text_widget.insert('1.0', content)
+            if original_state == tk.DISABLED:
+                 text_widget.config(state=tk.DISABLED)
+        text_widget.edit_modified(False) # Only edits by the user count as changes
+
+    def _continue_field_load(self, text_widget, content, position):
+        text_widget.config(state=tk.NORMAL)
+        text_widget.insert('end-1c', content[position:position + self.FIELD_CHUNK_CHARS])
+        text_widget.config(state=tk.DISABLED)
+        text_widget.edit_modified(False)
+        position += self.FIELD_CHUNK_CHARS
+        if position < len(content):
+            self._field_loads[text_widget] = self.root.after(1, self._continue_field_load, text_widget, content, position)
+        else:
+            del self._field_loads[text_widget]
+            self.ui_updates.mark("states") # Editable again
 
-        if original_state == tk.DISABLED:
-             text_widget.config(state=tk.DISABLED)
+    def _cancel_field_load(self, text_widget):
+        after_id = self._field_loads.pop(text_widget, None)
+        if after_id is not None:
+            self.root.after_cancel(after_id)
 
     def clear_text_fields(self):
         # ... (same as before) ...
@@ -576,10 +2101,20 @@ class JsonlEditorAppTk:
     def clear_all_app_state(self, is_new_file=False):
         # ... (same as before, but populate_listbox will handle dupe detection) ...
         self.current_file_path = None
-        self.data = []
+        self._stop_following()
+        self.dataset.close()
+        self.dataset = Dataset() # Fresh duplicate index, undo history and journal
         self.selected_index = -1
-
-        self.listbox.delete(0, tk.END)
+        self._clear_search_results()
+        self._reset_view_boxes()
+        self._clear_marks()
+        self._pending_builds = []
+        if self.near_duplicates_enabled:
+            self.dataset.set_near_duplicates(self.dataset.build_near_duplicates(self._near_threshold()))
+        if self.stats_panel is not None:
+            self.dataset.set_stats(self.dataset.build_stats())
+
+        self.listbox.set_row_count(0)
         self.clear_text_fields()
 
         if not is_new_file:
@@ -589,11 +2124,7 @@ class JsonlEditorAppTk:
         self.is_dirty_file = False
         self.ui_text_field_is_dirty = False
 
-        self.undo_stack.clear()
-        self.redo_stack.clear()
         self._update_ui_element_states()
-        self._find_duplicate_inputs() # Clear duplicates for new state
-        # self.populate_listbox() # Not needed here as listbox is already cleared
 
 
     def _commit_ui_edits_if_any(self):
@@ -601,10 +2132,12 @@ class JsonlEditorAppTk:
            0 <= self.selected_index < len(self.data):
             self._push_state_to_undo(f"Edit Item {self.selected_index + 1}")
 
-            if self.update_current_item_from_text_fields(): # This updates self.data
-                self._find_duplicate_inputs() # Re-check duplicates after edit
-                self.populate_listbox() # Refresh listbox to show new dupe status
-                pass
+            if self.update_current_item_from_text_fields(): # This updates self.data and the duplicate index
+                if self.dataset.view is not None:
+                    self.populate_listbox() # The edit may have moved the row or taken it out of the view
+                else:
+                    self.listbox.refresh_row(self.selected_index) # New preview
+                self._refresh_duplicate_rows() # Rows whose dupe status changed
             self.ui_text_field_is_dirty = False
             self._update_ui_element_states()
 
@@ -621,17 +2154,18 @@ class JsonlEditorAppTk:
         # The caller (_commit_ui_edits_if_any) will handle it.
         if not (0 <= self.selected_index < len(self.data)): return False
 
-        item = self.data[self.selected_index]
+        item = dict(self.data[self.selected_index]) # Store records are shared; edit a copy
         updated = False
         # Check if the input field itself has changed before re-evaluating duplicates
         old_input_val = item.get(self.KEY_INPUT, "").strip()
 
-        new_vals = {
-            self.KEY_INSTRUCTION: self.instruction_text.get('1.0', tk.END).strip(),
-            self.KEY_INPUT: self.input_text.get('1.0', tk.END).strip(),
-            self.KEY_OUTPUT: self.output_text.get('1.0', tk.END).strip()
-        }
-        new_input_val = new_vals[self.KEY_INPUT]
+        # Only the fields the user typed in are read back; a multi-megabyte value that was
+        # just looked at is not copied out of its widget and compared.
+        new_vals = {key: widget.get('1.0', tk.END).strip() for key, widget in self._field_widgets()
+                    if widget.edit_modified() and widget not in self._field_loads}
+        for key, widget in self._field_widgets():
+            widget.edit_modified(False)
+        new_input_val = new_vals.get(self.KEY_INPUT, old_input_val)
 
         for key, new_val in new_vals.items():
             if item.get(key, "") != new_val:
@@ -639,6 +2173,7 @@ class JsonlEditorAppTk:
                 updated = True
 
         if updated:
+            self.data[self.selected_index] = item
             self.is_dirty_file = True
             # Preview update in listbox is now handled by populate_listbox in the caller
             if old_input_val != new_input_val: # If input changed, dupe status might change
@@ -649,6 +2184,7 @@ class JsonlEditorAppTk:
     # --- Item Manipulation ---
     def add_item(self):
         # ... (same as before, but populate_listbox will handle dupe detection) ...
+        if self.busy_task is not None: return
         self._commit_ui_edits_if_any()
         self._push_state_to_undo("Add Item")
 
@@ -658,7 +2194,9 @@ class JsonlEditorAppTk:
 
         self.selected_index = insert_at
 
-        self.populate_listbox() # Will find duplicates and color accordingly
+        self.populate_listbox() # The duplicate index already saw the insert
+        self._load_item_data_to_fields(new_item) # The new row is selected by index, show its fields
+        self.ui_text_field_is_dirty = False
 
         self.is_dirty_file = True
         self._set_status(f"Added new item. Now {len(self.data)} items.")
@@ -672,39 +2210,119 @@ class JsonlEditorAppTk:
 
 
     def delete_item(self):
-        # ... (same as before, but populate_listbox will handle dupe detection) ...
-        if not (0 <= self.selected_index < len(self.data)):
+        # Deletes the selected items, or the item in the fields when none are selected.
+        if self.busy_task is not None: return
+        self._commit_ui_edits_if_any()
+        positions = self._marked_positions()
+        if not positions:
             messagebox.showwarning("Delete Item", "No item selected or selection is invalid.")
             return
-        if not messagebox.askyesno("Confirm Delete", f"Are you sure you want to delete Item {self.selected_index + 1}? This cannot be undone directly by standard text undo (use app's Undo)."):
+        if len(positions) == 1:
+            question = f"Are you sure you want to delete Item {positions[0] + 1}? This cannot be undone directly by standard text undo (use app's Undo)."
+            description = f"Delete Item {positions[0] + 1}"
+        else:
+            question = f"Are you sure you want to delete the {len(positions)} selected items? Undo restores them all at once."
+            description = f"Delete {len(positions)} Items"
+        if not messagebox.askyesno("Confirm Delete", question):
             return
+        self._delete_positions(positions, description)
 
-        self._commit_ui_edits_if_any()
-        self._push_state_to_undo(f"Delete Item {self.selected_index + 1}")
-
-        deleted_item_original_index = self.selected_index
-        del self.data[deleted_item_original_index]
-
-        new_selection_target_index = -1
-        if self.data:
-            if deleted_item_original_index < len(self.data):
-                new_selection_target_index = deleted_item_original_index
-            else:
-                new_selection_target_index = len(self.data) - 1
-
-        self.selected_index = new_selection_target_index
+    # --- Multi-Selection and Batch Operations ---
+    def _row_is_marked(self, row):
+        record_id = self._row_record_id(row)
+        return record_id < len(self.marks) and bool(self.marks[record_id])
 
-        self.populate_listbox() # Will find duplicates and color accordingly
+    def _set_mark(self, record_id, marked):
+        if record_id >= len(self.marks):
+            if not marked:
+                return
+            self.marks.extend(bytes(record_id + 1 - len(self.marks)))
+        if self.marks[record_id] != marked:
+            self.marks[record_id] = marked
+            self.mark_count += 1 if marked else -1
+
+    def _clear_marks(self):
+        if self.marks:
+            self.marks = bytearray()
+            self.mark_count = 0
+            self.listbox.selection_set(self.listbox.selected) # Redraws the selection of the rows in view
+
+    def _marked_positions(self):
+        # Sorted data indexes of the selected items, or of the item in the fields alone.
+        if not self.mark_count:
+            return [self.selected_index] if 0 <= self.selected_index < len(self.data) else []
+        marks, size = self.marks, len(self.marks)
+        return [i for i, record_id in enumerate(self.data.record_ids()) if record_id < size and marks[record_id]]
+
+    def on_list_item_mark(self, event):
+        # Ctrl-click toggles an item, Shift-click and Shift+arrows select the range from the
+        # last plain click, Ctrl+A selects every row. The clicked row gets the fields.
+        kind, anchor, row = self.listbox.mark_request
+        self._commit_ui_edits_if_any()
+        rows = self._row_count()
+        if kind == "all":
+            self.select_all_items()
+            return
+        if kind == "toggle":
+            if not self.mark_count and 0 <= anchor < rows and anchor != row: # The focused item joins in
+                self._set_mark(self._row_record_id(anchor), 1)
+            record_id = self._row_record_id(row)
+            self._set_mark(record_id, 0 if self._row_is_marked(row) else 1)
+        else:
+            self.marks = bytearray()
+            self.mark_count = 0
+            anchor = anchor if 0 <= anchor < rows else row
+            for marked_row in range(min(anchor, row), max(anchor, row) + 1):
+                self._set_mark(self._row_record_id(marked_row), 1)
+        self.listbox.selection_set(row)
+        self.listbox.activate(row)
+        self.selected_index = -1 # Let on_list_item_select load the row even if it is selected already
+        self.on_list_item_select(None)
+        if self.mark_count:
+            self._set_status(f"{self.mark_count} items selected.")
+
+    def select_all_items(self):
+        if self.busy_task is not None: return
+        self._commit_ui_edits_if_any()
+        view = self.dataset.view
+        if view is None:
+            self.marks = bytearray(b"\x01") * (max(self.data.record_ids(), default=-1) + 1) # Deleted ids are never listed
+            self.mark_count = len(self.data)
+        else:
+            for row in range(len(view)):
+                self._set_mark(view.record_id(row), 1)
+        self.listbox.selection_set(self.listbox.selected)
+        self._update_ui_element_states()
+        self._set_status(f"{self.mark_count} items selected.")
+
+    def _delete_positions(self, positions, description):
+        # One delete_many(), one undo step, one list refresh and one autosave, however many
+        # items go. The item after the one in the fields takes its place.
+        self._push_state_to_undo(description)
+        deleted = {self.data.record_id(position) for position in positions}
+        focus_row = self._row_of(self.selected_index)
+        survivor = None
+        if focus_row >= 0:
+            rows = self._row_count()
+            for row in itertools.chain(range(focus_row, rows), range(focus_row - 1, -1, -1)):
+                if self._row_record_id(row) not in deleted:
+                    survivor = self._row_record_id(row)
+                    break
+        self.data.delete_many(positions)
+        self._clear_marks()
+        self.selected_index = self.data.index_of(survivor) if survivor is not None else -1
+
+        self.populate_listbox() # The duplicate index already saw the deletes
 
         if 0 <= self.selected_index < len(self.data):
             self._load_item_data_to_fields(self.data[self.selected_index]) # Ensure fields are loaded for new selection
-            self._set_status(f"Displaying Item {self.selected_index + 1} of {len(self.data)}. Previous item deleted.")
+            self._set_status(f"Displaying Item {self.selected_index + 1} of {len(self.data)}. {description} done.")
         elif not self.data:
-            self._set_status(f"Deleted item. List is now empty.")
+            self._set_status(f"Deleted {len(positions)} items. List is now empty.")
         else:
             self.clear_text_fields()
             self.selected_index = -1
-            self._set_status("Item deleted. No item selected.")
+            self._set_status(f"Deleted {len(positions)} items. No item selected.")
 
         self.is_dirty_file = True
         if self.current_file_path:
@@ -712,8 +2330,149 @@ class JsonlEditorAppTk:
 
         self._update_ui_element_states()
 
+    def move_selected_items(self, where):
+        # Moves the selected items, in their order, to the top, the bottom, or in front of an
+        # item number asked for.
+        if self.busy_task is not None: return
+        self._commit_ui_edits_if_any()
+        positions = self._marked_positions()
+        if not positions:
+            return
+        if where == "top":
+            target = 0
+        elif where == "bottom":
+            target = len(self.data)
+        else:
+            number = simpledialog.askinteger("Move Items", f"Move the {len(positions)} selected items in front of item number\n"
+                                             f"({len(self.data) + 1} moves them to the end):",
+                                             parent=self.root, minvalue=1, maxvalue=len(self.data) + 1)
+            if number is None:
+                return
+            target = number - 1
+        self._push_state_to_undo(f"Move {len(positions)} Items")
+        moved = self.dataset.move(positions, target)
+        self._clear_marks()
+        if len(moved) > 1: # They stay selected, under their new record ids
+            for position in moved:
+                self._set_mark(self.data.record_id(position), 1)
+        self.selected_index = moved[0]
+        self.populate_listbox()
+        self._load_item_data_to_fields(self.data[self.selected_index])
+        self.ui_text_field_is_dirty = False
+        self.is_dirty_file = True
+        self._set_status(f"Moved {len(moved)} items to positions {moved[0] + 1}-{moved[-1] + 1}.")
+        if self.current_file_path:
+            self.save_data_to_file(autosave=True)
+        self._update_ui_element_states()
+
+    def find_and_replace(self):
+        # Replaces text in one field or all three, in the selected items or in every item.
+        # Matches are found on a worker thread; the edits are applied as one undo step.
+        if self.busy_task is not None: return
+        self._commit_ui_edits_if_any()
+        scope = f"the {self.mark_count} selected items" if self.mark_count else f"all {len(self.data)} items"
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Find and Replace")
+        dialog.transient(self.root)
+        find_var, replace_var = tk.StringVar(), tk.StringVar()
+        field_var = tk.StringVar(value="All fields")
+        regex_var, case_var = tk.BooleanVar(value=False), tk.BooleanVar(value=True)
+        form = tk.Frame(dialog)
+        form.pack(fill=tk.X, padx=5, pady=5)
+        tk.Label(form, text="Find:").grid(row=0, column=0, sticky=tk.W)
+        find_entry = tk.Entry(form, textvariable=find_var, width=40)
+        find_entry.grid(row=0, column=1, sticky=tk.EW)
+        tk.Label(form, text="Replace with:").grid(row=1, column=0, sticky=tk.W)
+        tk.Entry(form, textvariable=replace_var, width=40).grid(row=1, column=1, sticky=tk.EW)
+        tk.Label(form, text="In:").grid(row=2, column=0, sticky=tk.W)
+        ttk.Combobox(form, textvariable=field_var, state="readonly",
+                     values=["All fields", *Dataset.SEARCH_KEYS]).grid(row=2, column=1, sticky=tk.W)
+        tk.Checkbutton(form, text="Regular expression", variable=regex_var).grid(row=3, column=1, sticky=tk.W)
+        tk.Checkbutton(form, text="Match case", variable=case_var).grid(row=4, column=1, sticky=tk.W)
+        tk.Label(dialog, text=f"Replaces in {scope}.", anchor=tk.W).pack(fill=tk.X, padx=5)
+        buttons = tk.Frame(dialog)
+        buttons.pack(fill=tk.X, pady=5)
+
+        def replace_all():
+            find = find_var.get()
+            if not find:
+                return
+            try:
+                pattern = re.compile(find if regex_var.get() else re.escape(find), 0 if case_var.get() else re.IGNORECASE)
+            except re.error as e:
+                messagebox.showerror("Find and Replace", f"Invalid regular expression: {e}", parent=dialog)
+                return
+            text = replace_var.get()
+            replacement = text if regex_var.get() else (lambda match: text) # Taken literally
+            keys = Dataset.SEARCH_KEYS if field_var.get() == "All fields" else (field_var.get(),)
+            positions = self._marked_positions() if self.mark_count else None
+            dialog.destroy()
+            dataset = self.dataset
+            self._start_task("Finding replacements",
+                             lambda task: dataset.find_replacements(pattern, replacement, keys, positions, task),
+                             on_message=lambda kind, done, total: self._show_progress(done, total),
+                             on_done=lambda edits, error: self._on_replacements_found(dataset, edits, error))
+
+        tk.Button(buttons, text="Replace All", command=replace_all).pack(side=tk.LEFT, padx=5)
+        tk.Button(buttons, text="Cancel", command=dialog.destroy).pack(side=tk.RIGHT, padx=5)
+        find_entry.focus_set()
+        dialog.bind("<Return>", lambda e: replace_all())
+        dialog.bind("<Escape>", lambda e: dialog.destroy())
+
+    def _on_replacements_found(self, dataset, edits, error):
+        if dataset is not self.dataset:
+            return
+        if error is not None:
+            messagebox.showerror("Find and Replace", f"Replace failed: {error}")
+            return
+        if edits is None:
+            self._set_status("Find and replace cancelled.")
+            return
+        if not edits:
+            self._set_status("Find and replace: no matches.")
+            return
+        self._push_state_to_undo(f"Replace in {len(edits)} Items")
+        dataset.replace_records(edits)
+        self.populate_listbox()
+        if 0 <= self.selected_index < len(self.data):
+            self._load_item_data_to_fields(self.data[self.selected_index])
+        self.ui_text_field_is_dirty = False
+        self.is_dirty_file = True
+        self._set_status(f"Replaced text in {len(edits)} items.")
+        if self.current_file_path:
+            self.save_data_to_file(autosave=True)
+        self._update_ui_element_states()
+
+    def keep_first_duplicates(self):
+        # Deletes every item whose input repeats the input of an earlier item.
+        if self.busy_task is not None: return
+        self._commit_ui_edits_if_any()
+        positions = self.dataset.later_duplicates()
+        if not positions:
+            messagebox.showinfo("Keep First of Each Duplicate", "No two items have the same input.")
+            return
+        if not messagebox.askyesno("Keep First of Each Duplicate",
+                                   f"Delete {len(positions)} items whose input repeats an earlier item? "
+                                   "The first item of each group is kept. Undo restores them all at once."):
+            return
+        self._delete_positions(positions, f"Delete {len(positions)} Later Duplicates")
+
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support() # Large files are scanned by spawned processes, also when frozen
+    if len(sys.argv) > 1 and sys.argv[1] in jsonl_cli.COMMANDS: # Headless tools; no window is opened
+        sys.exit(jsonl_cli.main(sys.argv[1:]))
+    parser = argparse.ArgumentParser(description="JSONL dataset editor.",
+                                     epilog=f"Commands without a window: {', '.join(jsonl_cli.COMMANDS)} (see 'jsonl_editor.py <command> --help').")
+    parser.add_argument("--instrument", action="store_true", help="time operations and show their latencies (also JSONL_EDITOR_INSTRUMENT=1)")
+    parser.add_argument("--trace", metavar="FILE", help="write every timed operation to FILE for chrome://tracing or Perfetto")
+    parser.add_argument("--profile", metavar="OPERATION", help="run cProfile around the next call of OPERATION, e.g. populate_listbox")
+    parser.add_argument("--jobs", type=int, metavar="N", help="processes that scan large files (default: one per core; 1 scans in-process)")
+    args = parser.parse_args()
+    instrumentation = Instrumentation.from_environment(args.instrument, args.trace, args.profile)
     root = tk.Tk()
-    app = JsonlEditorAppTk(root)
+    app = JsonlEditorAppTk(root, instrumentation, args.jobs)
     root.mainloop()
+    if instrumentation.enabled:
+        print(instrumentation.format_summary(), file=sys.stderr)
+        instrumentation.close()
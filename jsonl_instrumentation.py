@@ -0,0 +1,178 @@
+"""Opt-in latency instrumentation for the editor.
+
+Turned on with ``python jsonl_editor.py --instrument`` or the environment
+variable JSONL_EDITOR_INSTRUMENT=1. When it is off, nothing is wrapped and
+the editor runs exactly as without it.
+
+Every instrumented call is a span. Spans nest, so a user-facing operation
+such as ``delete_item`` shows up together with its sub-steps
+(``populate_listbox``, ``save_data_to_file``...). Each name keeps a rolling
+window of latencies for p50/p99. Time spent in modal dialogs is measured
+separately and subtracted from the spans around it, so waiting for the user
+does not count as a stall.
+
+    --trace FILE       (JSONL_EDITOR_TRACE)    write every span to FILE in the Trace
+                                               Event format (chrome://tracing, Perfetto)
+    --profile NAME     (JSONL_EDITOR_PROFILE)  run cProfile around the next NAME call and
+                                               write NAME.prof next to the trace file
+"""
+import cProfile
+import functools
+import io
+import json
+import math
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import deque
+
+ENV_INSTRUMENT = "JSONL_EDITOR_INSTRUMENT"
+ENV_TRACE = "JSONL_EDITOR_TRACE"
+ENV_PROFILE = "JSONL_EDITOR_PROFILE"
+
+
+class LatencyStats:
+    """Count, maximum and a rolling window of latencies for one span name."""
+    WINDOW = 500 # Latest samples kept for the percentiles
+
+    def __init__(self):
+        self.samples = deque(maxlen=self.WINDOW)
+        self.count = 0
+        self.max = 0.0
+        self.last = 0.0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.last = seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        # Nearest-rank percentile over the window.
+        ordered = sorted(self.samples)
+        if not ordered:
+            return 0.0
+        return ordered[max(0, min(len(ordered), math.ceil(fraction * len(ordered))) - 1)]
+
+
+class _Span:
+    __slots__ = ("name", "start", "excluded", "exclude", "profiling")
+
+    def __init__(self, name, start, exclude):
+        self.name = name
+        self.start = start
+        self.excluded = 0.0 # Time spent in excluded (dialog) spans nested inside this one
+        self.exclude = exclude
+        self.profiling = False
+
+
+class Instrumentation:
+    """Spans, rolling latency statistics, an optional trace file and cProfile runs.
+
+    Only used from the Tk thread; background work is reported with record().
+    Listeners are called as ``listener(name, seconds, depth)`` when a span
+    ends, depth 0 being a user-facing operation.
+    """
+
+    def __init__(self, enabled=False, trace_path=None, profile=None):
+        self.enabled = enabled
+        self.stats = {} # span name -> LatencyStats
+        self.listeners = []
+        self.trace_path = trace_path if enabled else None
+        self.profile_dir = os.path.dirname(os.path.abspath(trace_path)) if trace_path else os.getcwd()
+        self._profile_next = profile if enabled else None
+        self._profiler = None
+        self._stack = []
+        self._epoch = time.perf_counter()
+        self._trace = None
+        if self.trace_path:
+            self._trace = open(self.trace_path, 'w', encoding='utf-8', buffering=64 * 1024)
+            self._trace.write("[\n") # The closing bracket is optional in the Trace Event format
+
+    @classmethod
+    def from_environment(cls, enabled=False, trace_path=None, profile=None):
+        # Command-line values win over the environment; a trace or profile implies enabled.
+        trace_path = trace_path or os.environ.get(ENV_TRACE) or None
+        profile = profile or os.environ.get(ENV_PROFILE) or None
+        enabled = enabled or os.environ.get(ENV_INSTRUMENT, "") not in ("", "0") or bool(trace_path or profile)
+        return cls(enabled, trace_path, profile)
+
+    def wrap(self, name, function, exclude=False):
+        # Returns `function` timed as span `name`, or unchanged when disabled. Excluded spans
+        # (dialogs) are traced but their time is subtracted from the enclosing spans.
+        if not self.enabled:
+            return function
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            self.begin(name, exclude)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.end()
+        return timed
+
+    def begin(self, name, exclude=False):
+        span = _Span(name, time.perf_counter(), exclude)
+        if name == self._profile_next and self._profiler is None:
+            self._profile_next = None
+            self._profiler = cProfile.Profile()
+            span.profiling = True
+            self._profiler.enable()
+        self._stack.append(span)
+
+    def end(self):
+        now = time.perf_counter()
+        span = self._stack.pop()
+        elapsed = now - span.start
+        if span.profiling:
+            self._profiler.disable()
+            self._write_profile(span.name, self._profiler)
+            self._profiler = None
+        if self._trace is not None:
+            event = {"name": span.name, "ph": "X", "ts": round((span.start - self._epoch) * 1e6, 1),
+                     "dur": round(elapsed * 1e6, 1), "pid": os.getpid(), "tid": threading.get_ident()}
+            if span.excluded:
+                event["args"] = {"dialog_ms": round(span.excluded * 1000, 3)}
+            self._trace.write(json.dumps(event) + ",\n")
+        if span.exclude:
+            for parent in self._stack:
+                parent.excluded += elapsed
+            return
+        self.record(span.name, elapsed - span.excluded, len(self._stack))
+
+    def record(self, name, seconds, depth=0):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = LatencyStats()
+        stats.add(seconds)
+        for listener in self.listeners:
+            listener(name, seconds, depth)
+
+    def profile_next(self, name):
+        self._profile_next = name
+
+    def _write_profile(self, name, profiler):
+        path = os.path.join(self.profile_dir, f"{name.strip('_')}.prof")
+        profiler.dump_stats(path)
+        text = io.StringIO()
+        pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(25)
+        print(f"cProfile of {name} written to {path}\n{text.getvalue()}", file=sys.stderr)
+
+    def summary(self):
+        # (name, count, p50, p99, max, last) per span name, slowest p99 first; in seconds.
+        rows = [(name, s.count, s.percentile(0.5), s.percentile(0.99), s.max, s.last) for name, s in self.stats.items()]
+        return sorted(rows, key=lambda row: row[3], reverse=True)
+
+    def format_summary(self):
+        lines = [f"{'operation':<36}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}{'last ms':>10}"]
+        for name, count, p50, p99, worst, last in self.summary():
+            lines.append(f"{name:<36}{count:>8}{p50 * 1000:>10.2f}{p99 * 1000:>10.2f}{worst * 1000:>10.2f}{last * 1000:>10.2f}")
+        return "\n".join(lines)
+
+    def close(self):
+        if self._trace is not None:
+            self._trace.close()
+            self._trace = None
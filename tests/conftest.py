@@ -0,0 +1,28 @@
+import functools
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def write_jsonl(tmp_path):
+    # write_jsonl(records, name) writes one record per line and returns the path. Strings
+    # are written as they are, for blank and invalid lines.
+    def write(records, name="data.jsonl"):
+        path = tmp_path / name
+        with open(path, 'w', encoding='utf-8') as f:
+            for record in records:
+                f.write((record if isinstance(record, str) else json.dumps(record)) + "\n")
+        return str(path)
+    return write
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    # Files of a few kilobytes are split into several chunks, as large ones are.
+    import jsonl_dataset
+    monkeypatch.setattr(jsonl_dataset, "map_chunks", functools.partial(jsonl_dataset.map_chunks, chunk_bytes=512))
@@ -0,0 +1,57 @@
+import json
+import random
+
+import jsonl_cli
+
+
+def test_dedupe_command_writes_the_output_and_report(write_jsonl, tmp_path):
+    path = write_jsonl([{"input": "a"}, {"input": "b"}, {"input": "a"}, "not json", {"input": "b"}])
+    out = tmp_path / "out.jsonl"
+    report = tmp_path / "removed.txt"
+    assert jsonl_cli.main(["dedupe", path, "-o", str(out), "--report", str(report), "--skip-invalid", "--jobs", "1"]) == 0
+    assert [json.loads(line) for line in out.read_text(encoding='utf-8').splitlines()] == [{"input": "a"}, {"input": "b"}]
+    assert report.read_text(encoding='utf-8').split() == ["3", "5"]
+    # Without --skip-invalid the invalid line stops the command with an error.
+    assert jsonl_cli.main(["dedupe", path, "-o", str(out), "--jobs", "1"]) == 1
+
+
+def test_dedupe_command_removes_near_duplicates(write_jsonl, tmp_path, capsys):
+    rng = random.Random(5)
+    texts = [" ".join(str(rng.randrange(10 ** 6)) for _ in range(40)) for _ in range(4)]
+    records = [{"input": texts[0]}, {"input": texts[1]}, {"input": texts[0] + " extra"}, {"input": texts[2]},
+               {"input": texts[1].upper() + "?"}, {"input": texts[3]}, {"input": texts[0]}]
+    out = tmp_path / "out.jsonl"
+    report = tmp_path / "removed.txt"
+    path = write_jsonl(records)
+    assert jsonl_cli.main(["dedupe", path, "-o", str(out), "--report", str(report), "--near", "0.8"]) == 0
+    kept = [json.loads(line) for line in out.read_text(encoding='utf-8').splitlines()]
+    assert kept == [records[i] for i in (0, 1, 3, 5)]
+    assert report.read_text(encoding='utf-8').split() == ["3", "5", "7"]
+    assert "removed 3 duplicates and near-duplicates" in capsys.readouterr().err
+
+
+def test_validate_command_prints_each_problem(write_jsonl, capsys):
+    path = write_jsonl([{"input": "a", "output": "1"}, "{oops", {"input": "b"}])
+    assert jsonl_cli.main(["validate", path, "--require-keys", "output", "--jobs", "1"]) == 1
+    captured = capsys.readouterr()
+    printed = captured.out.splitlines()
+    assert len(printed) == 2
+    assert "line 2" in printed[0].lower() and "line 3" in printed[1].lower()
+    assert "2 valid JSON lines, 2 problems" in captured.err
+    assert jsonl_cli.main(["validate", write_jsonl([{"input": "a"}], "ok.jsonl"), "--jobs", "1"]) == 0
+
+
+def test_stats_command_counts_every_field(write_jsonl, capsys):
+    records = [{"instruction": "Sum.", "input": "1 2", "output": "3"}, {"instruction": "Sum.", "input": "1 2", "output": None},
+               {"input": " ", "output": ""}, {"instruction": "Sum.", "input": "3 4", "output": "7" * 20}]
+    path = write_jsonl(records + ["not json"])
+    assert jsonl_cli.main(["stats", path, "--json"]) == 0
+    summary = json.loads(capsys.readouterr().out)
+    assert summary["records"] == 4 and summary["invalid_lines"] == 1
+    assert summary["duplicate_inputs"] == 1 and summary["duplicate_groups"] == {"2": 1}
+    fields = summary["fields"]
+    assert (fields["instruction"]["missing"], fields["instruction"]["empty"]) == (1, 1)
+    assert (fields["input"]["missing"], fields["input"]["empty"], fields["input"]["max_chars"]) == (0, 1, 3)
+    assert (fields["output"]["missing"], fields["output"]["empty"], fields["output"]["max_chars"]) == (0, 2, 20)
+    assert fields["output"]["histogram"] == [[0, 0, 2], [1, 1, 1], [2, 3, 0], [4, 7, 0], [8, 15, 0], [16, 31, 1]]
+    assert summary["top_instructions"] == [{"instruction": "Sum.", "records": 3}]
@@ -0,0 +1,723 @@
+import io
+import json
+import os
+import random
+import re
+from array import array
+
+import pytest
+
+import jsonl_dataset
+from jsonl_dataset import (ColumnarRecords, ContaminationIndex, Dataset, EditHistory, EditJournal, FileChangedError, LineIndexedStore,
+                           NearDuplicateIndex, RecordStats, RecordView, ReferenceIndex, ScanCache, SearchIndex,
+                           TailFollower)
+
+
+class InlineTask:
+    """Stands in for the editor's BackgroundTask: messages are handled as they are posted."""
+
+    def __init__(self, on_message=None):
+        self.on_message = on_message
+
+    def cancelled(self):
+        return False
+
+    def post(self, *message):
+        if self.on_message is not None:
+            self.on_message(*message)
+
+
+def records(n, start=0):
+    return [{"instruction": "Summarize.", "input": f"text {i}", "output": f"summary {i}"} for i in range(start, start + n)]
+
+
+def load(path, use_cache=True, workers=1):
+    # What the editor does: map the file, scan it on a "worker", take in the batches.
+    dataset = Dataset.map(path)
+    task = InlineTask(lambda kind, *message: kind == "rows" and dataset.extend_scanned(*message[:4], shard=message[6]))
+    dataset.finish_scan(dataset.scan(task, workers=workers, use_cache=use_cache))
+    return dataset
+
+
+# --- ColumnarRecords ---
+
+def test_shared_instruction_is_freed_with_its_last_record():
+    columns = ColumnarRecords()
+    prompt = "Summarize the text."
+    stored = {key: {"instruction": prompt, "input": f"text {key}", "output": f"summary {key}"} for key in range(3)}
+    for key, record in stored.items():
+        columns[key] = record
+    assert len(columns._buffers[0]) == len(prompt) # The three records share one copy
+
+    def check():
+        assert {key: columns[key] for key in columns.keys()} == stored
+
+    stored[0] = columns[0] = {"instruction": "Translate.", "input": "text 0", "output": "translation"}
+    check()
+    assert prompt in columns._interned[0] and columns._garbage == len("text 0") + len("summary 0")
+    columns.discard(1)
+    del stored[1]
+    check()
+    assert prompt in columns._interned[0] # Record 2 still uses it
+    garbage = columns._garbage
+    stored[2] = columns[2] = {"instruction": "Translate.", "input": "text 2", "output": "summary 2"}
+    check()
+    assert prompt not in columns._interned[0]
+    assert columns._garbage == garbage + len(prompt) + len("text 2") + len("summary 2")
+    assert set(columns._refs[0].values()) == {2} # Both records share "Translate."
+    columns[3] = {"instruction": prompt} # Interned afresh
+    stored[3] = {"instruction": prompt}
+    check()
+    assert columns._refs[0][columns._interned[0][prompt]] == 1
+
+    columns.compact()
+    check()
+    assert len(columns._buffers[0]) == len("Translate.") + len(prompt)
+    assert columns._garbage == 0 and sorted(columns._refs[0].values()) == [1, 2]
+
+
+def test_distinct_instructions_do_not_pin_the_intern_table(monkeypatch):
+    monkeypatch.setattr(ColumnarRecords, "INTERN_LIMIT", 8)
+    monkeypatch.setattr(ColumnarRecords, "COMPACT_MIN_BYTES", 0)
+    columns = ColumnarRecords()
+    for n in range(1000): # One record edited over and over, a new instruction each time
+        columns[0] = {"instruction": f"Prompt number {n}.", "output": "x"}
+        assert columns[0] == {"instruction": f"Prompt number {n}.", "output": "x"}
+        assert list(columns._interned[0]) == [f"Prompt number {n}."]
+    assert columns.nbytes < 200 # Compacted as the garbage builds up
+
+
+# --- LineIndexedStore ---
+
+def test_store_edits_and_save(write_jsonl):
+    path = write_jsonl(records(5))
+    with open(path, 'rb') as f:
+        original = f.read().splitlines()
+    store = LineIndexedStore.open(path)
+    try:
+        assert len(store) == 5
+        assert store[2] == records(5)[2]
+        store[1] = {"input": "edited"}
+        del store[3]
+        store.insert(0, {"input": "first"})
+        store.append([1, 2]) # Any JSON value
+        expected = [{"input": "first"}, records(5)[0], {"input": "edited"}, records(5)[2], records(5)[4], [1, 2]]
+        assert list(store) == expected
+        store.save(path)
+        assert list(store) == expected
+    finally:
+        store.close()
+    with open(path, 'rb') as f:
+        saved = f.read().splitlines()
+    assert [json.loads(line) for line in saved] == expected
+    assert saved[1] == original[0] and saved[3] == original[2] # Unchanged lines are copied byte for byte
+    reopened = LineIndexedStore.open(path)
+    try:
+        assert list(reopened) == expected
+    finally:
+        reopened.close()
+
+
+def test_store_notifies_listeners(write_jsonl):
+    store = LineIndexedStore.open(write_jsonl(records(3)))
+    events = []
+    store.add_listener(lambda kind, index, record_id, old, new: events.append((kind, index, old, new)))
+    try:
+        store[0] = {"input": "x"}
+        del store[1]
+        store.insert(1, {"input": "y"})
+    finally:
+        store.close()
+    assert events == [("replace", 0, records(3)[0], {"input": "x"}), ("delete", 1, records(3)[1], None),
+                      ("insert", 1, None, {"input": "y"})]
+
+
+def test_delete_many_and_insert_many(write_jsonl):
+    store = LineIndexedStore.open(write_jsonl(records(6)))
+    try:
+        store.delete_many([0, 2, 4])
+        assert list(store) == [records(6)[i] for i in (1, 3, 5)]
+        store.insert_many([(0, {"input": "a"}), (2, {"input": "b"})])
+        assert list(store) == [{"input": "a"}, records(6)[1], {"input": "b"}, records(6)[3], records(6)[5]]
+    finally:
+        store.close()
+
+
+# --- RecordView ---
+
+def test_sorted_view_keeps_ties_in_dataset_order():
+    store = LineIndexedStore()
+    for text in ("bb", "a", "cc", "dd", "e"):
+        store.append({"input": text})
+    length = lambda record_id: len(store.peek(record_id)["input"])
+    views = [RecordView(key=length), RecordView(key=length, descending=True)]
+    for view in views:
+        view.build(store)
+        view.listen()
+    store.insert(0, {"input": "ff"}) # Ties with bb, cc and dd, ahead of them all
+    store[3] = {"input": "gg"} # cc edited: same length, same row
+    store[2] = {"input": "hh"} # a grows into the tie
+    store.insert_many([(2, {"input": "i"}), (5, {"input": "jj"})])
+    store.append({"input": "kk"})
+    for view in views:
+        fresh = RecordView(view.predicate, view.key, view.descending)
+        fresh.build(store)
+        rows = [view.record_id(row) for row in range(len(view))]
+        assert rows == [fresh.record_id(row) for row in range(len(fresh))]
+        assert [view.row_of(record_id) for record_id in rows] == list(range(len(rows)))
+    texts = [store.peek(views[0].record_id(row))["input"] for row in range(len(views[0]))]
+    assert texts == ["i", "e", "ff", "bb", "hh", "gg", "jj", "dd", "kk"]
+
+
+# --- EditHistory ---
+
+def test_undo_redo_restores_every_step():
+    store = LineIndexedStore()
+    history = EditHistory(1024 * 1024)
+    history.attach(store)
+    snapshots = [list(store)]
+    for step, change in enumerate((
+            lambda: store.append({"input": "a", "output": "1"}),
+            lambda: store.append({"input": "b"}),
+            lambda: store.__setitem__(0, {"input": "a", "output": "2", "extra": True}),
+            lambda: store.delete_many([0, 1]),
+            lambda: store.insert_many([(0, {"input": "c"}), (1, [1, 2])]),
+            lambda: store.__setitem__(1, {"input": "d"}), # A list replaced by an object
+    )):
+        history.begin(f"Step {step}", 0)
+        change()
+        snapshots.append(list(store))
+    for snapshot in reversed(snapshots[:-1]):
+        history.undo(0)
+        assert list(store) == snapshot
+    assert not history.can_undo()
+    for snapshot in snapshots[1:]:
+        history.redo()
+        assert list(store) == snapshot
+    assert not history.can_redo()
+
+
+def test_new_change_clears_redo():
+    store = LineIndexedStore()
+    history = EditHistory(1024 * 1024)
+    history.attach(store)
+    history.begin("Add", 0)
+    store.append({"input": "a"})
+    history.undo(0)
+    assert history.can_redo()
+    history.begin("Add", 0)
+    store.append({"input": "b"})
+    assert not history.can_redo()
+    assert list(store) == [{"input": "b"}]
+
+
+def test_history_stays_within_budget():
+    store = LineIndexedStore()
+    history = EditHistory(4096)
+    history.attach(store)
+    for n in range(100):
+        history.begin(f"Add {n}", 0)
+        store.append({"input": "x" * 200})
+    undone = 0
+    while history.can_undo():
+        history.undo(0)
+        undone += 1
+    assert 0 < undone < 100
+    assert len(store) == 100 - undone
+
+
+# --- EditJournal ---
+
+def test_journal_replays_onto_the_file(write_jsonl):
+    path = write_jsonl(records(4))
+    dataset = Dataset.open(path)
+    try:
+        dataset.store[0] = {"input": "edited"}
+        del dataset.store[2]
+        dataset.store.append({"input": "added"})
+        dataset.journal.flush()
+        expected = list(dataset.store)
+    finally:
+        dataset.store.close() # As if the editor crashed: the file itself was never written
+    ops = EditJournal.read_ops(path)
+    assert [op["op"] for op in ops] == ["replace", "delete", "insert"]
+
+    recovered = Dataset.open(path)
+    try:
+        assert recovered.journal.replay(ops) == 3
+        assert list(recovered.store) == expected
+    finally:
+        recovered.close()
+
+
+def test_compact_file_writes_the_journal_into_the_file(write_jsonl):
+    path = write_jsonl(records(3))
+    dataset = Dataset.open(path)
+    dataset.store[1] = {"input": "edited"}
+    dataset.journal.flush()
+    expected = list(dataset.store)
+    dataset.store.close()
+    EditJournal.compact_file(path)
+    assert not os.path.exists(EditJournal.journal_path(path))
+    with open(path, encoding='utf-8') as f:
+        assert [json.loads(line) for line in f] == expected
+
+
+def test_journal_of_a_changed_file_is_not_replayed(write_jsonl):
+    path = write_jsonl(records(3))
+    dataset = Dataset.open(path)
+    dataset.store[1] = {"input": "edited"}
+    dataset.journal.flush()
+    dataset.store.close()
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps({"input": "written by someone else"}) + "\n")
+    assert EditJournal.read_ops(path) is None
+
+
+# --- SearchIndex ---
+
+COLORS = ("red", "green", "blue", "amber", "violet")
+ANIMALS = ("fox", "owl", "cat", "eel", "yak", "emu", "ox")
+
+
+def animal_records(n):
+    return [{"instruction": "Describe.", "input": f"a {COLORS[i % 5]} {ANIMALS[i % 7]}", "output": f"number {i}"}
+            for i in range(n)]
+
+
+def check_search(dataset):
+    # Every query gives exactly the live records containing its words, as an index built
+    # from scratch over the current records does.
+    store = dataset.store
+    fresh = SearchIndex(Dataset.SEARCH_KEYS)
+    for record_id, record in store.items():
+        fresh.add(record_id, record)
+    fresh.store = store
+    words = {record_id: fresh.record_words(store.peek(record_id)) for record_id in store.record_ids()}
+    for query in COLORS + ANIMALS + ("red fox", "blue owl cat", "number 7", "describe"):
+        expected = sorted(record_id for record_id, found in words.items() if set(SearchIndex.words(query)) <= found)
+        assert dataset.search.search(query) == expected == fresh.search(query)
+    assert dataset.search.search("a red", "phrase") == fresh.search("a red", "phrase")
+    for word in COLORS + ANIMALS: # Dead and edited-out ids are purged from the postings, not only skipped
+        posting = dataset.search._posting(word)
+        assert list(posting or ()) == sorted(record_id for record_id, found in words.items() if word in found)
+
+
+def test_parallel_scan_builds_the_same_search_index(write_jsonl, monkeypatch, small_chunks):
+    monkeypatch.setattr(jsonl_dataset, "PARALLEL_SCAN_BYTES", 0)
+    path = write_jsonl(animal_records(200))
+    serial = load(path, use_cache=False)
+    parallel = load(path, use_cache=False, workers=2) # One SearchIndex per chunk, merged in file order
+    try:
+        for query in COLORS + ANIMALS + ("red fox", "number 150"):
+            assert parallel.search.search(query) == serial.search.search(query)
+        check_search(parallel)
+    finally:
+        serial.close()
+        parallel.close()
+
+
+def test_search_follows_deletes_edits_and_undo(write_jsonl, monkeypatch, small_chunks):
+    monkeypatch.setattr(jsonl_dataset, "PARALLEL_SCAN_BYTES", 0)
+    dataset = load(write_jsonl(animal_records(120)), use_cache=False, workers=2)
+    store, history = dataset.store, dataset.history
+    try:
+        changes = (
+            lambda: store.delete_many([0, 5, 10, 35]), # red foxes among them
+            lambda: store.__setitem__(3, {"input": "a grey wolf"}), # Edits words out...
+            lambda: store.__setitem__(3, {"input": "a grey fox"}), # ...and one back in
+            lambda: store.insert(0, {"input": "a red fox", "output": "number 7"}),
+            lambda: store.__setitem__(1, ["not", "an", "object"]),
+            lambda: store.delete_many(range(0, 40, 2)),
+        )
+        for step, change in enumerate(changes):
+            history.begin(f"Step {step}", 0)
+            change()
+            check_search(dataset)
+        for _ in changes:
+            history.undo(0)
+            check_search(dataset)
+        for _ in changes:
+            history.redo()
+            check_search(dataset)
+    finally:
+        dataset.close()
+
+
+# --- Batch operations ---
+
+def letters_dataset(text):
+    dataset = Dataset()
+    for letter in text:
+        dataset.store.append({"input": letter})
+    return dataset
+
+
+def inputs(dataset):
+    return "".join(record["input"] for record in dataset)
+
+
+def test_move_to_the_top_bottom_and_middle():
+    dataset = letters_dataset("abcdefg")
+    assert list(dataset.move([3, 5], 0)) == [0, 1] and inputs(dataset) == "dfabceg"
+    assert list(dataset.move([0, 2], len(dataset))) == [5, 6] and inputs(dataset) == "fbcegda"
+    assert list(dataset.move([6, 1], 4)) == [3, 4] and inputs(dataset) == "fcebagd" # Keeps their order
+    assert list(dataset.move([2], 3)) == [2] and inputs(dataset) == "fcebagd" # In front of the next one: no change
+
+
+def test_move_is_one_undo_step():
+    dataset = letters_dataset("abcdefg")
+    dataset.history.begin("Move", 0)
+    dataset.move([1, 4, 5], 0)
+    dataset.history.begin("Move", 0)
+    dataset.move([0], 7)
+    assert inputs(dataset) == "efacdgb"
+    dataset.history.undo(0)
+    assert inputs(dataset) == "befacdg"
+    dataset.history.undo(0)
+    assert inputs(dataset) == "abcdefg"
+    dataset.history.redo()
+    assert inputs(dataset) == "befacdg"
+
+
+def test_later_duplicates_keep_the_first_of_each_input():
+    dataset = letters_dataset("abacabca")
+    assert dataset.later_duplicates() == [2, 4, 5, 6, 7]
+    dataset.store[0] = {"input": "z"} # The first "a" is edited away: the next one is kept
+    assert dataset.later_duplicates() == [4, 5, 6, 7]
+    dataset.store[3] = {"input": " b "} # Edited into a duplicate (inputs are compared stripped)...
+    assert dataset.later_duplicates() == [3, 4, 5, 7] # ...and the "c" left is no longer one
+    dataset.store.delete_many(dataset.later_duplicates())
+    assert inputs(dataset) == "zbac"
+    assert dataset.later_duplicates() == [] and dataset.duplicates.duplicate_count() == 0
+
+
+def test_find_replacements_with_a_regex_or_literal_text():
+    dataset = Dataset()
+    for text in ("cat 1", "dog 2", "cat 3", "cat 4"):
+        dataset.store.append({"instruction": "Name it.", "input": text, "output": text.upper()})
+    dataset.store.append(["cat 5"]) # Not an object: left alone
+    pattern = re.compile(r"(cat|dog) (\d)", re.IGNORECASE)
+    edits = dataset.find_replacements(pattern, r"\2 \1")
+    assert [dict(record) for _, record in edits] == [
+        {"instruction": "Name it.", "input": "1 cat", "output": "1 CAT"}, {"instruction": "Name it.", "input": "2 dog", "output": "2 DOG"},
+        {"instruction": "Name it.", "input": "3 cat", "output": "3 CAT"}, {"instruction": "Name it.", "input": "4 cat", "output": "4 CAT"}]
+    assert list(dataset)[0]["input"] == "cat 1" # Nothing is written until replace_records()
+
+    literal = re.compile(re.escape("cat"))
+    edits = dataset.find_replacements(literal, lambda match: r"\1", keys=("input",), positions=[0, 1, 3, 4])
+    assert [record_id for record_id, _ in edits] == [dataset.store.record_id(0), dataset.store.record_id(3)]
+    dataset.history.begin("Replace", 0)
+    assert dataset.replace_records(edits) == [0, 3]
+    assert [record["input"] for record in list(dataset)[:4]] == [r"\1 1", "dog 2", "cat 3", r"\1 4"]
+    assert list(dataset)[0]["output"] == "CAT 1"
+    dataset.history.undo(0)
+    assert [record["input"] for record in list(dataset)[:4]] == ["cat 1", "dog 2", "cat 3", "cat 4"]
+
+
+# --- NearDuplicateIndex ---
+
+def paragraph(seed, words=60):
+    rng = random.Random(seed)
+    return " ".join("".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randrange(3, 9)))
+                    for _ in range(words))
+
+
+def near_duplicate_ids(dataset):
+    # Pairs of live records whose signatures reach the threshold, found by comparing all.
+    index = dataset.near_duplicates
+    signatures = {record_id: index.signature(dataset.store.peek(record_id)) for record_id in dataset.store.record_ids()}
+    signatures = {record_id: signature for record_id, signature in signatures.items() if signature is not None}
+    return {a for a in signatures for b in signatures
+            if a != b and NearDuplicateIndex.similarity(signatures[a], signatures[b]) >= index.threshold}
+
+
+def test_near_duplicates_cluster_and_distinct_texts_do_not():
+    dataset = Dataset()
+    a, b, c = paragraph(1), paragraph(2), paragraph(3)
+    for text in (a, b, c, a.upper() + "!!", a.replace(a.split()[10], "changed", 1), b + " and one more", "", "short"):
+        dataset.store.append({"input": text})
+    dataset.set_near_duplicates(dataset.build_near_duplicates(0.8))
+    index = dataset.near_duplicates
+    ids = list(dataset.store.record_ids())
+    assert {record_id for record_id in ids if index.is_duplicate(record_id)} == {ids[i] for i in (0, 1, 3, 4, 5)}
+    assert set(index.neighbors(ids[0])) == {ids[3], ids[4]} and set(index.neighbors(ids[5])) == {ids[1]}
+    assert index.cluster(ids[0]) == index.cluster(ids[4]) != index.cluster(ids[1]) == index.cluster(ids[5])
+    assert index.cluster(ids[2]) == 0 and index.cluster_count() == 2
+    assert index.duplicate_count() == 5 == len(dataset.build_view("near_duplicates"))
+    assert not index.take_changed()
+
+
+def test_near_duplicates_follow_edits_and_deletes():
+    dataset = Dataset()
+    store = dataset.store
+    texts = [paragraph(seed) for seed in range(6)]
+    for text in texts + [texts[0] + " again", texts[1] + " again"]:
+        store.append({"input": text})
+    dataset.set_near_duplicates(dataset.build_near_duplicates(0.8))
+    index = dataset.near_duplicates
+    ids = list(store.record_ids())
+    assert near_duplicate_ids(dataset) == {ids[0], ids[1], ids[6], ids[7]}
+
+    store[7] = {"input": paragraph(99)} # No longer like record 1
+    assert index.take_changed() == {ids[1], ids[7]}
+    assert not index.is_duplicate(ids[1]) and not index.is_duplicate(ids[7])
+    store[2] = {"input": texts[0] + " once more"} # Joins record 0's cluster
+    assert set(index.neighbors(ids[2])) == {ids[0], ids[6]} and index.take_changed() == {ids[0], ids[2], ids[6]}
+    assert index.cluster(ids[2]) == index.cluster(ids[0]) == index.cluster(ids[6])
+    del store[0]
+    assert index.take_changed() == {ids[0], ids[2], ids[6]}
+    assert index.is_duplicate(ids[2]) and index.is_duplicate(ids[6]) # Still alike each other
+    store.insert(0, {"input": texts[3]}) # An exact copy of record 3
+    inserted = store.record_id(0)
+    assert set(index.neighbors(inserted)) == {ids[3]} and index.take_changed() == {inserted, ids[3]}
+    assert {record_id for record_id in store.record_ids() if index.is_duplicate(record_id)} == near_duplicate_ids(dataset)
+    assert index.duplicate_count() == len(dataset.build_view("near_duplicates")) == 4
+
+
+# --- Contamination checks ---
+
+EVAL = [{"input": paragraph(100 + i, 30), "output": paragraph(200 + i, 30)} for i in range(5)]
+
+
+def test_contamination_flags_exact_and_overlapping_records(write_jsonl):
+    reference = write_jsonl(EVAL, "eval.jsonl")
+    passage = " ".join(EVAL[1]["output"].split()[5:25])
+    dataset = Dataset()
+    store = dataset.store
+    for record in ({"input": EVAL[0]["input"].upper() + "?", "output": "x"}, # Exact once normalized
+                   {"input": f"Quote: {passage}, and so on.", "output": "y"}, # Shares a passage
+                   {"input": paragraph(300, 30), "output": paragraph(301, 30)},
+                   {"input": "yes", "output": EVAL[2]["output"].split()[0]}): # Too short to flag
+        store.append(record)
+    dataset.set_contamination(dataset.build_contamination([reference], workers=1))
+    index = dataset.contamination
+    ids = list(store.record_ids())
+    try:
+        assert [index.flag(record_id) for record_id in ids] == [ContaminationIndex.EXACT, ContaminationIndex.OVERLAP, 0, 0]
+        assert index.contaminated_count() == 2 == len(dataset.build_view("contaminated"))
+        assert not index.take_changed()
+
+        store[0] = {"input": passage} # Exact to overlap: still flagged, but drawn differently
+        assert index.flag(ids[0]) == ContaminationIndex.OVERLAP and index.take_changed() == {ids[0]}
+        store[1] = {"input": EVAL[3]["output"]} # Overlap to exact
+        assert index.flag(ids[1]) == ContaminationIndex.EXACT and index.take_changed() == {ids[1]}
+        store[2] = dict(store[2]) # Unchanged flag: nothing to redraw
+        assert not index.take_changed()
+        store[3] = {"input": EVAL[4]["input"]}
+        del store[0]
+        assert index.take_changed() == {ids[3]} and index.contaminated_count() == 2
+        assert [index.flag(record_id) for record_id in store.record_ids()] == [ContaminationIndex.EXACT, 0, ContaminationIndex.EXACT]
+    finally:
+        dataset.close()
+
+
+def test_reference_index_is_rebuilt_when_the_reference_changes(write_jsonl):
+    path = write_jsonl(EVAL, "eval.jsonl")
+    assert ReferenceIndex.load(path) is None
+    reference = ReferenceIndex.open(path, workers=1)
+    assert os.path.exists(ReferenceIndex.index_paths(path)[0]) and reference.header["records"] == 5
+    reference.close()
+    reference = ReferenceIndex.load(path) # Current: opened without hashing anything
+    assert reference is not None
+    reference.close()
+
+    added = {"input": paragraph(400, 30)}
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(added) + "\n")
+    assert ReferenceIndex.load(path) is None
+    reference = ReferenceIndex.open(path, workers=1)
+    try:
+        assert reference.header["records"] == 6
+        assert ContaminationIndex([reference]).matches(added) == [(reference, ContaminationIndex.EXACT)]
+    finally:
+        reference.close()
+
+
+def test_sorted_hash_writer_spills_to_buckets(monkeypatch):
+    monkeypatch.setattr(jsonl_dataset._SortedHashWriter, "SPILL_VALUES", 100)
+    rng = random.Random(2)
+    values = [rng.randrange(-2 ** 63, 2 ** 63) for _ in range(500)] + [-2 ** 63, 2 ** 63 - 1, 0, -1]
+    writer = jsonl_dataset._SortedHashWriter()
+    for start in range(0, 2000, 70): # Every value several times, across spills
+        writer.add(array('q', [values[i % len(values)] for i in range(start, start + 70)]))
+    assert writer._spill_dir is not None
+    spill_dir = writer._spill_dir
+    out = io.BytesIO()
+    assert writer.write(out) == len(set(values))
+    assert array('q', out.getvalue()).tolist() == sorted(set(values))
+    assert not os.path.exists(spill_dir)
+
+
+# --- RecordStats / DatasetStats ---
+
+def check_stats(dataset):
+    # The counts kept current through the edits equal those of the current records counted
+    # from scratch, and a field counts as empty exactly when the empty_* view lists it.
+    kept = dataset.stats.summary()
+    assert kept == dataset.build_stats().summary()
+    fresh = RecordStats()
+    for record in dataset:
+        fresh.add(record)
+    assert kept == fresh.summary()
+    for key in Dataset.SEARCH_KEYS:
+        assert kept["fields"][key]["empty"] == len(dataset.build_view(f"empty_{key}"))
+
+
+def test_stats_follow_edits_of_missing_null_and_empty_fields():
+    dataset = Dataset()
+    store = dataset.store
+    for record in ({"instruction": "Sum.", "input": "1 2", "output": "3"}, {"instruction": "Sum.", "input": "", "output": None},
+                   {"input": "1 2", "output": "   "}, {"instruction": None, "input": "4 5"}, ["not", "an", "object"],
+                   {"instruction": "Sum.", "input": "1 2", "output": 3}):
+        store.append(record)
+    dataset.set_stats(dataset.build_stats())
+    check_stats(dataset)
+    summary = dataset.stats.summary()
+    assert summary["duplicate_inputs"] == 2 and summary["duplicate_groups"] == {3: 1}
+    assert summary["fields"]["output"]["missing"] == 2 and summary["fields"]["output"]["empty"] == 4
+    assert summary["top_instructions"] == [{"instruction": "Sum.", "records": 3}]
+
+    changes = (
+        lambda: store.__setitem__(0, {"instruction": "Sum.", "input": "6 7", "output": ""}),
+        lambda: store.__setitem__(1, {"instruction": "Product.", "input": "1 2", "output": "2" * 40}),
+        lambda: store.insert(2, {"input": None, "output": "long " * 30}),
+        lambda: store.__setitem__(4, {"instruction": "Sum.", "input": " 4 5 "}),
+        lambda: store.delete_many([0, 3]),
+        lambda: store.__setitem__(0, "a string"),
+    )
+    for step, change in enumerate(changes):
+        dataset.history.begin(f"Step {step}", 0)
+        change()
+        check_stats(dataset)
+    for _ in changes:
+        dataset.history.undo(0)
+        check_stats(dataset)
+    assert dataset.stats.summary() == summary
+
+
+# --- TailFollower ---
+
+def append(path, text):
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(text)
+
+
+def test_follow_takes_in_appended_lines(write_jsonl):
+    path = write_jsonl(records(3))
+    dataset = load(path, use_cache=False)
+    dataset.set_stats(dataset.build_stats())
+    follower = TailFollower(dataset)
+    try:
+        assert follower.poll() == (0, [])
+        append(path, json.dumps(records(1, 3)[0]) + "\n" + json.dumps(records(1)[0]) + "\n" + '{"input": "half')
+        assert follower.poll() == (2, []) # The last line is still being written
+        append(path, ' a line"}\n\nnot json\n')
+        added, errors = follower.poll()
+        assert added == 1 and [e.line_number for e in errors] == [8]
+        assert list(dataset) == records(4) + [records(1)[0], {"input": "half a line"}]
+        assert dataset.is_duplicate(0) and dataset.is_duplicate(4)
+        assert dataset.find("half") == [5] and dataset.stats.summary()["records"] == 6
+        assert [e.line_number for e in dataset.invalid_lines] == [8]
+        assert not dataset.history.can_undo() # Part of the file, not an edit
+        assert follower.poll() == (0, [])
+    finally:
+        dataset.close()
+
+
+def test_save_while_following(write_jsonl):
+    path = write_jsonl(records(3))
+    dataset = load(path, use_cache=False)
+    follower = TailFollower(dataset)
+    try:
+        dataset.store[0] = {"input": "edited"}
+        append(path, json.dumps(records(1, 3)[0]) + "\n")
+        with pytest.raises(FileChangedError): # The appended line has not been read yet
+            dataset.save()
+        assert follower.poll() == (1, [])
+        dataset.save()
+        expected = [{"input": "edited"}] + records(4)[1:]
+        with open(path, encoding='utf-8') as f:
+            assert [json.loads(line) for line in f] == expected
+        append(path, json.dumps(records(1, 4)[0]) + "\n")
+        assert follower.poll() == (1, []) # Picks up again in the new file
+        assert list(dataset) == expected + records(1, 4)
+    finally:
+        dataset.close()
+
+
+def test_follow_notices_a_truncated_or_replaced_file(write_jsonl):
+    path = write_jsonl(records(20))
+    dataset = load(path, use_cache=False)
+    follower = TailFollower(dataset)
+    try:
+        follower.poll()
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(records(1)[0]) + "\n")
+        with pytest.raises(FileChangedError, match="truncated"):
+            follower.poll()
+    finally:
+        dataset.close()
+
+    path = write_jsonl(records(20), "other.jsonl")
+    dataset = load(path, use_cache=False)
+    follower = TailFollower(dataset)
+    try:
+        follower.poll()
+        with open(path, 'w', encoding='utf-8') as f: # Rewritten in place, longer than before
+            for record in records(30, 100):
+                f.write(json.dumps(record) + "\n")
+        with pytest.raises(FileChangedError, match="replaced"):
+            follower.poll()
+    finally:
+        dataset.close()
+
+
+# --- ScanCache ---
+
+def test_scan_cache_is_reused(write_jsonl, monkeypatch):
+    monkeypatch.setattr(ScanCache, "MIN_BYTES", 0)
+    path = write_jsonl(records(50) + ["not json"] + records(10, 50))
+    first = load(path)
+    expected = list(first)
+    first.close()
+    assert os.path.exists(ScanCache.cache_path(path))
+
+    scans = []
+    real_scan = jsonl_dataset.scan_and_hash_records
+    monkeypatch.setattr(jsonl_dataset, "scan_and_hash_records", lambda *args, **kwargs: scans.append(1) or real_scan(*args, **kwargs))
+    again = load(path)
+    try:
+        assert not scans # Nothing was parsed again
+        assert list(again) == expected
+        assert [e.line_number for e in again.invalid_lines] == [51]
+        assert again.find("text 55") == [55]
+        assert again.duplicates.duplicate_count() == 0
+    finally:
+        again.close()
+
+
+def test_scan_cache_resumes_after_an_append(write_jsonl, monkeypatch):
+    monkeypatch.setattr(ScanCache, "MIN_BYTES", 0)
+    path = write_jsonl(records(30))
+    load(path).close()
+    with open(path, 'a', encoding='utf-8') as f:
+        for record in records(5, 30) + [records(1)[0]]: # The last one repeats the first input
+            f.write(json.dumps(record) + "\n")
+
+    resumes = []
+    real_scan = jsonl_dataset.scan_and_hash_records
+
+    def scan(*args, **kwargs):
+        resumes.append(kwargs.get("resume"))
+        return real_scan(*args, **kwargs)
+
+    monkeypatch.setattr(jsonl_dataset, "scan_and_hash_records", scan)
+    dataset = load(path)
+    try:
+        assert len(resumes) == 1 and resumes[0] is not None and resumes[0][3] == 30 # Only the new lines
+        assert list(dataset) == records(30) + records(5, 30) + [records(1)[0]]
+        assert dataset.is_duplicate(0) and dataset.is_duplicate(35)
+        assert dataset.find("text 33") == [33]
+    finally:
+        dataset.close()
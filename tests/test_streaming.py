@@ -0,0 +1,226 @@
+import gzip
+import io
+import json
+import random
+from collections import Counter
+
+import pytest
+
+import jsonl_dataset
+from jsonl_dataset import (RecordDecodeError, RecordStats, count_values, dedupe_file, dedupe_records, diff_files, iter_records,
+                           merge_files, sample_records, shuffle_lines, validate_file)
+
+
+def corpus(n, seed=0):
+    rng = random.Random(seed)
+    return [{"instruction": "Answer.", "input": f"question {rng.randrange(n // 3)}" if rng.random() < 0.9 else "",
+             "output": f"answer {i}"} for i in range(n)]
+
+
+# --- dedupe_file ---
+
+def test_dedupe_file_matches_dedupe_records_for_any_worker_count(write_jsonl, small_chunks):
+    records = corpus(400) + [{"input": " question 1 "}] # Surrounding whitespace is ignored...
+    path = write_jsonl(records)
+    removed = []
+    expected = b"".join(line + b"\n" for _, line, _ in dedupe_records(iter_records(path), removed=removed))
+    for workers in (1, 3):
+        out = io.BytesIO()
+        report = io.StringIO()
+        kept, dropped = dedupe_file(path, out, report=report, workers=workers)
+        assert out.getvalue() == expected
+        assert (kept, dropped) == (len(records) - len(removed), len(removed))
+        assert report.getvalue().split() == [str(line_number) for line_number in removed]
+    assert len(removed) > 100 # ...and the corpus has plenty of duplicates
+
+
+def test_dedupe_file_in_several_passes(write_jsonl, monkeypatch):
+    # Buckets with more hashes than fit in memory are read in passes. One worker runs the
+    # buckets in-process, so the limit can be lowered to a few entries.
+    dedupe_bucket = jsonl_dataset._dedupe_bucket
+    monkeypatch.setattr(jsonl_dataset, "_dedupe_bucket", lambda bucket_path, max_entries: dedupe_bucket(bucket_path, 2))
+    path = write_jsonl(corpus(3000, seed=1))
+    expected = b"".join(line + b"\n" for _, line, _ in dedupe_records(iter_records(path)))
+    out = io.BytesIO()
+    dedupe_file(path, out, workers=1)
+    assert out.getvalue() == expected
+
+
+def test_dedupe_file_reads_compressed_input_and_skips_invalid_lines(tmp_path):
+    path = str(tmp_path / "data.jsonl.gz")
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        f.write('{"input": "a"}\nnot json\n{"input": "a"}\n{"input": "b"}\n')
+    out = io.BytesIO()
+    errors = []
+    assert dedupe_file(path, out, errors=errors, workers=1) == (2, 1)
+    assert out.getvalue() == b'{"input": "a"}\n{"input": "b"}\n'
+    assert [e.line_number for e in errors] == [2]
+    with pytest.raises(RecordDecodeError):
+        dedupe_file(path, io.BytesIO(), workers=1)
+
+
+# --- count_values ---
+
+def test_count_values_matches_counting_in_memory(write_jsonl, small_chunks, monkeypatch):
+    rng = random.Random(4)
+    records = [{"instruction": f"Prompt {rng.randrange(30)}" if rng.random() < 0.8 else " ", "input": f"question {rng.randrange(200)}"}
+               for _ in range(600)]
+    path = write_jsonl(records + ["not json"])
+    stats = RecordStats()
+    for record in records:
+        stats.add(record)
+    instructions = Counter(record["instruction"] for record in records if record["instruction"].strip())
+    first_line = {}
+    for line_number, record in enumerate(records, 1):
+        first_line.setdefault(record["instruction"], line_number)
+    count_bucket = jsonl_dataset._count_bucket
+    for workers in (1, 3):
+        errors = []
+        groups, top = count_values(path, "input", errors=errors, workers=workers)
+        assert groups == stats.group_sizes() and [e.line_number for e in errors] == [601]
+        _, top = count_values(path, "instruction", 5, [], workers=workers)
+        assert [count for count, _ in top] == [count for _, count in stats.top_instructions(5)]
+        assert top == sorted(top, key=lambda entry: (-entry[0], entry[1])) # Ties in file order
+        for count, line_number in top: # The first record of each of the top instructions
+            text = records[line_number - 1]["instruction"]
+            assert instructions[text] == count and first_line[text] == line_number
+    # Buckets larger than memory are counted in passes; one worker runs them in-process.
+    monkeypatch.setattr(jsonl_dataset, "_count_bucket", lambda bucket_path, max_entries, top: count_bucket(bucket_path, 2, top))
+    assert count_values(path, "input", errors=[], workers=1)[0] == stats.group_sizes()
+    assert count_values(path, "instruction", 5, [], workers=1)[1] == top
+    with pytest.raises(RecordDecodeError):
+        count_values(path, workers=1)
+
+
+def test_count_values_breaks_ties_in_file_order(write_jsonl):
+    path = write_jsonl([{"input": text} for text in "cbabcdaxc"])
+    assert count_values(path, top=2, workers=1) == ({2: 2, 3: 1}, [(3, 1), (2, 2)])
+    assert count_values(path, top=5, workers=1)[1] == [(3, 1), (2, 2), (2, 3)]
+
+
+# --- diff_files / merge_files ---
+
+def test_diff_files_reports_every_kind_of_change(write_jsonl):
+    old = [{"id": i, "input": f"input {i}", "output": f"output {i}"} for i in range(8)]
+    new = [dict(record) for record in old]
+    new[2]["output"] = "edited" # modified
+    del new[5] # removed
+    new.insert(0, new.pop(6)) # moved (input 7)
+    new.append({"id": 99, "input": "new", "output": "added"}) # added
+    entries = list(diff_files(write_jsonl(old, "old.jsonl"), write_jsonl(new, "new.jsonl"), key="id"))
+    found = {(entry.kind, (entry.old_record or entry.new_record)["id"]) for entry in entries}
+    assert found == {("modified", 2), ("removed", 5), ("moved", 7), ("added", 99)}
+    modified = next(entry for entry in entries if entry.kind == "modified")
+    assert list(modified.fields) == ["output"] and modified.new_record["output"] == "edited"
+
+
+def test_identical_files_have_no_diff(write_jsonl):
+    records = corpus(50)
+    assert list(diff_files(write_jsonl(records, "a.jsonl"), write_jsonl(records, "b.jsonl"))) == []
+
+
+def test_merge_combines_both_sides_and_reports_conflicts(write_jsonl):
+    base = [{"input": f"q{i}", "output": f"a{i}", "note": ""} for i in range(6)]
+    ours = [dict(record) for record in base]
+    theirs = [dict(record) for record in base]
+    ours[0]["output"] = "ours" # Changed on one side only
+    theirs[1]["output"] = "theirs"
+    ours[2]["output"] = "ours 2" # Different fields on each side
+    theirs[2]["note"] = "theirs 2"
+    ours[3]["output"] = "ours 3" # The same field on both sides
+    theirs[3]["output"] = "theirs 3"
+    del theirs[4]
+    ours.append({"input": "q ours", "output": "new"})
+    conflicts = []
+    out = io.BytesIO()
+    counts = merge_files(write_jsonl(base, "base.jsonl"), write_jsonl(ours, "ours.jsonl"), write_jsonl(theirs, "theirs.jsonl"),
+                         out, conflicts=conflicts)
+    merged = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert merged == [
+        {"input": "q0", "output": "ours", "note": ""},
+        {"input": "q1", "output": "theirs", "note": ""},
+        {"input": "q2", "output": "ours 2", "note": "theirs 2"},
+        {"input": "q3", "output": "ours 3", "note": ""}, # prefer="ours"
+        {"input": "q5", "output": "a5", "note": ""},
+        {"input": "q ours", "output": "new"},
+    ]
+    assert [conflict["fields"] for conflict in conflicts] == [["output"]]
+    assert counts["conflicts"] == 1 and counts["deleted"] == 1 and counts["added"] == 1
+
+
+# --- shuffle_lines / sample_records ---
+
+def test_shuffle_is_a_permutation_fixed_by_the_seed():
+    lines = [b"line %d" % i for i in range(1000)]
+    first = list(shuffle_lines(lines, seed=3))
+    assert sorted(first) == sorted(lines) and first != lines
+    assert list(shuffle_lines(lines, seed=3)) == first
+    assert list(shuffle_lines(lines, seed=4)) != first
+
+
+def test_shuffle_larger_than_memory_uses_runs_on_disk():
+    lines = [b"%05d" % i + b"x" * 100 for i in range(2000)]
+    shuffled = list(shuffle_lines(lines, seed=1, memory_budget=20000))
+    assert sorted(shuffled) == lines and shuffled != lines
+    assert list(shuffle_lines(lines, seed=1, memory_budget=20000)) == shuffled
+
+
+def test_sample_is_fixed_by_the_seed_and_in_file_order(write_jsonl):
+    path = write_jsonl(corpus(500))
+    picked = sample_records(iter_records(path), 20, seed=7)
+    assert len(picked) == 20 and len({line_number for line_number, _ in picked}) == 20
+    assert picked == sorted(picked)
+    assert sample_records(iter_records(path), 20, seed=7) == picked
+    assert sample_records(iter_records(path), 20, seed=8) != picked
+    assert len(sample_records(iter_records(path), 1000)) == 500 # Fewer records than asked for
+
+
+def test_sample_is_uniform():
+    hits = [0] * 10
+    for seed in range(2000):
+        for line_number, _ in sample_records(((i, b"", None) for i in range(10)), 3, seed):
+            hits[line_number] += 1
+    assert all(abs(count - 600) < 90 for count in hits) # 2000 draws of 3 in 10
+
+
+# --- validate_file ---
+
+def test_validate_reports_every_bad_line(write_jsonl, small_chunks):
+    lines = []
+    bad = {}
+    for i in range(1, 301):
+        if i % 37 == 0:
+            lines.append("{not json")
+            bad[i] = "invalid JSON"
+        elif i % 53 == 0:
+            lines.append("[1, 2]")
+            bad[i] = "expected a JSON object"
+        elif i % 71 == 0:
+            lines.append(json.dumps({"input": "no output"}))
+            bad[i] = "missing keys output"
+        else:
+            lines.append(json.dumps({"input": str(i), "output": str(i)}))
+    path = write_jsonl(lines)
+    for workers in (1, 2):
+        results = list(validate_file(path, required=("output",), workers=workers))
+        assert len(results) > 1 # Several chunks
+        problems = [problem for _, chunk in results for problem in chunk]
+        assert [line_number for line_number, _ in problems] == sorted(bad)
+        for line_number, message in problems:
+            assert f"line {line_number}" in message.lower()
+            if bad[line_number] != "invalid JSON":
+                assert bad[line_number] in message
+        valid_json = sum(records for records, _ in results)
+        assert valid_json == 300 - sum(1 for problem in bad.values() if problem == "invalid JSON")
+
+
+def test_validate_names_the_shard(tmp_path):
+    folder = tmp_path / "shards"
+    folder.mkdir()
+    (folder / "train-00000-of-00002.jsonl").write_text('{"input": "a"}\n', encoding='utf-8')
+    with gzip.open(folder / "train-00001-of-00002.jsonl.gz", 'wt', encoding='utf-8') as f:
+        f.write('{"input": "b"}\n{oops\n')
+    problems = [problem for _, chunk in validate_file(str(folder), workers=1) for problem in chunk]
+    assert len(problems) == 1
+    line_number, message = problems[0]
+    assert line_number == 2 and "train-00001-of-00002.jsonl.gz" in message